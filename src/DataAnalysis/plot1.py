@@ -103,11 +103,20 @@ matplotlib.rc('text', usetex=True)
 #matplotlib.rc('font', weight='bold')
 matplotlib.rcParams['text.latex.preamble']=[r'\usepackage{amssymb,amsmath}']
 
-for i,inputFilePath in enumerate(inputFilePath):
-    
-    print 'Parsing CSV file: ',inputFilePath
-    
-    csvData = tb.tabarray(SVfile=inputFilePath,delimiter=',')
+csvDataList = []
+for csvFilePath in inputFilePath:
+    print 'Parsing CSV file: ',csvFilePath
+    csvDataList.append(tb.tabarray(SVfile=csvFilePath,delimiter=','))
+
+# all the data sets fitted at once
+fittings = fitting.fitDataSets([csvData['realAccumulatedDose'] for csvData in csvDataList],
+                               [csvData['overallBFactor'] for csvData in csvDataList],
+                               [csvData['realAlpha'][-1] for csvData in csvDataList],
+                               [csvData['strategyResolution'][-1] for csvData in csvDataList],
+                               betas=[csvData['realBeta'][-1] for csvData in csvDataList],
+                               initialBFactors=[csvData['realInitialBFactor'][-1] for csvData in csvDataList])
+
+for i,csvData in enumerate(csvDataList):
     
     marker = markers[i%N]
     color = colormap_values[i]
@@ -131,15 +140,10 @@ for i,inputFilePath in enumerate(inputFilePath):
     #realRelativeOverallBFactor = csvData[r'realRelativeOverallBFactor']
     realRelativeOverallBFactor = csvData['overallBFactor']
     
-    realOverallBFactorFitting = fitting.Fitting(realAccumulatedDose,realRelativeOverallBFactor)
-    realOverallBFactorFitting.setContinuousX()
-    realOverallBFactorFitting.linearFitting2Coeffs()
-    realOverallBFactorFitting.setContinuousY()
-    
     beta = csvData['realBeta'][-1]
     
     ax1.plot(realAccumulatedDose,realRelativeOverallBFactor,marker=marker,linewidth=0,markerfacecolor=color,label='$\\beta=%.1e$'%beta)
-    ax1.plot(realOverallBFactorFitting.continuous_x,realOverallBFactorFitting.continuous_y)
+    ax1.plot(fittings['continuousDose'][i],fittings['continuousBFactor'][i])
     
     ax1.set_ylabel('B-Factor ($\AA^2$)')
     ax1.set_xlabel('Dose (Gy)')
@@ -161,14 +165,8 @@ for i,inputFilePath in enumerate(inputFilePath):
     realInvRelativeScale = csvData['realInvRelativeScale']
     alpha = csvData['realAlpha'][-1]
     
-    realInvRelativeScaleFitting = fitting.Fitting(realAccumulatedDose,realInvRelativeScale)
-    realInvRelativeScaleFitting.setContinuousX()
-    realInvRelativeScaleFitting.coefficients = [alpha]
-    realInvRelativeScaleFitting.function = realInvRelativeScaleFitting.funcExponentialSquaredNegative1coeffs
-    realInvRelativeScaleFitting.setContinuousY()
-    
     ax2.plot(realAccumulatedDose,realInvRelativeScale,marker=marker,linewidth=0,label='$\\alpha=%.1e$'%alpha)
-    ax2.plot(realInvRelativeScaleFitting.continuous_x,realInvRelativeScaleFitting.continuous_y)
+    ax2.plot(fittings['continuousDose'][i],fittings['continuousInvRelativeScale'][i])
     
     ax2.set_ylabel('Relative Scale')
     ax2.set_xlabel('Dose (Gy)')
@@ -188,24 +186,14 @@ for i,inputFilePath in enumerate(inputFilePath):
         plt.gca().set_color_cycle(colormap_values_dup)
         
     realRelativeAverageIntegratedIntensity = csvData['realRelativeAverageIntegratedIntensity']
-    initialB = csvData['realInitialBFactor'][-1]
-    
-    
-    realRelativeAverageIntegratedIntensityFitting = fitting.Fitting(realAccumulatedDose,realRelativeAverageIntegratedIntensity)    
-    realRelativeAverageIntegratedIntensityFitting.setContinuousX()
-    realRelativeAverageIntegratedIntensityFitting.calculateTheoreticalIntensityDecay(beta = beta,
-                                                                         gamma = alpha,
-                                                                         initialWilsonB= initialB)
     resolution = csvData['strategyResolution'][-1]
-    #resolution +=0.25
-    realRelativeAverageIntegratedIntensityFitting.doTheoreticalIntensityDecayCurve(resolution=resolution)
-    realDsOneHalf = realRelativeAverageIntegratedIntensityFitting.getTheoreticalDOneHalf()
+    realDsOneHalf = fittings['dOneHalf'][i]
     print '********************** realD1/2',realDsOneHalf
  
     
     ax3.plot(realAccumulatedDose,realRelativeAverageIntegratedIntensity,marker=marker,linewidth=0,
              label='${\\mathbf D_{1/2}}=%.1e$'%realDsOneHalf + ': ${\\boldsymbol\\alpha}=%.1e$'%alpha + ': ${\\boldsymbol\\beta}=%.1e$'%beta + ': $%.2f{\\mathbf\\AA}$'%resolution)
-    ax3.plot(realRelativeAverageIntegratedIntensityFitting.continuous_x,realRelativeAverageIntegratedIntensityFitting.continuous_y)
+    ax3.plot(fittings['continuousDose'][i],fittings['continuousRelativeIntensity'][i])
     
     ax3.set_ylabel('Relative $<I>$')
     ax3.set_xlabel('Dose (Gy)')
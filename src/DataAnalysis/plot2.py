@@ -104,11 +104,21 @@ matplotlib.rc('text', usetex=True)
 #matplotlib.rc('font', weight='bold')
 matplotlib.rcParams['text.latex.preamble']=[r'\usepackage{amssymb,amsmath}']
 
-for i,inputFilesPath in enumerate(inputFilesPath):
-    
-    print 'Parsing CSV file: ',inputFilesPath
-    
-    csvData = tb.tabarray(SVfile=inputFilesPath,delimiter=',')
+csvDataList = []
+for csvFilePath in inputFilesPath:
+    print 'Parsing CSV file: ',csvFilePath
+    csvDataList.append(tb.tabarray(SVfile=csvFilePath,delimiter=','))
+
+# all the data sets fitted at once
+fittings = fitting.fitDataSets([csvData['realAccumulatedDose'] for csvData in csvDataList],
+                               [csvData['overallBFactor'] for csvData in csvDataList],
+                               [csvData['realAlpha'][-1] for csvData in csvDataList],
+                               [csvData['strategyResolution'][-1] for csvData in csvDataList],
+                               betas=[csvData['realBeta'][-1] for csvData in csvDataList],
+                               initialBFactors=[csvData['realInitialBFactor'][-1] for csvData in csvDataList],
+                               relativeIntensities=[csvData['realRelativeAverageIntegratedIntensity'] for csvData in csvDataList])
+
+for i,csvData in enumerate(csvDataList):
     
     marker = markers[i%N]
     color = colormap_values[i]
@@ -132,15 +142,10 @@ for i,inputFilesPath in enumerate(inputFilesPath):
     #realRelativeOverallBFactor = csvData[r'realRelativeOverallBFactor']
     realRelativeOverallBFactor = csvData['overallBFactor']
     
-    realOverallBFactorFitting = fitting.Fitting(realAccumulatedDose,realRelativeOverallBFactor)
-    realOverallBFactorFitting.setContinuousX()
-    realOverallBFactorFitting.linearFitting2Coeffs()
-    realOverallBFactorFitting.setContinuousY()
-    
     beta = csvData['realBeta'][-1]
     
     ax1.plot(realAccumulatedDose,realRelativeOverallBFactor,marker=marker,linewidth=0,markerfacecolor=color,label='$\\beta=%.1e$'%beta)
-    ax1.plot(realOverallBFactorFitting.continuous_x,realOverallBFactorFitting.continuous_y)
+    ax1.plot(fittings['continuousDose'][i],fittings['continuousBFactor'][i])
     
     ax1.set_ylabel('B-Factor ($\AA^2$)')
     ax1.set_xlabel('Dose (Gy)')
@@ -162,14 +167,8 @@ for i,inputFilesPath in enumerate(inputFilesPath):
     realInvRelativeScale = csvData['realInvRelativeScale']
     alpha = csvData['realAlpha'][-1]
     
-    realInvRelativeScaleFitting = fitting.Fitting(realAccumulatedDose,realInvRelativeScale)
-    realInvRelativeScaleFitting.setContinuousX()
-    realInvRelativeScaleFitting.coefficients = [alpha]
-    realInvRelativeScaleFitting.function = realInvRelativeScaleFitting.funcExponentialSquaredNegative1coeffs
-    realInvRelativeScaleFitting.setContinuousY()
-    
     ax2.plot(realAccumulatedDose,realInvRelativeScale,marker=marker,linewidth=0,label='$\\alpha=%.1e$'%alpha)
-    ax2.plot(realInvRelativeScaleFitting.continuous_x,realInvRelativeScaleFitting.continuous_y)
+    ax2.plot(fittings['continuousDose'][i],fittings['continuousInvRelativeScale'][i])
     
     ax2.set_ylabel('Relative Scale')
     ax2.set_xlabel('Dose (Gy)')
@@ -189,30 +188,12 @@ for i,inputFilesPath in enumerate(inputFilesPath):
         plt.gca().set_color_cycle(colormap_values_dup)
         
     realRelativeAverageIntegratedIntensity = csvData['realRelativeAverageIntegratedIntensity']
-    initialB = csvData['realInitialBFactor'][-1]
-    
-    
-    realRelativeAverageIntegratedIntensityFitting = fitting.Fitting(realAccumulatedDose,realRelativeAverageIntegratedIntensity)    
-    realRelativeAverageIntegratedIntensityFitting.setContinuousX()
-    realRelativeAverageIntegratedIntensityFitting.calculateTheoreticalIntensityDecay(beta = beta,
-                                                                         gamma = alpha,
-                                                                         initialWilsonB= initialB)
     resolution = csvData['strategyResolution'][-1]
-    #resolution +=0.25
-    
-    def residual(p) :
-        global realRelativeAverageIntegratedIntensityFitting
-        realRelativeAverageIntegratedIntensityFitting.doTheoreticalIntensityDecayCurve(resolution=p)
-        realRelativeAverageIntegratedIntensityFitting.determineError()
-        return realRelativeAverageIntegratedIntensityFitting.error
     
-    import scipy.optimize as opt
-    p0 = resolution
-    plsq = opt.fmin(residual, p0, maxiter=10000, maxfun=10000,disp=True)
+    fittedResolution = fittings['resolution'][i]
     
-    #print 'Real resolution: %.2f Fitted REsolytion: %.2f'%(resolution,plsq) 
-    realRelativeAverageIntegratedIntensityFitting.doTheoreticalIntensityDecayCurve(resolution=plsq[0])
-    realDsOneHalf = realRelativeAverageIntegratedIntensityFitting.getTheoreticalDOneHalf()
+    #print 'Real resolution: %.2f Fitted REsolytion: %.2f'%(resolution,fittedResolution) 
+    realDsOneHalf = fittings['dOneHalf'][i]
     #print '********************** realD1/2',realDsOneHalf
  
     
@@ -221,9 +202,9 @@ for i,inputFilesPath in enumerate(inputFilesPath):
              '; ${\\boldsymbol\\alpha}:%.1e$'%alpha + \
              '; ${\\boldsymbol\\beta}:%.1e$'%beta + \
              '; Real:$%.2f{\\mathbf\\AA}$'%resolution + \
-             '; Fit:$%.2f{\\mathbf\\AA}$'%plsq[0]).replace('e+0','e').replace('e-0','e\\text{-}').replace('e-','e\\text{-}') )
+             '; Fit:$%.2f{\\mathbf\\AA}$'%fittedResolution).replace('e+0','e').replace('e-0','e\\text{-}').replace('e-','e\\text{-}') )
     
-    ax3.plot(realRelativeAverageIntegratedIntensityFitting.continuous_x,realRelativeAverageIntegratedIntensityFitting.continuous_y)
+    ax3.plot(fittings['continuousDose'][i],fittings['continuousRelativeIntensity'][i])
     
     ax3.set_ylabel('Relative $<I>$')
     ax3.set_xlabel('Dose (Gy)')
@@ -57,6 +57,7 @@ import time
 import getpass
 import pprint as pp
 import datetime
+import numpy as np
 
 
 # local imports
@@ -246,8 +247,12 @@ def main(argv=None):
         xds.prepareIniFile()    
         
         # Prepare best -DamPar (only calculates b-factor)
-        bestHandler = best.Best(wedge.wedgeFolderPath)
-        bestBatchFile = bestHandler.prepareBatchFile(ednaStrategy.getDetectorType(), ednaStrategy.getExposureTime())
+        if ini.Ini().getPar("GENERAL","scaling_program","best") == "wilson" :
+            # scale and b-factor calculated from the reflections in the analysis
+            bestBatchFile = "/bin/true"
+        else :
+            bestHandler = best.Best(wedge.wedgeFolderPath)
+            bestBatchFile = bestHandler.prepareBatchFile(ednaStrategy.getDetectorType(), ednaStrategy.getExposureTime())
         
         if "condor" in ini.Ini().getPar("GENERAL","run_through") : 
             # Prepare Condor files
@@ -328,6 +333,12 @@ def main(argv=None):
         else :
             myLog.logger.info("Using resolution from input: %.2f A" % resolution)
         burntWedge.parseWedges(wedgeRange, resolution)
+        # reflections measured in all the wedges (if xds_common_reflections)
+        burntWedge.buildCommonReflections(resolution)
+        # intensity per frame (if xds_per_frame_decay)
+        burntWedge.buildFrameList(resolution)
+        # per image statistics of INTEGRATE.LP, anomalous images flagged
+        burntWedge.buildImageList()
         
         
         # Raddose bit
@@ -417,6 +428,29 @@ def main(argv=None):
             dataToPlot.addListOfValuesWithKey('realRelativeOverallBFactor', realRelativeOverallBFactor)
         
         
+        #
+        # Beta from the decay of each reflection common to all the wedges
+        #
+        
+        if burntWedge.commonReflections is not None and len(burntWedge.commonReflections['keys']) > 0 :
+            doseOfWedge = dict(zip(dataToPlot.getListOfValuesFromKey('subWedgeNumber'),accumulatedDose))
+            commonDoses = [doseOfWedge.get(i) for i in burntWedge.commonReflections['subWedgeNumbers']]
+            if None not in commonDoses :
+                slopes,intercepts,slopeErrors = fitting.reflectionDecayFittingBatch(commonDoses,
+                                                                                  burntWedge.commonReflections['intensities'],
+                                                                                  burntWedge.commonReflections['sigmas'])
+                numberOfBins = int(ini.Ini().getPar("XDS","xds_decay_profile_number_of_bins",10))
+                binS2,binSlopes,binSlopeErrors,reflectionBeta = fitting.reflectionDecayProfile(slopes,slopeErrors,
+                                                                                               burntWedge.commonReflections['resolution'],
+                                                                                               numberOfBins)
+                myLog.logger.info("Beta from the decay of %d common reflections: %.2e"%(len(slopes),reflectionBeta))
+                dataToPlot.addListOfValuesWithKey('reflectionBeta',[reflectionBeta] * len(accumulatedDose))
+                
+                decayProfile = data.Data()
+                decayProfile.addListOfDcits([{'s2' : s2, 'resolution' : 1/np.sqrt(s2), 'decaySlope' : slope, 'decaySlopeError' : error}
+                                             for s2,slope,error in zip(binS2,binSlopes,binSlopeErrors)])
+                decayProfile.dumpToCsvFileAllKeysSorted(os.path.join(wedge.processFolderPath,wedge.wedgeName+'_decayProfile.csv'))
+        
         #
         # Alpha (from relative Scale)
         #
@@ -487,9 +521,25 @@ def main(argv=None):
         relativeAverageIntegratedIntensity = burntWedge.createRelativeAverageIntegratedIntensityField(1,invRelativeScale[0],averageIntegratedIntensity)
         dataToPlot.addListOfValuesWithKey('relativeAverageIntegratedIntensity',relativeAverageIntegratedIntensity)
 
+        # Decay curves for every resolution shell
+        for shellResolution in burntWedge.resolutionShells :
+            shellAverageIntegratedIntensity = dataToPlot.getListOfValuesFromKey(burntWedge.buildAverageIntegratedIntensityFieldName(shellResolution))
+            if len(shellAverageIntegratedIntensity) == len(averageIntegratedIntensity) :
+                dataToPlot.addListOfValuesWithKey(burntWedge.buildAverageIntegratedIntensityFieldName(shellResolution,'relativeAverageIntegratedIntensity'),
+                                                  burntWedge.createRelativeAverageIntegratedIntensityField(1,invRelativeScale[0],shellAverageIntegratedIntensity))
+
+        # Decay of the reflections common to all the wedges (if xds_common_reflections)
+        if burntWedge.commonReflections is not None and len(burntWedge.commonReflections['keys']) > 0 :
+            averageCommonIntegratedIntensity = dataToPlot.getListOfValuesFromKey('averageCommonIntegratedIntensity')
+            if len(averageCommonIntegratedIntensity) == len(averageIntegratedIntensity) :
+                dataToPlot.addListOfValuesWithKey('relativeAverageCommonIntegratedIntensity',
+                                                  burntWedge.createRelativeAverageIntegratedIntensityField(1,invRelativeScale[0],averageCommonIntegratedIntensity))
+
         relativeAverageIntegratedIntensityFitting = fitting.Fitting(accumulatedDose,relativeAverageIntegratedIntensity)
         
         relativeAverageIntegratedIntensityFitting.setContinuousX()
+        # initial B factor given as input: not resampled by the bootstrap
+        inputBFactor0 = bfactor0
         if bfactor0 is None:
             bfactor0 = overallBFactorFitting.coefficients[1]
         
@@ -520,6 +570,87 @@ def main(argv=None):
             dataToPlot.addListOfValuesWithKey('realD1/2',realDsOneHalf)
         
         
+        # INTEGRATE.LP statistics image by image
+        anomalousImages = set()
+        if len(burntWedge.imageList) > 0 :
+            images = data.Data()
+            images.addListOfDcits([image for image in burntWedge.imageList if image['subWedgeNumber'] in wedgeRange])
+            for subWedgeNumber in sorted(set(images.getListOfValuesFromKey('subWedgeNumber'))) :
+                wedgeImages = [image for image in images.listOfDicts if image['subWedgeNumber'] == subWedgeNumber]
+                imageDoses = ednaStrategy.getFrameAccumulatedDoses(subWedgeNumber,[image['imageFraction'] for image in wedgeImages])
+                if imageDoses is None :
+                    imageDoses = [np.nan] * len(wedgeImages)
+                for image,imageDose in zip(wedgeImages,imageDoses) :
+                    image['accumulatedDose'] = imageDose
+            images.dumpToCsvFileAllKeysSorted(os.path.join(wedge.processFolderPath,wedge.wedgeName+'_images.csv'))
+            anomalousImages = set([(image['subWedgeNumber'],image['image']) for image in images.listOfDicts if image['anomalous']])
+
+        # Decay frame by frame: one dose point per image. The theoretical decay
+        # (beta, alpha and initial B factor of the wedges) is fitted to the frames,
+        # leaving out the anomalous images of INTEGRATE.LP
+        if len(burntWedge.frameList) > 0 :
+            IForDEqualsTo0 = averageIntegratedIntensity[0] / invRelativeScale[0]
+            frames = data.Data()
+            wedgeFramesList = [frame for frame in burntWedge.frameList if frame['subWedgeNumber'] in wedgeRange]
+            for subWedgeNumber in sorted(set([frame['subWedgeNumber'] for frame in wedgeFramesList])) :
+                wedgeFrames = [frame for frame in wedgeFramesList if frame['subWedgeNumber'] == subWedgeNumber]
+                frameDoses = ednaStrategy.getFrameAccumulatedDoses(subWedgeNumber,[frame['frameFraction'] for frame in wedgeFrames])
+                if frameDoses is None :
+                    myLog.logger.warning("No dose for the frames of subwedge %d: frames not used"%subWedgeNumber)
+                    continue
+                for frame,frameDose in zip(wedgeFrames,frameDoses) :
+                    frame['accumulatedDose'] = frameDose
+                    frame['relativeAverageIntegratedIntensity'] = frame['averageIntegratedIntensity'] / IForDEqualsTo0
+                    frame['anomalous'] = int((subWedgeNumber,frame['frameNumber']) in anomalousImages)
+                frames.addListOfDcits(wedgeFrames)
+            
+            fittedFrames = [frame for frame in frames.listOfDicts if not frame['anomalous']]
+            frameResolution = frameDOneHalf = np.nan
+            if len(fittedFrames) >= 2 :
+                frameFitting = fitting.Fitting([frame['accumulatedDose'] for frame in fittedFrames],
+                                               [frame['relativeAverageIntegratedIntensity'] for frame in fittedFrames])
+                frameFitting.setContinuousX()
+                frameFitting.calculateTheoreticalIntensityDecay(beta = overallBFactorFitting.coefficients[0],
+                                                                gamma = invRelativeScaleFitting.coefficients[0],
+                                                                initialWilsonB= relativeAverageIntegratedIntensityFitting.initialWilsonB)
+                frameResolution = frameFitting.fitTheoreticalResolution(resolution)
+                if np.isfinite(frameResolution) :
+                    frameDOneHalf = frameFitting.getTheoreticalDOneHalf()
+            myLog.logger.info("D1/2 from %d frames (%d anomalous left out): %.2e Gy, fitted resolution %.2f A"
+                              %(len(fittedFrames),len(frames.listOfDicts)-len(fittedFrames),frameDOneHalf,frameResolution))
+            dataToPlot.addListOfValuesWithKey('frameD1/2',[frameDOneHalf] * len(accumulatedDose))
+            dataToPlot.addListOfValuesWithKey('frameResolution',[frameResolution] * len(accumulatedDose))
+            frames.dumpToCsvFileAllKeysSorted(os.path.join(wedge.processFolderPath,wedge.wedgeName+'_frames.csv'))
+        
+        #
+        # Bootstrap confidence intervals of beta, alpha and D1/2
+        #
+        
+        numberOfReplicates = int(ini.Ini().getPar("GENERAL","bootstrap_number_of_replicates",0))
+        confidenceLevel = float(ini.Ini().getPar("GENERAL","bootstrap_confidence_level",0.95))
+        confidenceIntervals = {}
+        if numberOfReplicates > 0 and len(accumulatedDose) >= 3 :
+            bootstrapSeries = [('',accumulatedDose)]
+            if rad is not None and rad.results is not None :
+                bootstrapSeries.append(('real',realAccumulatedDose))
+            for prefix,doses in bootstrapSeries :
+                replicates = fitting.bootstrapDecayParameters(doses,overallBFactor,relativeScale,resolution,
+                                                              numberOfReplicates,initialWilsonB=inputBFactor0)
+                for name,key in [('beta','beta'),('alpha','alpha'),('dOneHalf','D1/2')] :
+                    if prefix :
+                        key = prefix + key[0].upper() + key[1:]
+                    low,high = fitting.confidenceInterval(replicates[name],confidenceLevel)
+                    confidenceIntervals[key] = (low,high)
+                    dataToPlot.addListOfValuesWithKey(key+'Low',[low] * len(doses))
+                    dataToPlot.addListOfValuesWithKey(key+'High',[high] * len(doses))
+                    myLog.logger.info("Bootstrap %s %d%% confidence interval (%d replicates): [%.2e, %.2e]"%
+                                      (key,round(confidenceLevel*100),numberOfReplicates,low,high))
+        
+        def formatConfidenceInterval(key):
+            if key in confidenceIntervals :
+                return ' [%.2e, %.2e]'%confidenceIntervals[key]
+            return ''
+        
         #
         # Save as CSV file
         csvFilePath = os.path.join(wedge.processFolderPath,wedge.wedgeName+'.csv')
@@ -545,10 +676,10 @@ def main(argv=None):
         
         plot1.setAxisTitles('Dose (Gy)','B-Factor ($\\AA^2$)','Relative Scale')
               
-        bottomText= '$\\alpha = %.2e$ : $\\beta = %.2e$ : $D_{1/2} = %.2e$ ' \
-            %(invRelativeScaleFitting.coefficients[0],
-              overallBFactorFitting.coefficients[0],
-              dsOneHalf[-1])
+        bottomText= '$\\alpha = %.2e$%s : $\\beta = %.2e$%s : $D_{1/2} = %.2e$%s ' \
+            %(invRelativeScaleFitting.coefficients[0],formatConfidenceInterval('alpha'),
+              overallBFactorFitting.coefficients[0],formatConfidenceInterval('beta'),
+              dsOneHalf[-1],formatConfidenceInterval('D1/2'))
         plot1.setBottomText(bottomText)
         plot1.addLegend()
         plot1.savePlot(os.path.join(wedge.processFolderPath,wedge.wedgeName))
@@ -570,9 +701,10 @@ def main(argv=None):
             
             plot2.setAxisTitles('Dose (Gy)','B-Factor ($\\AA^2$)','Relative Scale')
             
-            bottomText= '$\\alpha = %.2e$ : $\\beta = %.2e$ : $D_{1/2} = %.2e$ ' \
-                %(realInvRelativeScaleFitting.coefficients[0],
-                  realOverallBFactorFitting.coefficients[0],realDsOneHalf[-1])
+            bottomText= '$\\alpha = %.2e$%s : $\\beta = %.2e$%s : $D_{1/2} = %.2e$%s ' \
+                %(realInvRelativeScaleFitting.coefficients[0],formatConfidenceInterval('realAlpha'),
+                  realOverallBFactorFitting.coefficients[0],formatConfidenceInterval('realBeta'),
+                  realDsOneHalf[-1],formatConfidenceInterval('realD1/2'))
             plot2.setBottomText(bottomText)
             plot2.addLegend()
             plot2.savePlot(os.path.join(wedge.processFolderPath,wedge.wedgeName+"_real"))
@@ -10,6 +10,96 @@ from string import Template
 import ini
 import localLogger
 
+try :
+    import xml.etree.cElementTree as ElementTree
+except ImportError :
+    import xml.etree.ElementTree as ElementTree
+
+
+# Record fields and the (normalised) names BEST may give them in the -dna xml
+BEST_XML_ITEM_NAMES = {'relativeScale' : ['relativescale', 'scale', 'scalefactor'],
+                       'overallBFactor' : ['overallbfactor', 'bfactor', 'wilsonbfactor', 'relativebfactor'],
+                       'mosaicity' : ['mosaicity'],
+                       'cell_length_a' : ['a', 'cella'],
+                       'cell_length_b' : ['b', 'cellb'],
+                       'cell_length_c' : ['c', 'cellc'],
+                       'cell_angle_alpha' : ['alpha', 'cellalpha'],
+                       'cell_angle_beta' : ['beta', 'cellbeta'],
+                       'cell_angle_gamma' : ['gamma', 'cellgamma']}
+BEST_XML_CELL_FIELDS = ['cell_length_a','cell_length_b','cell_length_c','cell_angle_alpha','cell_angle_beta','cell_angle_gamma']
+
+nonAlphanumericPattern = re.compile(r"[^a-z0-9]")
+
+def normaliseBestXmlName(name):
+    """
+    'Overall B-factor' and 'overall_b_factor' are both 'overallbfactor'
+    """
+    return nonAlphanumericPattern.sub('',name.lower())
+
+def parseBestXml(bestXmlFilePath):
+    """
+    Parses the -dna xml of BEST -Bonly:
+    
+    <dna_tables>
+      <table name="...">
+        <list name="...">
+          <item name="...">value</item>
+    
+    The file is streamed (iterparse). Item names are matched after
+    normalisation (BEST_XML_ITEM_NAMES); the cell items are only taken
+    inside a list or table whose name contains 'cell', and the B-factor
+    eigenvalues from items with 'eigen' in the name.
+    
+    @return: dictionary with the fields of BurntWedgesHandler's BEST record
+    (relativeScale, overallBFactor, cell..., mosaicity, bFactorEigenvalue1..3)
+    """
+    
+    namesToFields = {}
+    for field,names in BEST_XML_ITEM_NAMES.items() :
+        for name in names :
+            namesToFields[name] = field
+    
+    record = {}
+    eigenvalues = []
+    parents = []
+    for event, element in ElementTree.iterparse(bestXmlFilePath,events=('start','end')) :
+        if element.tag in ('table','list') :
+            if event == 'start' :
+                parents.append(normaliseBestXmlName(element.get('name','')))
+            else :
+                parents.pop()
+                element.clear()
+            continue
+        if event != 'end' or element.tag != 'item' :
+            continue
+        
+        name = normaliseBestXmlName(element.get('name',''))
+        text = (element.text or '').strip()
+        element.clear()
+        try :
+            values = [float(i) for i in text.split()]
+        except ValueError :
+            continue
+        if len(values) == 0 :
+            continue
+        
+        insideCell = len([p for p in parents if p.find('cell') >= 0]) > 0
+        if name.find('eigen') >= 0 :
+            eigenvalues.extend(values)
+        elif name == 'cell' and len(values) >= 6 :
+            record.update(zip(BEST_XML_CELL_FIELDS,values[:6]))
+        elif name in namesToFields :
+            field = namesToFields[name]
+            if field in BEST_XML_CELL_FIELDS and not insideCell :
+                continue
+            # the first match wins: e.g. 'overall_b_factor' before a later 'b_factor'
+            if field not in record :
+                record[field] = values[0]
+    
+    for idx,value in enumerate(eigenvalues[:3]) :
+        record['bFactorEigenvalue%d'%(idx+1)] = value
+    return record
+
 
 
 class Best :
@@ -11,9 +11,32 @@ import os.path
 import re
 import wedgeHandler
 import ini
+import reflections
+import best
+import xdsLogs
+import fitting
 import pprint as pp
 import numpy as np
 import pickle
+import multiprocessing
+
+# config options read by BurntWedgesHandler.parseWedge: part of the key of the cached wedge records
+WEDGE_RECORD_OPTIONS = [("GENERAL","scaling_program"),
+                        ("GENERAL","wilson_low_resolution_limit"),
+                        ("GENERAL","wilson_number_of_bins"),
+                        ("BEST","best_xml_file"),
+                        ("BEST","best_log_file"),
+                        ("BEST","best_record_out_file"),
+                        ("XDS","xds_intensities_file"),
+                        ("XDS","xds_log_file"),
+                        ("XDS","xds_log_shells_out_file"),
+                        ("XDS","xds_reflections_out_file"),
+                        ("XDS","xds_reflection_optional_items"),
+                        ("XDS","xds_resolution_shells"),
+                        ("XDS","xds_streaming_chunk_size"),
+                        ("XDS","xds_per_frame_decay")]
+# version of the fields of the wedge records, part of the key of the cached wedge records
+WEDGE_RECORD_VERSION = 2
 
 class BurntWedgesHandler():
     '''
@@ -90,64 +113,468 @@ class BurntWedgesHandler():
         self.log.logger.debug("BurntWedgesHandler...")
 
         self.wedgeList = []
+        self.resolutionShells = []
+        self.commonReflections = None
+        self.frameList = []
+        self.imageList = []
 
     def parseWedges(self,wedgeNumbersListToProcess,resolution):
         """
         Parses the XDS and Best log files and builds a dictionary
         with statists of corresponding wedge : self.wedgeList
 
+        Wedges are independent: with number_of_parsing_workers > 1 in the
+        GENERAL section of the config file they are parsed in parallel
+        processes. Records are kept in the wedge order.
+
         """
 
-        recordList = []
+        self.resolutionShells = self.__getResolutionShells()
+
+        # Records of the wedges whose files didn't change since the last analysis
+        recordsCache = self.__loadWedgeRecordsCache()
+        keys = dict([(i,self.__getWedgeRecordKey(i,resolution)) for i in wedgeNumbersListToProcess])
+        wedgeNumbersListToParse = [i for i in wedgeNumbersListToProcess
+                                   if i not in recordsCache or recordsCache[i]['key'] != keys[i]]
+        self.log.logger.debug("Wedges to parse: %s (%d records cached)"
+                              %(wedgeNumbersListToParse,len(wedgeNumbersListToProcess)-len(wedgeNumbersListToParse)))
+
+        numberOfWorkers = int(ini.Ini().getPar("GENERAL","number_of_parsing_workers",1))
+        if numberOfWorkers > 1 and len(wedgeNumbersListToParse) > 1 :
+            records = self.__parseWedgesInParallel(wedgeNumbersListToParse,resolution,numberOfWorkers)
+        else :
+            records = [self.parseWedge(i,resolution) for i in wedgeNumbersListToParse]
+
+        if len(wedgeNumbersListToParse) > 0 :
+            for i,record in zip(wedgeNumbersListToParse,records) :
+                recordsCache[i] = {'key' : keys[i], 'record' : record}
+            self.__saveWedgeRecordsCache(recordsCache)
 
+        recordList = []
         for i in wedgeNumbersListToProcess :
+            record = recordsCache[i]['record']
+            if record is not None :
+                # a copy: the record is updated by the Data merges
+                recordList.append(dict(record))
 
-            record = {}
+        self.wedgeList = recordList
+        #self.__createRelativeIntensityField('relativeScale')
+        #self.__createRelativeOverallBFactorField('overallBFactor')
+#        for resolution in resolutionRange :
+#            self.__createRelativeAverageIntegratedIntensityField(self.buildAverageIntegratedIntensityFieldName(resolution))
 
-            record['subWedgeNumber'] = i
-            record['resolution'] =  resolution
 
-            wedgeFolderPath = self.wedge.getWedgeFolderPath(i)
-            
+
+        #self.log.logger.debug(pprint.pformat(self.wedgeList))
+
+
+    def parseWedge(self,subWedgeNumber,resolution):
+        """
+        Parses the XDS and Best log files of a single wedge
+
+        @return: dictionary with the statistics of the wedge or None if
+        BEST or XDS have failed for this wedge
+
+        """
+
+        i = subWedgeNumber
+
+        record = {}
+
+        record['subWedgeNumber'] = i
+        record['resolution'] =  resolution
+
+        wedgeFolderPath = self.wedge.getWedgeFolderPath(i)
+        xdsIntensitiesFilePath = os.path.join(wedgeFolderPath,ini.Ini().getPar("XDS","xds_intensities_file"))
+        
+        if ini.Ini().getPar("GENERAL","scaling_program","best") == "wilson" :
+            # relative scale and B-factor from the reflections (BEST not run)
+            scalingRecord = self.__calculateWilsonScaling(xdsIntensitiesFilePath)
+        else :
             # BEST
-            bestLogFilePath = os.path.join(wedgeFolderPath,ini.Ini().getPar("BEST","best_log_file"))
-            bestRecord = self.__parseBestLogFile(bestLogFilePath)
-            record.update(bestRecord)
-            #pp.pprint(record)
+            scalingRecord = self.__getBestRecord(wedgeFolderPath)
+        if len(scalingRecord) == 0 :
+            # No cell: the reflections resolution can't be calculated
+            return None
+        record.update(scalingRecord)
+        #pp.pprint(record)
+
+        self.reciprocalMat = reflections.crystGen(self.currentCell)
+
+#        # get crystal type
+#        self.crystalSystemName = self.__getCrystalSystemName(self.currentCell)
+#        record['crystalSystemName'] = self.crystalSystemName
+#        self.log.logger.debug("Crystal System Name: " + self.crystalSystemName)
+
+        # XDS
+
+        xdsLogFilePath = os.path.join(wedgeFolderPath,ini.Ini().getPar("XDS","xds_log_file"))
+        xdsRecord = self.__parseXdsCorrectLogFile(xdsLogFilePath)
+        record.update(xdsRecord)
+
+        chunkSize = int(ini.Ini().getPar("XDS","xds_streaming_chunk_size",0))
+        if chunkSize > 0 :
+            # Bounded memory: hkl file read by chunks and reduced on the fly
+            xdsRecord = self.__calculateXDSIntegratedIntensityStreaming(xdsIntensitiesFilePath,resolution,chunkSize)
+        else :
+            # Parse hkl file and calculate resolution per reflection
+            reflectionArray = self.__parseXdsXhlFile(xdsIntensitiesFilePath)
+            xdsRecord = self.__calculateXDSIntegratedIntensity(reflectionArray,resolution)
+        record.update(xdsRecord)
+        
+        if len(xdsRecord) > 0 :
+            return record
+        else :
+            return None
 
-            self.reciprocalMat = self.__crystGen(self.currentCell)
+    def buildCommonReflections(self,resolution):
+        """
+        Matches the symmetry unique reflections of the parsed wedges (self.wedgeList)
+        and keeps the ones measured in all the wedges: self.commonReflections
 
-#            # get crystal type
-#            self.crystalSystemName = self.__getCrystalSystemName(self.currentCell)
-#            record['crystalSystemName'] = self.crystalSystemName
-#            self.log.logger.debug("Crystal System Name: " + self.crystalSystemName)
+        Decay calculated on those reflections doesn't depend on the completeness
+        of each wedge. Adds to each record of self.wedgeList:
+        averageCommonIntegratedIntensity and numberOfCommonReflections
 
-            # XDS
+        Only if xds_common_reflections is set in the XDS section: the reflections
+        of every wedge are read again (by chunks if xds_streaming_chunk_size > 0).
 
-            xdsLogFilePath = os.path.join(wedgeFolderPath,ini.Ini().getPar("XDS","xds_log_file"))
-            xdsRecord = self.__parseXdsCorrectLogFile(xdsLogFilePath)
-            record.update(xdsRecord)
+        @param resolution: only reflections with d >= resolution are kept
+        """
 
+        self.commonReflections = None
+        if int(ini.Ini().getPar("XDS","xds_common_reflections",0)) <= 0 :
+            return
+
+        chunkSize = int(ini.Ini().getPar("XDS","xds_streaming_chunk_size",0))
+        keysList, iList, sigmaList, dList = [], [], [], []
+        operators = None
+        for record in self.wedgeList :
+            wedgeFolderPath = self.wedge.getWedgeFolderPath(record['subWedgeNumber'])
             xdsIntensitiesFilePath = os.path.join(wedgeFolderPath,ini.Ini().getPar("XDS","xds_intensities_file"))
-            # Parse hkl file and calculate resolution per reflection
-            reflectionList = self.__parseXdsXhlFile(xdsIntensitiesFilePath)
 
-            xdsRecord = self.__calculateXDSIntegratedIntensity(reflectionList,resolution)
-            record.update(xdsRecord)
-            
-            if len(bestRecord) > 0 and len(xdsRecord) > 0 and reflectionList is not None and  len(reflectionList) > 0:
-                recordList.append(record)
+            self.currentCell = [record['cell_length_a'],record['cell_length_b'],record['cell_length_c'],
+                                record['cell_angle_alpha'],record['cell_angle_beta'],record['cell_angle_gamma']]
+            self.reciprocalMat = reflections.crystGen(self.currentCell)
+
+            if operators is None and os.path.exists(xdsIntensitiesFilePath) :
+                keywords, items = reflections.readXdsAsciiHklHeader(xdsIntensitiesFilePath)
+                spaceGroupNumber = int(keywords.get('SPACE_GROUP_NUMBER',1))
+                operators = reflections.getLaueGroupOperators(spaceGroupNumber)
+                self.log.logger.debug("Space group %d: %d Laue group operators"%(spaceGroupNumber,len(operators)))
+
+            if chunkSize > 0 :
+                merged = self.__mergeXdsXhlFileStreaming(xdsIntensitiesFilePath,operators,resolution,chunkSize)
+            else :
+                merged = self.__mergeXdsXhlFile(xdsIntensitiesFilePath,operators,resolution)
+            if merged is None :
+                self.log.logger.warning("No reflections for wedge %d: common reflections not calculated"%record['subWedgeNumber'])
+                return
+
+            keys, i, sigma, d = merged
+            keysList.append(keys)
+            iList.append(i)
+            sigmaList.append(sigma)
+            dList.append(d)
+
+        if len(keysList) == 0 :
+            return
+
+        keys, d, intensities, sigmas = reflections.buildCommonReflectionTable(keysList,iList,sigmaList,dList)
+        self.log.logger.debug("%d reflections common to the %d wedges"%(len(keys),len(keysList)))
+
+        self.commonReflections = {'subWedgeNumbers' : [record['subWedgeNumber'] for record in self.wedgeList],
+                                  'keys' : keys,
+                                  'resolution' : d,
+                                  'intensities' : intensities,
+                                  'sigmas' : sigmas}
+
+        for column,record in enumerate(self.wedgeList) :
+            record['numberOfCommonReflections'] = len(keys)
+            if len(keys) > 0 :
+                record['averageCommonIntegratedIntensity'] = intensities[:,column].mean()
+
+    def __mergeXdsXhlFile(self,xdsIntensitiesFilePath,operators,resolution):
+        """
+        Symmetry unique reflections of a wedge with d >= resolution
+        (reflections.mergeEquivalentReflections), from the whole reflection array
 
-        self.wedgeList = recordList
-        #self.__createRelativeIntensityField('relativeScale')
-        #self.__createRelativeOverallBFactorField('overallBFactor')
-#        for resolution in resolutionRange :
-#            self.__createRelativeAverageIntegratedIntensityField(self.buildAverageIntegratedIntensityFieldName(resolution))
+        @return: (keys, i, sigma, d) or None if the HKL file can't be read
+        """
+        reflectionArray = self.__parseXdsXhlFile(xdsIntensitiesFilePath)
+        if reflectionArray is None :
+            return None
+        reflectionArray = reflectionArray[reflectionArray['RESOLUTION'] >= resolution]
+        keys = reflections.getUniqueReflectionKeys(reflections.getHkl(reflectionArray),operators)
+        return reflections.mergeEquivalentReflections(keys,reflectionArray['IOBS'],
+                                                      reflectionArray['SIGMA(IOBS)'],
+                                                      reflectionArray['RESOLUTION'])
+
+    def __mergeXdsXhlFileStreaming(self,xdsIntensitiesFilePath,operators,resolution,chunkSize):
+        """
+        Same as __mergeXdsXhlFile but reads the XDS_ASCII.HKL by chunks of chunkSize
+        bytes: each chunk is merged into the unique reflections of the previous ones,
+        so memory depends on the number of unique reflections only.
+        (1/sigma^2 weighted means of weighted means are the overall weighted means.)
+        """
+        if os.path.exists(xdsIntensitiesFilePath) is False:
+            self.log.logger.warning('XDS HKL file does not exist: %s'%xdsIntensitiesFilePath)
+            return None
+
+        merged = None
+        try :
+            for keywords, chunk in reflections.iterXdsAsciiHkl(xdsIntensitiesFilePath,chunkSize):
+                d, _ = reflections.getResolution(reflections.getHkl(chunk),self.reciprocalMat)
+                selected = d >= resolution
+                keys = reflections.getUniqueReflectionKeys(reflections.getHkl(chunk[selected]),operators)
+                i, sigma, d = chunk['IOBS'][selected], chunk['SIGMA(IOBS)'][selected], d[selected]
+                if merged is not None :
+                    keys = np.concatenate((merged[0],keys))
+                    i = np.concatenate((merged[1],i))
+                    sigma = np.concatenate((merged[2],sigma))
+                    d = np.concatenate((merged[3],d))
+                merged = reflections.mergeEquivalentReflections(keys,i,sigma,d)
+        except ValueError, e:
+            self.log.logger.warning('XDS HKL file is not complete: %s'%e)
+            return None
+        return merged
+
+    def buildFrameList(self,resolution):
+        """
+        Average intensity of every frame of the parsed wedges (self.wedgeList),
+        from the ZD of the reflections: self.frameList
+        Only if xds_per_frame_decay is set in the XDS section.
 
+        Each frame record has subWedgeNumber, frameNumber, frameFraction (position of
+        the middle of the frame in the wedge: 0 start, 1 end), averageIntegratedIntensity
+        and numberOfReflections.
 
+        @param resolution: only reflections with d >= resolution are used
+        """
+        self.frameList = []
+        if not self.__isFrameAnalysisOn() :
+            return
 
-        #self.log.logger.debug(pprint.pformat(self.wedgeList))
+        for record in self.wedgeList :
+            wedgeFolderPath = self.wedge.getWedgeFolderPath(record['subWedgeNumber'])
+            xdsIntensitiesFilePath = os.path.join(wedgeFolderPath,ini.Ini().getPar("XDS","xds_intensities_file"))
+
+            self.currentCell = [record['cell_length_a'],record['cell_length_b'],record['cell_length_c'],
+                                record['cell_angle_alpha'],record['cell_angle_beta'],record['cell_angle_gamma']]
+            self.reciprocalMat = reflections.crystGen(self.currentCell)
+            reflectionArray = self.__parseXdsXhlFile(xdsIntensitiesFilePath)
+            if reflectionArray is None :
+                continue
+
+            frames, counts, averageIntensities = reflections.frameStatistics(reflectionArray['ZD'],reflectionArray['IOBS'],
+                                                                             reflectionArray['SIGMA(IOBS)'],
+                                                                             reflectionArray['RESOLUTION'],resolution)
+            if len(frames) == 0 :
+                continue
+            numberOfFrames = float(frames[-1] - frames[0] + 1)
+            for frame,count,averageIntensity in zip(frames,counts,averageIntensities) :
+                self.frameList.append({'subWedgeNumber' : record['subWedgeNumber'],
+                                       'frameNumber' : int(frame),
+                                       'frameFraction' : (frame - frames[0] + 0.5) / numberOfFrames,
+                                       'averageIntegratedIntensity' : averageIntensity,
+                                       'numberOfReflections' : count})
+        self.log.logger.debug("%d frames in %d wedges"%(len(self.frameList),len(self.wedgeList)))
+
+    def buildImageList(self):
+        """
+        Per image statistics of INTEGRATE.LP (xdsLogs.parseIntegrateLpImageTable)
+        for the parsed wedges: self.imageList
+
+        Each image record has subWedgeNumber, the columns of the table, imageFraction
+        (position of the middle of the image in the wedge: 0 start, 1 end) and
+        anomalous (1 for images flagged by xdsLogs.flagAnomalousImages).
+        Adds numberOfImagesIntegrated and numberOfAnomalousImages to the records
+        of self.wedgeList.
+        """
+        self.imageList = []
+        threshold = float(ini.Ini().getPar("XDS","xds_anomalous_image_threshold",5.0))
+
+        for record in self.wedgeList :
+            wedgeFolderPath = self.wedge.getWedgeFolderPath(record['subWedgeNumber'])
+            xdsIntegrateLogFilePath = os.path.join(wedgeFolderPath,ini.Ini().getPar("XDS","xds_integrate_log_file","INTEGRATE.LP"))
+            if os.path.exists(xdsIntegrateLogFilePath) is False :
+                self.log.logger.warning('XDS Integrate file does not exist: %s'%xdsIntegrateLogFilePath)
+                continue
+
+            table = xdsLogs.readIntegrateLpImageTable(xdsIntegrateLogFilePath)
+            if len(table) == 0 :
+                self.log.logger.warning("Nothing was parsed from XDS INTEGRATE file: %s"%xdsIntegrateLogFilePath)
+                continue
+            anomalous = xdsLogs.flagAnomalousImages(table,threshold)
+
+            images = table['image']
+            numberOfImages = float(images[-1] - images[0] + 1)
+            for idx in range(len(images)) :
+                image = dict([(name,table[name][idx]) for name in xdsLogs.INTEGRATE_LP_IMAGE_COLUMNS])
+                image['subWedgeNumber'] = record['subWedgeNumber']
+                image['imageFraction'] = (images[idx] - images[0] + 0.5) / numberOfImages
+                image['anomalous'] = int(anomalous[idx])
+                self.imageList.append(image)
+
+            record['numberOfImagesIntegrated'] = len(images)
+            record['numberOfAnomalousImages'] = int(anomalous.sum())
+            if anomalous.any() :
+                self.log.logger.warning("Wedge %d: anomalous images in INTEGRATE.LP: %s"
+                                        %(record['subWedgeNumber'],", ".join([str(i) for i in images[anomalous]])))
+
+    def __parseWedgesInParallel(self,wedgeNumbersListToProcess,resolution,numberOfWorkers):
+        """
+        Parses the wedges in a pool of processes.
+        
+        The workers get this handler through the fork (see _parseWedgeWorker),
+        only the wedge number and the resulting records go through the pipes.
+        
+        @return: list of records (or None) in the same order as wedgeNumbersListToProcess
+        """
+        global _parsingHandler
+
+        numberOfWorkers = min(numberOfWorkers,len(wedgeNumbersListToProcess))
+        self.log.logger.debug("Parsing %d wedges with %d processes"%(len(wedgeNumbersListToProcess),numberOfWorkers))
+
+        _parsingHandler = self
+        try :
+            pool = multiprocessing.Pool(numberOfWorkers)
+            try :
+                records = pool.map(_parseWedgeWorker,[(i,resolution) for i in wedgeNumbersListToProcess])
+            finally :
+                pool.close()
+                pool.join()
+        except OSError, e:
+            self.log.logger.warning("Could not parse wedges in parallel (%s): parsing them one by one..."%e)
+            records = [self.parseWedge(i,resolution) for i in wedgeNumbersListToProcess]
+        _parsingHandler = None
+
+        return records
+
+    def __getWedgeRecordKey(self,subWedgeNumber,resolution):
+        """
+        Key of the record of a wedge: modification time and size of the files
+        parsed for this wedge (None if the file does not exist), the resolution,
+        the versions of the record and of the CORRECT.LP table and the config
+        values used to build the record (WEDGE_RECORD_OPTIONS).
+        """
+        wedgeFolderPath = self.wedge.getWedgeFolderPath(subWedgeNumber)
+        key = [resolution, WEDGE_RECORD_VERSION, xdsLogs.CORRECT_LP_SHELL_TABLE_VERSION]
+        for section,option in WEDGE_RECORD_OPTIONS :
+            key.append(ini.Ini().getPar(section,option))
+        for section,option in [("BEST","best_xml_file"),("BEST","best_log_file"),("XDS","xds_log_file"),("XDS","xds_intensities_file")] :
+            filePath = os.path.join(wedgeFolderPath,ini.Ini().getPar(section,option))
+            try :
+                stat = os.stat(filePath)
+                key.append((stat.st_mtime,stat.st_size))
+            except OSError :
+                key.append(None)
+        return key
+
+    def __getWedgeRecordsCacheFilePath(self):
+        """
+        Index file with the records of all the wedges, in the process folder
+        
+        @return: file path or None if the cache is disabled
+        """
+        cacheFileName = ini.Ini().getPar("GENERAL","wedge_records_cache_file","")
+        if len(cacheFileName) == 0 :
+            return None
+        return os.path.join(self.wedge.processFolderPath,cacheFileName)
 
+    def __loadWedgeRecordsCache(self):
+        """
+        @return: dictionary subWedgeNumber -> {'key' : key, 'record' : record}
+        """
+        cacheFilePath = self.__getWedgeRecordsCacheFilePath()
+        if cacheFilePath is None or not os.path.exists(cacheFilePath) :
+            return {}
+        try :
+            inp = open(cacheFilePath,"rb")
+            recordsCache = pickle.load(inp)
+            inp.close()
+        except Exception, e :
+            self.log.logger.warning("Ignoring the wedge records cache %s: %s"%(cacheFilePath,e))
+            return {}
+        if not isinstance(recordsCache,dict) :
+            return {}
+        return recordsCache
+
+    def __saveWedgeRecordsCache(self,recordsCache):
+        cacheFilePath = self.__getWedgeRecordsCacheFilePath()
+        if cacheFilePath is None :
+            return
+        try :
+            temporaryFilePath = cacheFilePath + '.tmp'
+            outFile = open(temporaryFilePath,"wb")
+            pickle.dump(recordsCache,outFile,pickle.HIGHEST_PROTOCOL)
+            outFile.close()
+            os.rename(temporaryFilePath,cacheFilePath)
+            self.log.logger.debug("Wedge records cache saved to: %s"%cacheFilePath)
+        except (IOError, OSError), e:
+            self.log.logger.warning("Could not write the wedge records cache %s: %s"%(cacheFilePath,e))
+
+    def __getBestRecord(self,wedgeFolderPath):
+        """
+        BEST results of a wedge: from the -dna xml (best.parseBestXml) or,
+        if it doesn't exist or misses values, from best.log.
+        
+        The record is cached beside the wedge (best_record_out_file) and
+        only parsed again if the BEST output changed.
+        
+        @return: dictionary (see __parseBestLogFile), empty if BEST failed
+        """
+        bestXmlFilePath = os.path.join(wedgeFolderPath,ini.Ini().getPar("BEST","best_xml_file","best.xml"))
+        bestLogFilePath = os.path.join(wedgeFolderPath,ini.Ini().getPar("BEST","best_log_file"))
+        cacheFileName = ini.Ini().getPar("BEST","best_record_out_file","")
+        
+        cacheFilePath = None
+        if len(cacheFileName) > 0 :
+            cacheFilePath = os.path.join(wedgeFolderPath,cacheFileName)
+            cacheKey = [reflections.getFileKey(f) if os.path.exists(f) else None for f in [bestXmlFilePath,bestLogFilePath]]
+            try :
+                inp = open(cacheFilePath,"rb")
+                cache = pickle.load(inp)
+                inp.close()
+                if cache['key'] == cacheKey :
+                    record = cache['record']
+                    self.log.logger.debug("BEST record loaded from cache: %s"%cacheFilePath)
+                    if len([name for name in best.BEST_XML_CELL_FIELDS if name in record]) == 6 :
+                        self.currentCell = [record[name] for name in best.BEST_XML_CELL_FIELDS]
+                    return record
+            except Exception :
+                pass
+        
+        record = {}
+        if os.path.exists(bestXmlFilePath) :
+            self.log.logger.debug("Parsing: " + bestXmlFilePath)
+            try :
+                record = best.parseBestXml(bestXmlFilePath)
+            except SyntaxError, e:
+                # ElementTree.ParseError is a SyntaxError
+                self.log.logger.warning("Could not parse %s: %s"%(bestXmlFilePath,e))
+                record = {}
+            missing = [name for name in ['relativeScale','overallBFactor'] + best.BEST_XML_CELL_FIELDS if name not in record]
+            if len(missing) > 0 :
+                self.log.logger.warning("Missing in %s: %s. Using %s"%(bestXmlFilePath,", ".join(missing),bestLogFilePath))
+                record = {}
+            else :
+                self.currentCell = [record[name] for name in best.BEST_XML_CELL_FIELDS]
+                self.log.logger.debug("Overall B-factor = %.2f : Relative scale = %.2f" % (record["overallBFactor"],record["relativeScale"]))
+        if len(record) == 0 :
+            record = self.__parseBestLogFile(bestLogFilePath)
+        
+        if cacheFilePath is not None :
+            try :
+                temporaryFilePath = cacheFilePath + '.tmp'
+                outFile = open(temporaryFilePath,"wb")
+                pickle.dump({'key' : cacheKey, 'record' : record},outFile,pickle.HIGHEST_PROTOCOL)
+                outFile.close()
+                os.rename(temporaryFilePath,cacheFilePath)
+            except (IOError, OSError), e:
+                self.log.logger.warning("Could not write the BEST record cache %s: %s"%(cacheFilePath,e))
+        
+        return record
 
     def __parseBestLogFile(self, bestLogFilePath):
         """
@@ -191,6 +618,9 @@ class BurntWedgesHandler():
                 record["relativeScale"] = float(t[1].strip())
             elif t[0].find("Overall B-factor")>=0 :
                 record["overallBFactor"] = float(t[1].strip().split()[0])
+            elif t[0].find("B-factor eigenvalues")>=0 :
+                for idx,value in enumerate(t[1].strip().split()[:3]) :
+                    record['bFactorEigenvalue%d'%(idx+1)] = float(value)
             elif t[0].find("Cell")>=0 :
                 tokens = t[1].strip().split()
                 record['cell_length_a']= float(tokens[0])
@@ -213,6 +643,52 @@ class BurntWedgesHandler():
         return record
 
 
+    def __calculateWilsonScaling(self,xdsIntensitiesFilePath):
+        """
+        Alternative to BEST: relative scale and overall B-factor from the
+        Wilson plot of the reflections against the ideal protein Wilson
+        distribution (fitting.wilsonScaling). The cell is the one in the
+        header of the XDS_ASCII.HKL.
+        
+        @return: dictionary with relativeScale, overallBFactor and the cell
+        (same fields as __parseBestLogFile) or empty if it fails
+        """
+        record = {}
+        
+        if os.path.exists(xdsIntensitiesFilePath) is False:
+            self.log.logger.warning('XDS HKL file does not exist: %s'%xdsIntensitiesFilePath)
+            return record
+        
+        keywords, items = reflections.readXdsAsciiHklHeader(xdsIntensitiesFilePath)
+        try :
+            self.currentCell = [float(i) for i in keywords['UNIT_CELL_CONSTANTS'].split()[:6]]
+        except (KeyError, ValueError) :
+            self.log.logger.warning('No UNIT_CELL_CONSTANTS in the header of: %s'%xdsIntensitiesFilePath)
+            return record
+        self.reciprocalMat = reflections.crystGen(self.currentCell)
+        
+        # The reflections are parsed (or taken from the cache) once, also for the intensities
+        reflectionArray = self.__parseXdsXhlFile(xdsIntensitiesFilePath)
+        if reflectionArray is None :
+            return record
+        valid = reflectionArray['SIGMA(IOBS)'] > 0
+        scale, bFactor = fitting.wilsonScaling(reflectionArray['IOBS'][valid],reflectionArray['RESOLUTION'][valid],
+                                               float(ini.Ini().getPar("GENERAL","wilson_low_resolution_limit",4.5)),
+                                               int(ini.Ini().getPar("GENERAL","wilson_number_of_bins",20)))
+        if scale is None or not np.isfinite(scale) :
+            self.log.logger.warning("Wilson scaling failed for: %s"%xdsIntensitiesFilePath)
+            return record
+        
+        # BEST's relative scale is the factor applied to the data
+        record["relativeScale"] = 1. / scale
+        record["overallBFactor"] = bFactor
+        for name,value in zip(['cell_length_a','cell_length_b','cell_length_c','cell_angle_alpha','cell_angle_beta','cell_angle_gamma'],
+                              self.currentCell) :
+            record[name] = value
+        self.log.logger.debug("Wilson: Overall B-factor = %.2f : Relative scale = %.2e" % (record["overallBFactor"],record["relativeScale"]))
+        
+        return record
+
     def __parseXdsCorrectLogFile(self,xdsLogFilePath):
         """
           COMPLETENESS AND QUALITY OF DATA SET
@@ -274,20 +750,21 @@ class BurntWedgesHandler():
 
         record = {}
         if os.path.exists(xdsLogFilePath) :
-            infile = open(xdsLogFilePath,"r")
-            insideTableFlag = False
-            for line in infile:
-                if insideTableFlag is True:
-                    if line.strip().startswith('total'):
-                        tokens = line.strip().split()
-                        #print tokens
-                        record['numberOfReflectionsObserved'] = float(tokens[1])
-                        record['completenessOfData'] = float(tokens[4].replace('%',''))/100
-                        record['iOverSigma'] = float(tokens[8])
-                        record['rMeas'] = float(tokens[9].replace('%',''))/100
-                        break
-                if line.find('COMPLETENESS AND QUALITY OF DATA SET') >= 0 :
-                    insideTableFlag = True
+            shells, total = self.__getXdsCorrectLogShellTable(xdsLogFilePath)
+            if len(total) > 0 :
+                record['numberOfReflectionsObserved'] = total['numberOfReflectionsObserved']
+                record['completenessOfData'] = total['completenessOfData']
+                record['iOverSigma'] = total['iOverSigma']
+                record['rMeas'] = total['rMeas']
+                # quality per configured resolution shell: the same fields for
+                # every wedge, whatever the shell limits XDS picked for it
+                indices = xdsLogs.correctLpShellIndices(shells['resolutionLimit'],self.resolutionShells)
+                for shellResolution,idx in zip(self.resolutionShells,indices) :
+                    if idx < 0 :
+                        continue
+                    for name in ['completenessOfData','rFactorObserved','iOverSigma','rMeas','ccOneHalf'] :
+                        if name in shells :
+                            record[self.buildAverageIntegratedIntensityFieldName(shellResolution,name)] = shells[name][idx]
         else: 
             self.log.logger.warning('XDS Correct file does not exist: %s'%xdsLogFilePath)
             return record
@@ -300,13 +777,54 @@ class BurntWedgesHandler():
         return record
 
 
+    def __getXdsCorrectLogShellTable(self,xdsLogFilePath):
+        """
+        Statistics per resolution shell of CORRECT.LP (xdsLogs.parseCorrectLpShellTable)
+
+        The table is cached beside the wedge (xds_log_shells_out_file) and
+        only parsed again if CORRECT.LP changed.
+
+        @return: (shells, total)
+        """
+        cacheFileName = ini.Ini().getPar("XDS","xds_log_shells_out_file","")
+        if len(cacheFileName) == 0 :
+            return xdsLogs.readCorrectLpShellTable(xdsLogFilePath)
+
+        cacheFilePath = os.path.join(os.path.dirname(xdsLogFilePath),cacheFileName)
+        cacheKey = reflections.getFileKey(xdsLogFilePath,xdsLogs.CORRECT_LP_SHELL_TABLE_VERSION)
+        try :
+            inp = open(cacheFilePath,"rb")
+            cache = pickle.load(inp)
+            inp.close()
+            if cache['key'] == cacheKey :
+                self.log.logger.debug("CORRECT.LP shells loaded from cache: %s"%cacheFilePath)
+                return cache['shells'], cache['total']
+        except Exception :
+            pass
+
+        shells, total = xdsLogs.readCorrectLpShellTable(xdsLogFilePath)
+        try :
+            temporaryFilePath = cacheFilePath + '.tmp'
+            outFile = open(temporaryFilePath,"wb")
+            pickle.dump({'key' : cacheKey, 'shells' : shells, 'total' : total},outFile,pickle.HIGHEST_PROTOCOL)
+            outFile.close()
+            os.rename(temporaryFilePath,cacheFilePath)
+        except (IOError, OSError), e:
+            self.log.logger.warning("Could not write the CORRECT.LP shells cache %s: %s"%(cacheFilePath,e))
+        return shells, total
+
     def __parseXdsXhlFile(self,xdsIntensitiesFilePath):
         """
 
-        reads the XDS_ASCII.HKL and return a list of reclections of the format:
+        reads the XDS_ASCII.HKL and returns a compact structured array of reflections
+        (reflections.REFLECTION_DTYPE) with h, k, l, I, sigma(I) and the
+        resolution of the reflection, plus the items in xds_reflection_optional_items.
+
+        Saves the array to the binary cache file : xds_reflections_out_file
+        On later runs the cache is memory-mapped instead of parsing the HKL file,
+        as long as the HKL file (size, mtime, content) and the cell did not change.
 
-        Saves the list to the file : xds_reflections_out_file
-        h k l I sigma(I) resolution
+        Items in the header:
 
        !NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD=12
         !ITEM_H=1
@@ -322,80 +840,103 @@ class BurntWedgesHandler():
         !ITEM_CORR=11
         !ITEM_PSI=12
 
+        RESOLUTION
+
         """
 
-        reflectionList = []
         if os.path.exists(xdsIntensitiesFilePath) is False:
             self.log.logger.warning('XDS HKL file does not exist: %s'%xdsIntensitiesFilePath)
-            return reflectionList
-        else :
-            inp = open(xdsIntensitiesFilePath,"r")
-            lines = inp.readlines()
-            inp.close()
-
-            spaceGroupNumber = None
-            header=True
-            for line in lines:
-                if line.find("!END_OF_DATA") >= 0 :
-                    self.log.logger.debug("File parsed successfully: " + xdsIntensitiesFilePath)
-                    # Writes list of reflection to a file
-                    wedgeBasePath = os.path.dirname(xdsIntensitiesFilePath)
-                    outFilePath = os.path.join(wedgeBasePath,ini.Ini().getPar("XDS","xds_reflections_out_file"))
-                    outFile = open(outFilePath,"wb")
+            return None
 
-                    self.log.logger.info("Dumping reflections file to: " +  outFilePath)
-                    #pp.pprint(reflectionList,depth=2)
-                    pickle.dump(reflectionList, outFile)
+        # Binary cache of the reflections: only valid for the same HKL file and cell
+        wedgeBasePath = os.path.dirname(xdsIntensitiesFilePath)
+        cacheFilePath = os.path.join(wedgeBasePath,ini.Ini().getPar("XDS","xds_reflections_out_file"))
+        cacheKey = reflections.getFileKey(xdsIntensitiesFilePath,*self.currentCell)
+        optionalItems = self.__getReflectionOptionalItems()
+        dtype = reflections.getReflectionDtype(optionalItems)
 
-                    break
-                if header is False:
-                    # Inside the list of reflection
-                    lineContents = line.split()
-                    reflection = [ int(i) for i in lineContents[:3]]
-                    intensity = float(lineContents[3])
-                    sigma = float(lineContents[4])
-                    resolution = self.__getD(reflection) #self.__getD(reflection,self.currentCell, spaceGroupNumber)
-                    # put all in the same list
+        reflectionArray = reflections.loadReflectionsCache(cacheFilePath,cacheKey,dtype)
+        if reflectionArray is not None :
+            self.log.logger.debug("Reflections loaded from cache: %s (%d reflections)"%(cacheFilePath,len(reflectionArray)))
+            return reflectionArray
 
-                    #print '%5d%5d%5d %8.2f %.2f' %(reflection[0],reflection[1],reflection[2],float(lineContents[-1]),resolution)
+        keywords, reflectionArray = reflections.readReflections(xdsIntensitiesFilePath,self.reciprocalMat,optionalItems)
+        if reflectionArray is None :
+            self.log.logger.warning('XDS HKL file is not complete: %s'%xdsIntensitiesFilePath)
+            return None
 
-                    reflection.append(intensity)
-                    reflection.append(sigma)
-                    reflection.append(resolution)
-                    reflectionList.append(reflection)
-                if line.find("!END_OF_HEADER") >= 0 :
-                    header=False
-#                elif line.find("SPACE_GROUP_NUMBER") >= 0 :
-#                    spaceGroupNumber =  int(line.split()[1])
-#                    #print "spaceGroupNumber ->", spaceGroupNumber
+        self.log.logger.debug("File parsed successfully: %s (%d reflections)"%(xdsIntensitiesFilePath,len(reflectionArray)))
 
+        # Writes array of reflections to the cache
+        self.log.logger.info("Dumping reflections file to: " +  cacheFilePath)
+        try :
+            reflections.saveReflectionsCache(cacheFilePath,reflectionArray,cacheKey)
+        except (IOError, OSError), e:
+            self.log.logger.warning("Could not write the reflections cache %s: %s"%(cacheFilePath,e))
 
-        return reflectionList
+        return reflectionArray
 
-    def __calculateXDSIntegratedIntensity(self,reflectionList,resolution):
+    def __calculateXDSIntegratedIntensity(self,reflectionArray,resolution):
 
         """
         Calculates the integrated intensitity from the diffraction pattern
 
         """
         
+        if reflectionArray is None or len(reflectionArray) == 0:
+            return {}
+
+        accumulator = reflections.IntensityAccumulator(resolution,self.resolutionShells)
+        accumulator.add(reflectionArray['IOBS'],reflectionArray['SIGMA(IOBS)'],reflectionArray['RESOLUTION'])
+
+        return self.__buildIntegratedIntensityRecord(accumulator)
+
+    def __calculateXDSIntegratedIntensityStreaming(self,xdsIntensitiesFilePath,resolution,chunkSize):
+
+        """
+        Same as __calculateXDSIntegratedIntensity but reads the XDS_ASCII.HKL
+        by chunks of chunkSize bytes: peak memory does not depend on the number of reflections.
+
+        The reflections cache is neither read nor written in this mode.
+        As in the full load, an incomplete file gives an empty record.
+
+        """
+
+        if os.path.exists(xdsIntensitiesFilePath) is False:
+            self.log.logger.warning('XDS HKL file does not exist: %s'%xdsIntensitiesFilePath)
+            return {}
+
+        accumulator = reflections.IntensityAccumulator(resolution,self.resolutionShells)
+        numberOfChunks = 0
+        try :
+            for keywords, chunk in reflections.iterXdsAsciiHkl(xdsIntensitiesFilePath,chunkSize):
+                d, _ = reflections.getResolution(reflections.getHkl(chunk),self.reciprocalMat)
+                accumulator.add(chunk['IOBS'],chunk['SIGMA(IOBS)'],d)
+                numberOfChunks += 1
+        except ValueError, e:
+            self.log.logger.warning('XDS HKL file is not complete: %s'%e)
+            return {}
+
+        self.log.logger.debug("File parsed by streaming: %s (%d chunks)"%(xdsIntensitiesFilePath,numberOfChunks))
+
+        return self.__buildIntegratedIntensityRecord(accumulator)
+
+    def __buildIntegratedIntensityRecord(self,accumulator):
+
+        """
+        Builds the record with the average intensity from the accumulated sums
+
+        """
+
         record = {}
-        
-        if reflectionList is None or len(reflectionList) == 0:
-            return record
 
-        iSum = 0 # intensity sum
-        rSum = 0 # reflections sum
-        for entry in reflectionList:
-            h,k,l,i,sigma,res = entry
-            if i > 0 and sigma > 0 :
-                if resolution is None or res >= resolution:
-                    iSum += i
-                    rSum += 1
-                else :
-                    #print 'Not including reflection', reflection
-                    pass
+        resolution = accumulator.resolution
+        iSum = accumulator.iSum # intensity sum
+        rSum = accumulator.numberOfReflections # reflections sum
 
+        if rSum == 0 :
+            self.log.logger.warning("No reflections above %.2f A in the XDS HKL file!"%(resolution))
+            return record
 
         averageISum = iSum / rSum
 
@@ -404,23 +945,60 @@ class BurntWedgesHandler():
                               %(resolution,iSum,averageISum,rSum))
 
         #self.log.logger.debug("Average Sum(I) below %.2f A in XDS_ASCII.HKL: %d" % (resolution,averageISum))
-#        record[self.buildAverageIntegratedIntensityFieldName(resolution)] = averageISum
-#        record[self.buildAverageIntegratedIntensityFieldName(resolution,'numberOfReflections')] = rSum
         record['averageIntegratedIntensity'] = averageISum
         record['numberOfReflections'] = rSum
+
+        # Statistics for all the resolution shells (same pass over the reflections)
+        if len(accumulator.shellLimits) > 0 :
+            statistics = accumulator.getShellStatistics()
+            for idx,shellResolution in enumerate(statistics['shellLimits']) :
+                # d >= shellResolution
+                record[self.buildAverageIntegratedIntensityFieldName(shellResolution)] = statistics['cumulativeAverageIntensity'][idx]
+                record[self.buildAverageIntegratedIntensityFieldName(shellResolution,'numberOfReflections')] = int(statistics['cumulativeNumberOfReflections'][idx])
+                record[self.buildAverageIntegratedIntensityFieldName(shellResolution,'averageIOverSigma')] = statistics['cumulativeAverageIOverSigma'][idx]
+                # previous shell limit > d >= shellResolution
+                record[self.buildAverageIntegratedIntensityFieldName(shellResolution,'shellAverageIntegratedIntensity')] = statistics['averageIntensity'][idx]
+                record[self.buildAverageIntegratedIntensityFieldName(shellResolution,'shellAverageIOverSigma')] = statistics['averageIOverSigma'][idx]
         return record
 
-#    def buildAverageIntegratedIntensityFieldName(self,resolution,prefix="averageIntegratedIntensity"):
-#        """
-#        Builds average intensity header
-#        """
-#        return prefix+"_%.2f"%(resolution)
-#
-#    def resolutionSuffixFieldName(self,resolution):
-#        """
-#        Builds average intensity header
-#        """
-#        return "_%.2f"%(resolution)
+    def __getReflectionOptionalItems(self):
+        """
+        XDS items kept with the reflections besides h, k, l, I, sigma and d:
+        xds_reflection_optional_items in the XDS section (e.g. ZD,PSI,CORR)
+        """
+        items = ini.Ini().getPar("XDS","xds_reflection_optional_items","")
+        items = [i.strip() for i in items.split(',') if len(i.strip()) > 0]
+        if self.__isFrameAnalysisOn() and 'ZD' not in items :
+            items.append('ZD')
+        return items
+
+    def __isFrameAnalysisOn(self):
+        return int(ini.Ini().getPar("XDS","xds_per_frame_decay",0)) > 0
+
+    def __getResolutionShells(self):
+        """
+        Resolution shell limits from the config file: e.g. 4.0,3.0,2.5
+        
+        @return: list of floats (empty if not defined)
+        """
+        resolutionShells = ini.Ini().getPar("XDS","xds_resolution_shells","")
+        try :
+            return [float(i) for i in resolutionShells.split(',') if len(i.strip()) > 0]
+        except ValueError:
+            self.log.logger.error("Invalid resolution shells in the config file: %s"%resolutionShells)
+            return []
+
+    def buildAverageIntegratedIntensityFieldName(self,resolution,prefix="averageIntegratedIntensity"):
+        """
+        Builds average intensity header
+        """
+        return prefix+"_%.2f"%(resolution)
+
+    def resolutionSuffixFieldName(self,resolution):
+        """
+        Builds average intensity header
+        """
+        return "_%.2f"%(resolution)
 
     def createRelativeScaleField(self,s0,relativeScale):
         """
@@ -592,72 +1170,16 @@ class BurntWedgesHandler():
 #            self.log.logger.error("Crystal system not recognised for cell: " + cell)
 #            sys.exit(-2)
 
-    def __getD(self, hkl) :
-
-        self.reciprocalMat
-
-        h,k,l = hkl
-
-        hklM = np.matrix([h,k,l])
-        hklMT = np.transpose(hklM)
-
-        # s = h**2 = xh**2 + yk**2 + zl**2
-        s = np.sum(np.square(self.reciprocalMat * hklMT))
-
-        d = np.sqrt(1/s)
-
-        #print '%5d%5d%5d  %8.2f %8.2f' %(h,k,l,s,d)
-        return d
-
-
-    def __crystGen(self,cell):
-        """
-        c-------------------------------------------------
-        c    Callculation of reciprocal lattice parameters and
-        c     orthogonal matrix of crystal orientation
-        c    Am(3,3) -  3*3 - matrics
-        c       a*  b*cos(gama*)  c*cos(beta*)
-        c       0   b*sin(gama*) -c*sin(beta*)cosAlpha
-        c       0       0         1/c
-        c
-        c===================================================
-        """
-
-        a,b,c,alpha,beta,gamma = cell
-
-        alpha = alpha * np.pi/180
-        beta = beta * np.pi/180
-        gamma = gamma * np.pi/180
-
-        cosAlpha = np.cos(alpha)
-        sinAlpha = np.sin(alpha)
-        cosBeta = np.cos(beta)
-        sinBeta = np.sin(beta)
-        cosGamma = np.cos(gamma)
-        sinGamma = np.sin(gamma)
-
-        vol=a*b*c*np.sqrt(1.-cosAlpha**2-cosBeta**2-cosGamma**2+2.*cosAlpha*cosBeta*cosGamma)
-
-        ar=b*c*sinAlpha/vol
-        br=a*c*sinBeta/vol
-        cr=a*b*sinGamma/vol
-
-        cosalfar=(cosBeta*cosGamma-cosAlpha)/(sinBeta*sinGamma)
-        cosbetar=(cosAlpha*cosGamma-cosBeta)/(sinAlpha*sinGamma)
-        cosgamar=(cosAlpha*cosBeta-cosGamma)/(sinAlpha*sinBeta)
-
-        alfar=np.arccos(cosalfar)
-        betar=np.arccos(cosbetar)
-        gamar=np.arccos(cosgamar)
-
-        am = np.matrix([[ar, br*np.cos(gamar), cr*np.cos(betar)],
-                        [ 0.0, br*np.sin(gamar), -cr*np.sin(betar)*cosAlpha],
-                        [ 0.0, 0.0, 1.0/c]])
-
-        #print am
 
-        return am
+# Handler used by the parsing processes (inherited through fork)
+_parsingHandler = None
 
+def _parseWedgeWorker(args):
+    """
+    Parses a wedge in a worker process of BurntWedgesHandler.__parseWedgesInParallel
+    """
+    subWedgeNumber, resolution = args
+    return _parsingHandler.parseWedge(subWedgeNumber,resolution)
 
 
 if __name__ == '__main__':
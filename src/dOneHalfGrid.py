@@ -0,0 +1,197 @@
+#!/usr/bin/env python2.6
+
+"""
+
+D1/2 lookup grid for strategy planning
+
+D1/2 of the theoretical intensity decay (see fitting.calculateTheoreticalIntensityDecay)
+precomputed for every combination of beta, gamma, initial Wilson B factor and
+resolution limit of a grid. The grid is saved as a numpy .npy file (memory-mapped
+when loaded) with its axes beside it (<grid>_axes.npz); queries interpolate
+log(D1/2) multilinearly between the grid points (in log(beta) and log(gamma)).
+
+D1/2 comes from fitting.theoreticalDsOneHalfBatch with the accumulated
+intensities interpolated between the bins of the ideal Wilson distribution
+(interpolated=True), so it is continuous in the resolution limit and can be
+interpolated between the grid points. The D1/2 of InducedRadDam accumulates
+whole bins up to the first one beyond the resolution limit (interpolated=False):
+on the default axes the two differ by up to 1.2% between 1 and 2 A, 2% up to
+3 A and 5% at 4 A (largest for high beta and low gamma), the grid giving the
+longer D1/2.
+
+run as : dOneHalfGrid.py -o dOneHalfGrid.npy [-w <workers>]
+
+-o <grid file>, default dOneHalfGrid.npy
+-w <number of processes>, default all the cores
+
+"""
+
+import os
+import sys
+import getopt
+import multiprocessing
+
+import numpy as np
+
+import fitting
+
+# default axes of the grid
+DEFAULT_BETAS = np.logspace(-8,-4,17)                # A^2/Gy
+DEFAULT_GAMMAS = np.logspace(-9,-5,17)               # 1/Gy
+DEFAULT_INITIAL_WILSON_BS = np.linspace(0.,80.,9)    # A^2
+DEFAULT_RESOLUTIONS = np.linspace(1.,4.,13)          # A
+
+AXES_NAMES = ['betas','gammas','initialWilsonBs','resolutions']
+# axes interpolated in log (log spaced)
+LOG_AXES_NAMES = ['betas','gammas']
+
+
+def _theoreticalDsOneHalfStar(args):
+    # multiprocessing.Pool.map passes one argument
+    return fitting.theoreticalDsOneHalfBatch(*args,interpolated=True)
+
+
+def buildGrid(betas=DEFAULT_BETAS,gammas=DEFAULT_GAMMAS,initialWilsonBs=DEFAULT_INITIAL_WILSON_BS,
+              resolutions=DEFAULT_RESOLUTIONS,numberOfWorkers=None):
+    """
+    D1/2 for every combination of the axes, (beta, gamma, initial B) combinations
+    computed in parallel by numberOfWorkers processes (None for all the cores, 1 for none)
+
+    @return: (betas x gammas x initialWilsonBs x resolutions) array of D1/2 (Gy)
+    """
+    betas = np.asarray(betas,dtype=np.float64)
+    gammas = np.asarray(gammas,dtype=np.float64)
+    initialWilsonBs = np.asarray(initialWilsonBs,dtype=np.float64)
+    resolutions = np.asarray(resolutions,dtype=np.float64)
+
+    jobs = [(beta,gamma,initialWilsonB,resolutions) for beta in betas for gamma in gammas for initialWilsonB in initialWilsonBs]
+    if numberOfWorkers == 1 :
+        results = map(_theoreticalDsOneHalfStar,jobs)
+    else :
+        pool = multiprocessing.Pool(numberOfWorkers)
+        try :
+            results = pool.map(_theoreticalDsOneHalfStar,jobs)
+        finally :
+            pool.close()
+            pool.join()
+
+    return np.array(results).reshape(len(betas),len(gammas),len(initialWilsonBs),len(resolutions))
+
+
+def getAxesFilePath(gridFilePath):
+    return os.path.splitext(gridFilePath)[0] + '_axes.npz'
+
+
+def saveGrid(gridFilePath,grid,betas,gammas,initialWilsonBs,resolutions):
+    """
+    Saves the grid (.npy) and its axes (<grid>_axes.npz), through temporary
+    files renamed at the end
+    """
+    axesFilePath = getAxesFilePath(gridFilePath)
+    tmpGridFilePath = gridFilePath + '.tmp.npy'
+    tmpAxesFilePath = axesFilePath + '.tmp.npz'
+    np.save(tmpGridFilePath,np.asarray(grid,dtype=np.float64))
+    np.savez(tmpAxesFilePath,betas=betas,gammas=gammas,initialWilsonBs=initialWilsonBs,resolutions=resolutions)
+    os.rename(tmpAxesFilePath,axesFilePath)
+    os.rename(tmpGridFilePath,gridFilePath)
+
+
+class DOneHalfGrid(object):
+    """
+    Queries of a saved D1/2 grid
+    """
+
+    def __init__(self,gridFilePath):
+
+        self.grid = np.load(gridFilePath,mmap_mode='r')
+        axesFile = np.load(getAxesFilePath(gridFilePath))
+        self.axes = [np.asarray(axesFile[name],dtype=np.float64) for name in AXES_NAMES]
+        axesFile.close()
+        self.logAxes = [name in LOG_AXES_NAMES for name in AXES_NAMES]
+        for dimension in range(len(self.axes)) :
+            if self.logAxes[dimension] :
+                self.axes[dimension] = np.log(self.axes[dimension])
+        if self.grid.shape != tuple([len(axis) for axis in self.axes]) :
+            raise ValueError("D1/2 grid %s%s does not match its axes %s"%(gridFilePath,str(self.grid.shape),
+                                                                          str(tuple([len(axis) for axis in self.axes]))))
+
+    def query(self,beta,gamma,initialWilsonB,resolution):
+        """
+        D1/2 (Gy) interpolated multilinearly in log(D1/2). The arguments
+        broadcast against each other.
+
+        @return: array of D1/2, nan outside the grid or where a neighbouring
+        grid point has no D1/2
+        """
+        olderr = np.seterr(divide='ignore',invalid='ignore')
+        try :
+            values = [np.log(np.asarray(v,dtype=np.float64)) if logAxis else np.asarray(v,dtype=np.float64)
+                      for v,logAxis in zip((beta,gamma,initialWilsonB,resolution),self.logAxes)]
+        finally :
+            np.seterr(**olderr)
+        values = np.broadcast_arrays(*values)
+
+        lowerIndices = []
+        fractions = []
+        inside = np.ones(values[0].shape,dtype=bool)
+        for axis,value in zip(self.axes,values) :
+            inside &= (value >= axis[0]) & (value <= axis[-1])
+            lower = np.clip(np.searchsorted(axis,value,side='right')-1,0,len(axis)-2)
+            lowerIndices.append(lower)
+            fractions.append(np.clip((value - axis[lower]) / (axis[lower+1] - axis[lower]),0.,1.))
+
+        # sum over the 16 corners of the cell
+        logDOneHalf = np.zeros(values[0].shape)
+        for corner in range(2**len(self.axes)) :
+            weight = np.ones(values[0].shape)
+            indices = []
+            for dimension in range(len(self.axes)) :
+                upper = (corner >> dimension) & 1
+                indices.append(lowerIndices[dimension] + upper)
+                weight = weight * np.where(upper,fractions[dimension],1-fractions[dimension])
+            # only the corners are read from the memory-mapped grid
+            cornerValues = np.log(self.grid[tuple(indices)])
+            # corners with no weight don't spread their nan
+            logDOneHalf += np.where(weight > 0,weight*cornerValues,0.)
+
+        return np.where(inside,np.exp(logDOneHalf),np.nan)
+
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "ho:w:", ["help", "output=", "workers="])
+        except getopt.error, msg:
+            raise Usage(msg)
+
+        gridFilePath = 'dOneHalfGrid.npy'
+        numberOfWorkers = None
+
+        # option processing
+        for option, value in opts:
+            if option in ("-h", "--help"):
+                raise Usage(__doc__)
+            if option in ("-o", "--output"):
+                gridFilePath = value
+            if option in ("-w", "--workers"):
+                numberOfWorkers = int(value)
+
+    except Usage, err:
+        print >>sys.stderr, sys.argv[0].split("/")[-1] + ": " + str(err.msg)
+        print >>sys.stderr, "     for help use --help"
+        return 2
+
+    grid = buildGrid(numberOfWorkers=numberOfWorkers)
+    saveGrid(gridFilePath,grid,DEFAULT_BETAS,DEFAULT_GAMMAS,DEFAULT_INITIAL_WILSON_BS,DEFAULT_RESOLUTIONS)
+    print "D1/2 grid %s saved in %s (%d points without D1/2)"%(str(grid.shape),gridFilePath,np.isnan(grid).sum())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -275,6 +275,27 @@ class EdnaHandler():
 #        self.subWedgesList.saveSV('/tmp/test.csv',delimiter=',')
     
     
+    def getFrameAccumulatedDoses(self,subWedgeNumber,frameFractions,real=False):
+        """
+        Accumulated dose at frames of a subwedge, after doCalculations.
+        The dose of the subwedge is spread evenly over its frames.
+        
+        @param frameFractions: position of the frames in the subwedge: 0 at the start, 1 at the end
+        @param real: use the real dose (raddose) instead of the EDNA one
+        
+        @return: array of doses
+        """
+        if real :
+            doseKey, accumulatedDoseKey = 'realDose', 'realAccumulatedDose'
+        else :
+            doseKey, accumulatedDoseKey = 'dose', 'accumulatedDose'
+        for wedge in self.subWedgesList :
+            if wedge['subWedgeNumber'] == subWedgeNumber :
+                startDose = wedge[accumulatedDoseKey] - wedge[doseKey]
+                return startDose + wedge[doseKey] * np.asarray(frameFractions,dtype=np.float64)
+        self.log.logger.error("Subwedge %d not found in the EDNA strategy"%subWedgeNumber)
+        return None
+    
     def getCellAsString(self):
         return "%.2f %.2f %.2f %.2f %.2f %.2f " %(self.subWedgesList[0]['initial_cell_length_a'],
                                                   self.subWedgesList[0]['initial_cell_length_b'],
@@ -8,6 +8,230 @@ import numpy as np
 import localLogger
 import scipy.optimize as opt
 
+# Ideal Wilson distribution of protein intensities (values for dose 0)
+# H2 = 1/d^2
+IDEAL_WILSON_DISTRIBUTION_H2 = [0.0090, 0.0131, 0.0172,0.0213, 0.0254, 0.0295,0.0335, 0.0376, 0.0417,0.0458, 0.0499, 0.0540,0.0581, 0.0622, 0.0663,0.0704, 0.0745, 0.0786,0.0826, 0.0867, 0.0908,0.0949, 0.0990, 0.1031,0.1072, 0.1113, 0.1154,0.1195, 0.1236, 0.1277,0.1318, 0.1358, 0.1399,0.1440, 0.1481, 0.1522,0.1563, 0.1604, 0.1645,0.1686, 0.1727, 0.1768,0.1809, 0.1849, 0.1890,0.1931, 0.1972, 0.2013,0.2054, 0.2095, 0.2136,0.2177, 0.2218, 0.2259,0.2300, 0.2341, 0.2381,0.2422, 0.2463, 0.2504,0.2545, 0.2586, 0.2627,0.2668, 0.2709, 0.2750,0.2791, 0.2832, 0.2873,0.2913, 0.2954, 0.2995,0.3036, 0.3077, 0.3118,0.3159, 0.3200, 0.3241,0.3282, 0.3323, 0.3364,0.3404, 0.3445, 0.3486,0.3527, 0.3568, 0.3609,0.3650, 0.3691, 0.3732,0.3773, 0.3814, 0.3855,0.3896, 0.3936, 0.3977,0.4018, 0.4059, 0.4100,0.4141, 0.4182, 0.4223,0.4264, 0.4305, 0.4346,0.4387, 0.4428, 0.4468,0.4509, 0.4550, 0.4591,0.4632, 0.4673, 0.4714,0.4755, 0.4796, 0.4837,0.4878, 0.4919, 0.4959,0.5000, 0.5041, 0.5082,0.5123, 0.5164, 0.5205,0.5246, 0.5287, 0.5328,0.5369, 0.5410, 0.5451,0.5491, 0.5532, 0.5573,0.5614, 0.5655, 0.5696,0.5737, 0.5778, 0.5819,0.5860, 0.5901, 0.5942,0.5982, 0.6023, 0.6064,0.6105, 0.6146, 0.6187,0.6228, 0.6269, 0.6310,0.6351, 0.6392, 0.6433,0.6474, 0.6514, 0.6555,0.6596, 0.6637, 0.6678,0.6719, 0.6760, 0.6801,0.6842, 0.6883, 0.6924,0.6965, 0.7006, 0.7046,0.7087, 0.7128, 0.7169,0.7210, 0.7251, 0.7292,0.7333, 0.7374, 0.7415,0.7456, 0.7497, 0.7537,0.7578, 0.7619, 0.7660,0.7701, 0.7742, 0.7783,0.7824, 0.7865, 0.7906,0.7947, 0.7988, 0.8029,0.8069, 0.8110, 0.8151,0.8192, 0.8233, 0.8274,0.8315, 0.8356, 0.8397,0.8438, 0.8479, 0.8520,0.8561, 0.8601, 0.8642,0.8683, 0.8724, 0.8765,0.8806, 0.8847, 0.8888,0.8929, 0.8970, 0.9011,0.9052, 0.9092, 0.9133,0.9174, 0.9215, 0.9256,0.9297, 0.9338, 0.9379,0.9420, 0.9461, 0.9502,0.9543, 0.9584, 0.9624,0.9665, 0.9706, 0.9747,0.9788, 0.9829, 0.9870,0.9911, 0.9952, 0.9993,1.0034, 1.0075, 1.0115,1.0156, 1.0197, 1.0238,1.0279, 1.0320, 1.0361,1.0402, 1.0443, 1.0484,1.0525, 1.0566, 1.0607,1.0647, 1.0688, 1.0729,1.0770, 1.0811, 1.0852,1.0893, 1.0934, 1.0975,1.1016, 1.1057, 1.1098,1.1139, 1.1179, 1.1220,1.1261, 1.1302, 1.1343,1.1384, 1.1425, 1.1466,1.1507, 1.1548, 1.1589,1.1630, 1.1670, 1.1711,1.1752, 1.1793, 1.1834,1.1875, 1.1916, 1.1957,1.1998, 1.2039, 1.2080,1.2121, 1.2162, 1.2202,1.2243, 1.2284, 1.2325,1.2366,1.2407,1.2448,1.2489,1.253,1.2571,1.2612,1.2653,1.2694,1.2735,1.2776,1.2817,1.2858,1.2899,1.294,1.2981,1.3022,1.3063,1.3104,1.3145,1.3186,1.3227,1.3268,1.3309,1.335,1.3391,1.3432,1.3473,1.3514,1.3555,1.3596,1.3637,1.3678,1.3719,1.376,1.3801,1.3842,1.3883,1.3924,1.3965,1.4006,1.4047,1.4088,1.4129,1.417,1.4211,1.4252,1.4293,1.4334,1.4375,1.4416,1.4457,1.4498,1.4539,1.458,1.4621,1.4662,1.4703,1.4744,1.4785,1.4826,1.4867,1.4908,1.4949,1.499,1.5031,1.5072,1.5113,1.5154,1.5195,1.5236,1.5277,1.5318,1.5359,1.5400,1.5441,1.5482,1.5523,1.5564,1.5605,1.5646,1.5687,1.5728,1.5769,1.5810,1.5851,1.5892,1.5933,1.5974,1.6015,1.6056,1.6097,1.6138,1.6179,1.6220,1.6261,1.6302,1.6343,1.6384,1.6425,1.6466,1.6507,1.6548,1.6589,1.6630,1.6671,1.6712,1.6753,1.6794,1.6835,1.6876,1.6917,1.6958,1.6999,1.7040,1.7081,1.7122,1.7163,1.7204,1.7245,1.7286,1.7327,1.7368,1.7409,1.7450,1.7491,1.7532,1.7573,1.7614,1.7655,1.7696,1.7737,1.7778,1.7819,1.7860,1.7901,1.7942,1.7983,1.8024,1.8065,1.8106,1.8147,1.8188,1.8229,1.8270,1.8311,1.8352,1.8393,1.8434,1.8475,1.8516,1.8557,1.8598,1.8639,1.8680,1.8721,1.8762,1.8803,1.8844,1.8885,1.8926,1.8967,1.9008,1.9049,1.9090,1.9131,1.9172,1.9213,1.9254,1.9295,1.9336,1.9377,1.9418,1.9459,1.9500,1.9541,1.9582,1.9623,1.9664,1.9705,1.9746,1.9787,1.9828,1.9869,1.9910,1.9951,1.9992,2.0033,2.0074,2.0115,2.0156,2.0197,2.0238,2.0279,2.0320,2.0361,2.0402,2.0443,2.0484,2.0525,2.0566,2.0607,2.0648,2.0689,2.0730,2.0771,2.0812,2.0853,2.0894,2.0935,2.0976,2.1017,2.1058,2.1099,2.1140,2.1181,2.1222,2.1263,2.1304,2.1345,2.1386,2.1427,2.1468,2.1509,2.1550,2.1591,2.1632,2.1673,2.1714,2.1755,2.1796,2.1837,2.1878,2.1919,2.1960,2.2001,2.2042,2.2083,2.2124,2.2165,2.2206,2.2247,2.2288,2.2329,2.2370,2.2411,2.2452,2.2493,2.2534,2.2575,2.2616,2.2657,2.2698,2.2739,2.2780,2.2821,2.2862,2.2903,2.2944,2.2985,2.3026,2.3067,2.3108,2.3149,2.3190,2.3231,2.3272,2.3313,2.3354,2.3395,2.3436,2.3477,2.3518,2.3559,2.3600,2.3641,2.3682,2.3723,2.3764,2.3805,2.3846,2.3887,2.3928,2.3969,2.4010,2.4051,2.4092,2.4133,2.4174,2.4215,2.4256,2.4297,2.4338,2.4379,2.4420,2.4461,2.4502,2.4543,2.4584,2.4625,2.4666,2.4707,2.4748,2.4789,2.4830,2.4871,2.4912,2.4953,2.4994,2.5035,2.5076,2.5117,2.5158,2.5199,2.5240,2.5281,2.5322,2.5363,2.5404,2.5445,2.5486,2.5527,2.5568,2.5609,2.5650,2.5691,2.5732,2.5773,2.5814,2.5855,2.5896,2.5937,2.5978,2.6019,2.6060,2.6101,2.6142,2.6183,2.6224,2.6265,2.6306,2.6347,2.6388,2.6429,2.6470,2.6511,2.6552,2.6593,2.6634,2.6675,2.6716,2.6757,2.6798,2.6839,2.6880,2.6921,2.6962,2.7003,2.7044,2.7085,2.7126,2.7167,2.7208,2.7249,2.7290,2.7331,2.7372,2.7413,2.7454,2.7495,2.7536,2.7577,2.7618,2.7659,2.7700,2.7741,2.7782,2.7823,2.7864,2.7905,2.7946,2.7987,2.8028,2.8069,2.8110,2.8151,2.8192,2.8233,2.8274,2.8315,2.8356,2.8397,2.8438,2.8479,2.8520,2.8561,2.8602,2.8643,2.8684,2.8725]
+IDEAL_WILSON_DISTRIBUTION_VALUE = [117970.000, 100512.023,  80882.992, 62948.516,  57507.758,  61357.430, 72234.063,  89858.945, 109460.930,126917.039, 137405.063, 139655.375,137483.219, 133394.875, 129394.328,125762.617, 121035.289, 116051.805,110836.078, 104613.297,  97322.055, 89836.305,  83216.188,  78146.273, 73459.672,  69471.023,  65299.645, 61581.441,  58510.613,  55865.180, 53658.789,  52101.020,  51070.418, 50092.043,  49350.723,  48151.910, 47058.906,  46675.406,  46597.676, 45924.047,  46080.672,  45937.621, 46096.023,  45896.965,  45990.094, 46123.293,  46343.516,  45936.539, 45715.695,  45109.164,  44549.133, 43634.820,  43566.086,  43451.016, 42696.293,  41173.980,  39972.754, 39166.629,  38020.367,  36810.992, 35497.309,  34194.906,  32992.742, 31585.996,  30211.492,  29119.816, 28151.564,  27386.414,  26232.775, 25235.693,  24318.244,  23707.949, 22821.910,  22182.096,  21694.740, 21236.889,  20733.123,  20323.289, 20073.404,  19932.156,  19631.480, 19223.189,  18920.273,  18557.662, 18134.789,  17926.918,  17909.145, 17908.371,  17781.652,  17634.252, 17607.758,  17273.971,  17132.121, 16953.238,  16883.561,  16615.092, 16435.377,  16423.141,  16351.833, 16278.806,  15998.301,  15795.754, 15589.186,  15561.384,  15467.072, 15476.589,  15331.998,  15028.964, 14745.987,  14509.142,  14445.926, 14254.643,  14111.921,  13900.479, 13785.526,  13686.093,  13464.846, 13304.157,  13084.093,  13114.881, 13089.596,  13244.095,  13117.398, 13140.626,  13031.727,  12999.481, 12835.458,  12954.440,  12937.747, 12936.304,  12825.827,  12995.077, 12994.031,  13036.257,  13006.766, 13057.586,  13010.016,  12891.707, 12966.081,  13114.423,  13119.474, 13065.754,  13052.747,  13214.619, 13376.885,  13386.037,  13244.184, 13225.625,  13203.178,  13157.919, 13058.345,  13089.547,  13236.270, 13356.928,  13294.085,  13322.506, 13356.878,  13574.700,  13741.788, 13988.013,  14126.934,  14226.778, 14096.913,  14083.928,  14170.343, 14351.646,  14494.585,  14485.082, 14514.434,  14622.690,  14725.597, 14840.912,  14869.137,  14947.929, 15039.328,  15069.899,  15058.230, 14892.115,  14829.184,  14854.609, 14911.043,  14950.722,  15113.783, 15211.773,  15205.695,  15024.023, 14926.859,  14948.205,  14968.500, 14961.653,  14880.744,  14853.396, 14715.400,  14625.747,  14476.197, 14315.362,  14115.836,  14177.435, 14214.169,  13756.128,  13478.938, 13409.521,  13313.305,  13191.076, 13068.228,  13143.240,  13034.021, 12844.786,  12565.626,  12494.126, 12431.333,  12224.259,  12045.229, 11934.917,  11999.310,  12092.722, 12073.927,  12000.386,  11492.284, 11340.666,  11261.278,  11170.411, 11033.554,  10920.556,  10805.261, 10749.542,  10633.937,  10553.671, 10396.852,  10345.898,  10439.532, 10444.084,  10338.728,  10137.357, 10024.374,   9960.443,   9843.068,  9813.853,   9774.964,   9722.901,  9668.755,   9489.759,   9437.470,  9337.847,   9232.355,   9143.001,  8946.202,   9061.576,   8927.707,  8833.817,   8559.503,   8737.791,  8741.253,   8734.717,   8730.013,  8553.071,   8567.203,   8448.906,  8348.450,   8372.744,   8420.621,  8534.404,   8515.739,   8391.372,  8376.129,   8364.006,   8370.607,  8053.081,   7885.547,   7949.570,  8098.683,   8009.885,   7884.853,  7912.111,   7977.090,   8038.597,  7984.881,   7943.616,   8002.785,  7840.147,   7771.715,   7704.840,  7606.398,   7499.033,   7380.200,  7353.043,   7373.826,   7386.296,  7445.311,   7298.761,   7163.549,6936.293,6920.410,6888.470,7020.130,   6991.486,6970.270,6894.089,6915.407,6934.171,6726.973509,6686.434089,6646.138977,6606.086698,6566.275791,6526.704799,6487.372279,6448.276792,6409.416909,6370.791212,6332.398289,6294.236737,6256.305161,6218.602176,6181.126405,6143.876477,6106.851032,6070.048718,6033.468188,5997.108108,5960.967148,5925.043987,5889.337314,5853.845824,5818.568219,5783.503211,5748.649519,5714.005869,5679.570996,5645.343641,5611.322553,5577.506491,5543.894217,5510.484504,5477.276131,5444.267885,5411.45856,5378.846957,5346.431885,5314.212159,5282.186601,5250.354043,5218.71332,5187.263276,5156.002763,5124.930639,5094.045767,5063.34702,5032.833276,5002.503419,4972.356343,4942.390945,4912.60613,4883.00081,4853.573904,4824.324336,4795.251038,4766.352947,4737.629007,4709.078169,4680.69939,4652.491632,4624.453866,4596.585067,4568.884216,4541.350301,4513.982317,4486.779263,4459.740146,4432.863977,4406.149774,4379.596562,4353.20337,4326.969234,4300.893196,4274.974301,4249.211605,4223.604165,4198.151045,4172.851316,4147.704053,4122.708338,4097.863257,4073.167902,4048.621371,4024.222768,3999.9712,3975.865781,3951.905632,3928.089876,3904.417643,3880.888068,3857.500292,3834.25346,3811.146723,3788.179236,3765.35016,3742.658662,3720.103911,3697.685085,3675.401363,3653.251931,3631.235981,3609.352708,3587.601312,3565.980999,3544.490978,3523.130465,3501.898679,3480.794844,3459.818189,3438.967947,3418.243358,3397.643663,3377.16811,3356.815951,3336.586442,3316.478844,3296.492423,3276.626448,3256.880193,3237.252936,3217.743962,3198.352556,3179.078011,3159.919621,3140.876688,3121.948515,3103.134411,3084.433688,3065.845663,3047.369657,3029.004995,3010.751005,2992.607021,2974.57238,2956.646424,2938.828495,2921.117945,2903.514126,2886.016394,2868.624111,2851.336641,2834.153351,2817.073615,2800.096808,2783.222311,2766.449505,2749.77778,2733.206524,2716.735134,2700.363007,2684.089545,2667.914153,2651.836241,2635.85522,2619.970507,2604.181522,2588.487688,2572.888431,2557.383182,2541.971373,2526.652442,2511.425828,2496.290977,2481.247334,2466.29435,2451.431479,2436.658177,2421.973905,2407.378127,2392.870308,2378.449919,2364.116433,2349.869327,2335.708079,2321.632173,2307.641093,2293.73433,2279.911374,2266.17172,2252.514868,2238.940317,2225.447571,2212.036139,2198.705528,2185.455254,2172.284831,2159.193778,2146.181617,2133.247872,2120.392072,2107.613745,2094.912426,2082.28765,2069.738956,2057.265885,2044.867982,2032.544794,2020.29587,2008.120763,1996.019028,1983.990223,1972.033909,1960.149647,1948.337005,1936.595551,1924.924856,1913.324493,1901.794038,1890.33307,1878.941171,1867.617923,1856.362914,1845.175733,1834.055969,1823.003218,1812.017075,1801.097139,1790.243011,1779.454294,1768.730594,1758.07152,1747.476681,1736.945691,1726.478165,1716.073721,1705.731978,1695.452558,1685.235086,1675.079189,1664.984495,1654.950636,1644.977245,1635.063957,1625.210411,1615.416246,1605.681105,1596.004632,1586.386472,1576.826276,1567.323694,1557.878377,1548.489982,1539.158165,1529.882586,1520.662904,1511.498784,1502.389891,1493.335892,1484.336455,1475.391253,1466.499958,1457.662246,1448.877793,1440.146279,1431.467384,1422.840792,1414.266187,1405.743256,1397.271688,1388.851173,1380.481403,1372.162073,1363.892878,1355.673517,1347.503688,1339.383095,1331.311439,1323.288427,1315.313764,1307.38716,1299.508325,1291.67697,1283.892811,1276.155562,1268.46494,1260.820666,1253.222459,1245.670041,1238.163138,1230.701474,1223.284777,1215.912776,1208.585202,1201.301787,1194.062264,1186.86637,1179.713841,1172.604415,1165.537835,1158.51384,1151.532174,1144.592583,1137.694813,1130.838611,1124.023727,1117.249913,1110.51692,1103.824504,1097.172418,1090.56042,1083.988269,1077.455724,1070.962547,1064.508501,1058.093349,1051.716857,1045.378793,1039.078924,1032.817021,1026.592855,1020.406198,1014.256824,1008.144509,1002.069029,996.0301617,990.0276876,984.0613867,978.1310412,972.2364343,966.3773506,960.5535761,954.7648979,949.0111047,943.2919861,937.6073332,931.9569382,926.3405948,920.7580977,915.209243,909.6938279,904.2116508,898.7625116,893.346211,887.9625512,882.6113354,877.2923683,872.0054553,866.7504034,861.5270205,856.3351158,851.1744996,846.0449833,840.9463796,835.878502,830.8411655,825.834186,820.8573805,815.9105673,810.9935655,806.1061955,801.2482787,796.4196377,791.620096,786.8494783,782.1076102,777.3943185,772.7094309,768.0527764,763.4241847,758.8234867,754.2505144,749.7051006,745.1870793,740.6962854,736.2325548,731.7957244,727.3856321,723.0021168,718.6450183,714.3141775,710.0094359,705.7306365,701.4776228,697.2502395,693.0483321,688.871747,684.7203317,680.5939345,676.4924046,672.4155921,668.3633481,664.3355246,660.3319743,656.3525511,652.3971094,648.4655048,644.5575936,640.673233,636.8122811,632.9745969,629.16004,625.3684712,621.5997519,617.8537445,614.1303119,610.4293182,606.7506282,603.0941075]
+
+# built on first use by getIdealWilsonDistribution
+_idealWilsonDistribution = None
+
+# (initialWilsonB, initialWilsonScale) -> (i0PerBin, i0AccumulatedPerBin)
+_i0PerBinCache = {}
+I0_PER_BIN_CACHE_SIZE = 128
+
+def _readOnlyArray(values):
+    values = np.array(values,dtype=np.float64)
+    values.setflags(write=False)
+    return values
+
+def getIdealWilsonDistribution():
+    """
+    Ideal Wilson distribution as read-only arrays, built once
+    
+    @return: dictionary with h2, value, resolution (1/sqrt(h2)) and deltaH
+    (sqrt of the h2 step)
+    """
+    global _idealWilsonDistribution
+    if _idealWilsonDistribution is None :
+        h2 = _readOnlyArray(IDEAL_WILSON_DISTRIBUTION_H2)
+        _idealWilsonDistribution = {
+            'h2' : h2,
+            'value' : _readOnlyArray(IDEAL_WILSON_DISTRIBUTION_VALUE),
+            'resolution' : _readOnlyArray(np.sqrt(1./h2)),
+            'deltaH' : np.sqrt((h2[-1]-h2[0])/(len(h2)-1)),
+        }
+    return _idealWilsonDistribution
+
+def getIdealWilsonI0PerBin(initialWilsonB,initialWilsonScale=1.0):
+    """
+    Intensity per bin of the ideal Wilson distribution for an initial B factor
+    and scale, and its accumulation from low to high resolution.
+    Memoized (read-only arrays).
+    
+    @return: (i0PerBin, i0AccumulatedPerBin)
+    """
+    key = (float(initialWilsonB),float(initialWilsonScale))
+    if key not in _i0PerBinCache :
+        if len(_i0PerBinCache) >= I0_PER_BIN_CACHE_SIZE :
+            _i0PerBinCache.clear()
+        i0PerBin = idealWilsonI0PerBin(initialWilsonB,initialWilsonScale)
+        _i0PerBinCache[key] = (_readOnlyArray(i0PerBin), _readOnlyArray(np.add.accumulate(i0PerBin)))
+    return _i0PerBinCache[key]
+
+def idealWilsonI0PerBin(initialWilsonB,initialWilsonScale=1.0):
+    """
+    Intensity per bin of the ideal Wilson distribution (not memoized,
+    for B factors that change at every call, e.g. while fitting).
+    An array of n B factors gives an (n x bins) array.
+    """
+    wilson = getIdealWilsonDistribution()
+    h2 = wilson['h2']
+    return wilson['value'] * np.exp(-np.multiply.outer(initialWilsonB,h2)/2.)*initialWilsonScale*4*np.pi*h2*wilson['deltaH']
+
+#################################################
+# Models: vectorised function and analytic Jacobian
+# (d function / d coefficient, one column per coefficient)
+#################################################
+
+def exponential3coeffs(coeffs,x):
+    a,b,c = coeffs
+    return a*np.exp(b*x) + c
+
+def exponential3coeffsJacobian(coeffs,x):
+    a,b,c = coeffs
+    e = np.exp(b*x)
+    return np.column_stack((e, a*x*e, np.ones(len(x))))
+
+def exponential2coeffs(coeffs,x):
+    a,b = coeffs
+    return a*np.exp(b*x)
+
+def exponential2coeffsJacobian(coeffs,x):
+    a,b = coeffs
+    e = np.exp(b*x)
+    return np.column_stack((e, a*x*e))
+
+def exponential1coeff(coeffs,x):
+    return np.exp(coeffs[0]*x)
+
+def exponential1coeffJacobian(coeffs,x):
+    return (x*np.exp(coeffs[0]*x))[:,np.newaxis]
+
+def exponentialSquared3coeffs(coeffs,x):
+    a,b,c = coeffs
+    return a*np.exp((b*x)**2) + c
+
+def exponentialSquared3coeffsJacobian(coeffs,x):
+    a,b,c = coeffs
+    e = np.exp((b*x)**2)
+    return np.column_stack((e, 2*a*b*x**2*e, np.ones(len(x))))
+
+def exponentialSquared2coeffs(coeffs,x):
+    a,b = coeffs
+    return a*np.exp((b*x)**2)
+
+def exponentialSquared2coeffsJacobian(coeffs,x):
+    a,b = coeffs
+    e = np.exp((b*x)**2)
+    return np.column_stack((e, 2*a*b*x**2*e))
+
+def exponentialSquared1coeff(coeffs,x):
+    return np.exp((coeffs[0]*x)**2)
+
+def exponentialSquared1coeffJacobian(coeffs,x):
+    b = coeffs[0]
+    return (2*b*x**2*np.exp((b*x)**2))[:,np.newaxis]
+
+def exponentialSquaredNegative1coeff(coeffs,x):
+    return np.exp(-(coeffs[0]*x)**2)
+
+def exponentialSquaredNegative1coeffJacobian(coeffs,x):
+    b = coeffs[0]
+    return (-2*b*x**2*np.exp(-(b*x)**2))[:,np.newaxis]
+
+def linear1coeff(coeffs,x):
+    return coeffs[0]*x
+
+def linear1coeffJacobian(coeffs,x):
+    return np.asarray(x,dtype=np.float64)[:,np.newaxis]
+
+FITTING_MODELS = {
+    'exponential3coeffs' : {'function' : exponential3coeffs, 'jacobian' : exponential3coeffsJacobian},
+    'exponential2coeffs' : {'function' : exponential2coeffs, 'jacobian' : exponential2coeffsJacobian},
+    'exponential1coeff' : {'function' : exponential1coeff, 'jacobian' : exponential1coeffJacobian},
+    'exponentialSquared3coeffs' : {'function' : exponentialSquared3coeffs, 'jacobian' : exponentialSquared3coeffsJacobian},
+    'exponentialSquared2coeffs' : {'function' : exponentialSquared2coeffs, 'jacobian' : exponentialSquared2coeffsJacobian},
+    'exponentialSquared1coeff' : {'function' : exponentialSquared1coeff, 'jacobian' : exponentialSquared1coeffJacobian},
+    'exponentialSquaredNegative1coeff' : {'function' : exponentialSquaredNegative1coeff, 'jacobian' : exponentialSquaredNegative1coeffJacobian},
+    'linear1coeff' : {'function' : linear1coeff, 'jacobian' : linear1coeffJacobian},
+}
+
+def leastSquaresFitting(modelName,x,y,p0):
+    """
+    Levenberg-Marquardt least squares (MINPACK, scipy.optimize.leastsq) of
+    a model of FITTING_MODELS with its analytic Jacobian.
+    
+    @return: (coefficients, covariance)
+    covariance of the coefficients (scaled by the residual variance), None if
+    it can't be determined (singular or not more points than coefficients)
+    """
+    model = FITTING_MODELS[modelName]
+    function = model['function']
+    jacobian = model['jacobian']
+    x = np.asarray(x,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64)
+    
+    def residuals(p):
+        return function(p,x) - y
+    
+    def residualsJacobian(p):
+        return jacobian(p,x)
+    
+    coefficients, covariance, infodict, message, ier = opt.leastsq(residuals,np.asarray(p0,dtype=np.float64),
+                                                                   Dfun=residualsJacobian,full_output=True)
+    coefficients = np.atleast_1d(coefficients)
+    if covariance is not None and len(x) > len(coefficients) :
+        covariance = covariance * np.dot(infodict['fvec'],infodict['fvec']) / (len(x) - len(coefficients))
+    else :
+        covariance = None
+    return coefficients, covariance
+
+def prefixLeastSquaresFitting(modelName,x,y,p0,firstLength=2,xtol=1.49012e-08):
+    """
+    Least squares of a model of FITTING_MODELS to every prefix x[:n], y[:n]
+    (n >= firstLength). Each prefix starts from the solution of the previous
+    one; if the Gauss-Newton step from there is negligible (relative size
+    below xtol) that solution is kept without iterating. A previous solution
+    where the relative sensitivities (Jacobian columns times the coefficients)
+    are rank deficient, e.g. b ~ 0 for exp((b*x)**2), is not a usable start
+    and p0 is used instead.
+    
+    @return: (coefficients, covariances) lists with one entry per prefix
+    """
+    model = FITTING_MODELS[modelName]
+    function = model['function']
+    jacobian = model['jacobian']
+    x = np.asarray(x,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64)
+    p0 = np.asarray(p0,dtype=np.float64)
+    p = p0
+    
+    coefficientsList = []
+    covariances = []
+    for n in range(firstLength,len(x)+1):
+        xn = x[:n]
+        yn = y[:n]
+        residuals = function(p,xn) - yn
+        jac = jacobian(p,xn)
+        if np.linalg.matrix_rank(jac*np.where(p != 0,np.abs(p),1.0)) < len(p) :
+            p = p0
+            step = None
+        else :
+            step = np.linalg.lstsq(jac,-residuals,rcond=-1)[0]
+        if step is not None and np.all(np.isfinite(step)) and np.sqrt(np.dot(step,step)) <= xtol*np.sqrt(np.dot(p,p)) :
+            covariance = None
+            if n > len(p) :
+                try:
+                    covariance = np.linalg.inv(np.dot(jac.T,jac)) * np.dot(residuals,residuals) / (n - len(p))
+                except np.linalg.LinAlgError:
+                    pass
+        else :
+            p, covariance = leastSquaresFitting(modelName,xn,yn,p)
+        coefficientsList.append(p.copy())
+        covariances.append(covariance)
+    return coefficientsList, covariances
+
+def exponentialSquaredGuess(x,y):
+    """
+    Initial guess for a*exp(+-(b*x)**2) from the linear fitting of log(y) against x**2
+    
+    @return: (a, b) with b >= 0
+    """
+    k, logA = np.polyfit(np.asarray(x,dtype=np.float64)**2, np.log(y), 1)
+    return np.exp(logA), np.sqrt(abs(k))
+
+
 class Fitting(object):
     '''
     classdocs
@@ -29,6 +253,7 @@ class Fitting(object):
         
         self.function = None
         self.coefficients = None
+        self.covariance = None
         self.error = None
         
         #self.log.logger.debug('Data to Fit: \nX: %s\nY: %s'%(x,y))
@@ -48,135 +273,73 @@ class Fitting(object):
     
     
     def linearFitting1Coeff(self):
-        
+        """
+        y = b*x : least squares solution b = sum(x*y)/sum(x*x)
+        """
         self.function = self.funcLinear1coeff
-        residuals = self.residualsLinear1coeff
         
-        # Estimate a,b
-        a,b = np.polyfit(self.discrete_x,self.discrete_y, 1)
-
-        #initial guess
-        p0=[a]
-                
-        #self.log.logger.debug("Guess exponential function: %.2e * exp(%.2e * x) + %.2e" % (p0[0],p0[1],0))
-        plsq = opt.fmin(residuals, p0, args=(self.discrete_x,self.discrete_y), maxiter=10000, maxfun=10000,disp=False)
-        #self.log.logger.debug("Exponential fit function: %.2e * exp(%.2e * x) + %.2e" % (plsq[0],plsq[1],plsq[2]))
-        #print plsq
-        
-        self.coefficients = plsq
+        x = np.asarray(self.discrete_x,dtype=np.float64)
+        y = np.asarray(self.discrete_y,dtype=np.float64)
+        self.coefficients = np.array([np.dot(x,y)/np.dot(x,x)])
     
     def exponentialFitting1Coeff(self):
-        
+        """
+        y = exp(b*x)
+        """
         self.function = self.funcExponential1coeffs
-        residuals = self.residualsExponential1coeffs
         
-        # Estimate a and b, assuming c = 0
+        # Estimate b
         # y = A * exp(B * x) can be linearized by fitting log(y) = log(A * exp(B * x)) = B * x + log(A)
         # y2 = B * x + log(A)
         y2 = np.log(self.discrete_y)
         b, log2 = np.polyfit(self.discrete_x, y2, 1)
-        a = np.exp(log2)
-
-        #initial guess
-        p0=[b]
-                
-        #self.log.logger.debug("Guess exponential function: %.2e * exp(%.2e * x) + %.2e" % (p0[0],p0[1],0))
-        plsq = opt.fmin(residuals, p0, args=(self.discrete_x,self.discrete_y), maxiter=10000, maxfun=10000,disp=False)
-        #self.log.logger.debug("Exponential fit function: %.2e * exp(%.2e * x) + %.2e" % (plsq[0],plsq[1],plsq[2]))
-        #print plsq
         
-        self.coefficients = plsq
+        self.coefficients, self.covariance = leastSquaresFitting('exponential1coeff',self.discrete_x,self.discrete_y,[b])
     
     
     def exponentialFitting3Coeffs(self):
-        
+        """
+        y = a*exp(b*x) + c
+        """
         self.function = self.funcExponential3coeffs
-        residuals = self.residualsExponential3coeffs
         
         # Estimate a and b, assuming c = 0
-        # y = A * exp(B * x) can be linearized by fitting log(y) = log(A * exp(B * x)) = B * x + log(A)
-        # y2 = B * x + log(A)
         y2 = np.log(self.discrete_y)
         b, log2 = np.polyfit(self.discrete_x, y2, 1)
         a = np.exp(log2)
-
-        #initial guess
-        p0=[a,b,0]
-                
-        #self.log.logger.debug("Guess exponential function: %.2e * exp(%.2e * x) + %.2e" % (p0[0],p0[1],0))
-        plsq = opt.fmin(residuals, p0, args=(self.discrete_x,self.discrete_y), maxiter=10000, maxfun=10000,disp=False)
-        #self.log.logger.debug("Exponential fit function: %.2e * exp(%.2e * x) + %.2e" % (plsq[0],plsq[1],plsq[2]))
-        #print plsq
         
-        self.coefficients = plsq
+        self.coefficients, self.covariance = leastSquaresFitting('exponential3coeffs',self.discrete_x,self.discrete_y,[a,b,0])
     
     def exponentialSquared2coeffsFitting(self):
-        
-        
+        """
+        y = a*exp((b*x)**2)
+        """
         self.function = self.funcExponentialSquared2coeffs
-        residuals = self.residualsExponentialSquared2coeffs
         
-        # Estimate a and b, assuming c = 0
-        # y = A * exp(B * x) can be linearized by fitting log(y) = log(A * exp(B * x)) = B * x + log(A)
-        # y2 = B * x + log(A)
-        y2 = np.log(self.discrete_y)
-        b, log2 = np.polyfit(self.discrete_x, y2, 1)
-        a = np.exp(log2)
-
-        #initial guess
-        p0=[a,b]
-                
-        #self.log.logger.debug("Guess exponential function: %.2e * exp(%.2e * x) + %.2e" % (p0[0],p0[1],0))
-        plsq = opt.fmin(residuals, p0, args=(self.discrete_x,self.discrete_y), maxiter=10000, maxfun=10000,disp=False)
-        #self.log.logger.debug("Exponential fit function: %.2e * exp(%.2e * x) + %.2e" % (plsq[0],plsq[1],plsq[2]))
-        #print plsq
-        
-        self.coefficients = plsq
+        a, b = exponentialSquaredGuess(self.discrete_x,self.discrete_y)
+        self.coefficients, self.covariance = leastSquaresFitting('exponentialSquared2coeffs',self.discrete_x,self.discrete_y,[a,b])
+        # b and -b are the same solution
+        self.coefficients[1] = abs(self.coefficients[1])
     
     def exponentialSquared1coeffFitting(self):
-        
-        
+        """
+        y = exp((b*x)**2)
+        """
         self.function = self.funcExponentialSquared1coeff
-        residuals = self.residualsExponentialSquared1coeff
-        
-        # Estimate a and b, assuming c = 0
-        # y = A * exp(B * x) can be linearized by fitting log(y) = log(A * exp(B * x)) = B * x + log(A)
-        # y2 = B * x + log(A)
-        y2 = np.log(self.discrete_y)
-        b, log2 = np.polyfit(self.discrete_x, y2, 1)
-        a = np.exp(log2)
-
-        #initial guess
-        p0=[a,b]
-                
-        #self.log.logger.debug("Guess exponential function: %.2e * exp(%.2e * x) + %.2e" % (p0[0],p0[1],0))
-        plsq = opt.fmin(residuals, p0, args=(self.discrete_x,self.discrete_y), maxiter=10000, maxfun=10000,disp=False)
-        #self.log.logger.debug("Exponential fit function: %.2e * exp(%.2e * x) + %.2e" % (plsq[0],plsq[1],plsq[2]))
-        #print plsq
         
-        self.coefficients = plsq
+        a, b = exponentialSquaredGuess(self.discrete_x,self.discrete_y)
+        self.coefficients, self.covariance = leastSquaresFitting('exponentialSquared1coeff',self.discrete_x,self.discrete_y,[b])
+        self.coefficients[0] = abs(self.coefficients[0])
     
     def exponentialSquared1CoeffsNegativeFitting(self):
-        
-        
+        """
+        y = exp(-(b*x)**2)
+        """
         self.function = self.funcExponentialSquaredNegative1coeffs
-        residuals = self.residualsExponentialSquaredNegative1coeffs
         
-        # Estimate a and b, assuming c = 0
-        # y = A * exp(B * x) can be linearized by fitting y = log(A * exp(B * x)) = B * x + log(A)
-        y2 = np.log(self.discrete_y)
-        b, log2 = np.polyfit(self.discrete_x, y2, 1)
-        a = np.exp(log2)
-
-        #initial guess
-        p0=[b]
-                
-        #self.log.logger.debug("Guess exponential function: %.2e * exp(%.2e * x) + %.2e" % (p0[0],p0[1],0))
-        plsq = opt.fmin(residuals, p0, args=(self.discrete_x,self.discrete_y), maxiter=10000, maxfun=10000,disp=False)
-        #self.log.logger.debug("Exponential fit function: %.2e * exp(%.2e * x) + %.2e" % (plsq[0],plsq[1],plsq[2]))
-        #print plsq
-        
-        self.coefficients = plsq
+        a, b = exponentialSquaredGuess(self.discrete_x,self.discrete_y)
+        self.coefficients, self.covariance = leastSquaresFitting('exponentialSquaredNegative1coeff',self.discrete_x,self.discrete_y,[b])
+        self.coefficients[0] = abs(self.coefficients[0])
 
     
     def determineError(self):
@@ -191,139 +354,33 @@ class Fitting(object):
     
     
     ##########################    
+    # a - y coordinate where x=0
+    # b - curve inclination (large values, high inclination
+    # c - moves curve in y axis
     
-    #
     def funcExponential3coeffs(self,coeffs,x):
-        a,b,c = coeffs
-        # a - y coordinate where x=0
-        # b - curve inclination (large values, high inclination
-        # c - moves curve in y axis
-        return a*np.exp( b*x )+c
-    
-    def residualsExponential3coeffs(self,p,x,y):
-        w=p[0]*np.exp( p[1]*x ) + p[2]
-        err=w-y
-        err=err**2
-        b=sum(err)
-        return b
-    
-    #
+        return exponential3coeffs(coeffs,x)
+    
     def funcExponential2coeffs(self,coeffs,x):
-        a,b = coeffs
-        # a - y coordinate where x=0
-        # b - curve inclination (large values, high inclination
-        # c - moves curve in y axis
-        return a*np.exp( b*x )
-    
-    def residualsExponential2coeffs(self,p,x,y):
-        w=p[0]*np.exp( p[1]*x )
-        err=w-y
-        err=err**2
-        b=sum(err)
-        return b
+        return exponential2coeffs(coeffs,x)
    
     def funcExponential1coeffs(self,coeffs,x):
-        b = coeffs[0]
-        # a - y coordinate where x=0
-        # b - curve inclination (large values, high inclination
-        # c - moves curve in y axis
-        return np.exp( b*x )
-    
-    def residualsExponential1coeffs(self,p,x,y):
-        w=np.exp( p[0]*x )
-        err=w-y
-        err=err**2
-        b=sum(err)
-        return b
+        return exponential1coeff(coeffs,x)
     
-    
-    #
     def funcExponentialSquared3coeffs(self,coeffs,x):
-        a,b,c = coeffs
-        # a - y coordinate where x=0
-        # b - curve inclination (large values, high inclination
-        # c - moves curve in y axis
-        return a*np.exp( (b*x)**2 )+c
-    
-    def residualsExponentialSquared3coeffs(self,p,x,y):
-        w=p[0]*np.exp( (p[1]*x)**2 ) + p[2]
-        err=w-y
-        err=err**2
-        b=sum(err)
-        return b
-    #
+        return exponentialSquared3coeffs(coeffs,x)
+    
     def funcExponentialSquared2coeffs(self,coeffs,x):
-        a,b = coeffs
-        # a - y coordinate where x=0
-        # b - curve inclination (large values, high inclination
-        # c - moves curve in y axis
-        return a*np.exp( (b*x)**2 )
-    
-    def residualsExponentialSquared2coeffs(self,p,x,y):
-        w=p[0]*np.exp( (p[1]*x)**2 )
-        err=w-y
-        err=err**2
-        b=sum(err)
-        return b
-    
-    #
-    def funcExponentialSquared1coeff(self,coeffs,x):
-        b = coeffs[0]
-        # a - y coordinate where x=0
-        # b - curve inclination (large values, high inclination
-        # c - moves curve in y axis
-        return np.exp((b*x)**2 )
-    
-    def residualsExponentialSquared1coeff(self,p,x,y):
-        w=np.exp( (p[0]*x)**2 )
-        err=w-y
-        err=err**2
-        b=sum(err)
-        return b        
-    
-    #
-    def funcExponentialSquaredNegative1coeffs(self,coeffs,x):
-        b = coeffs[0]
-        # a - y coordinate where x=0
-        # b - curve inclination (large values, high inclination
-        # c - moves curve in y axis
-        return np.exp(-(b*x)**2 )
+        return exponentialSquared2coeffs(coeffs,x)
     
-    def residualsExponentialSquaredNegative1coeffs(self,p,x,y):
-        w=np.exp( -(p[0]*x)**2 )
-        err=w-y
-        err=err**2
-        b=sum(err)
-        return b        
+    def funcExponentialSquared1coeff(self,coeffs,x):
+        return exponentialSquared1coeff(coeffs,x)
     
+    def funcExponentialSquaredNegative1coeffs(self,coeffs,x):
+        return exponentialSquaredNegative1coeff(coeffs,x)
     
-    #
     def funcLinear1coeff(self,coeffs,x):
-        b = coeffs[0]
-        # a - y coordinate where x=0
-        # b - curve inclination (large values, high inclination
-        # c - moves curve in y axis
-        return b*x
-    
-    def residualsLinear1coeff(self,p,x,y):
-        w=p[0]*x
-        err=w-y
-        err=err**2
-        b=sum(err)
-        return b
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
+        return linear1coeff(coeffs,x)
     
     
     ######
@@ -334,79 +391,72 @@ class Fitting(object):
         """
         
         Going throught all the data and calculates the fitting since the first 2 points
+        All the fittings are solved at once (prefixLinearFitting).
+        The standard errors of the slopes are kept in self.slopeErrors
         
         @return: a list with the slopes of the linear fitting
         """
         
         self.setContinuousX()
-        slopes = []
-        slopes.append(0)
-        x= self.discrete_x
-        y= self.discrete_y
-        for i in range(2,len(x)+1):
-            temp = Fitting(x[:i],y[:i])
-            temp.linearFitting1Coeff()
-            slopes.append(temp.coefficients[0])
-        # I know I am going to repeat the same fitting but its simpler
-        self.linearFitting1Coeff()     
+        slopes, intercepts, slopeErrors, interceptErrors = prefixLinearFitting(self.discrete_x,self.discrete_y,intercept=False)
+        
+        # the fitting of all the data is the last one
+        self.function = self.funcLinear1coeff
+        self.coefficients = np.array([slopes[-1]])
+        self.slopeErrors = [0] + list(slopeErrors[1:])
         self.setContinuousY()
         self.determineError()
         
-        return slopes
+        return [0] + list(slopes[1:])
     
     def doMultipleLinearFitting2Coeffs(self):
         """
         
         Going throught all the data and calculates the fitting since the first 2 points
+        All the fittings are solved at once (prefixLinearFitting).
+        The standard errors are kept in self.slopeErrors and self.interceptErrors
         
         @return: a list with the slopes of the linear fitting
         """
         
         self.setContinuousX()
-        slopes = []
-        slopes.append(0)
-        x0 = []
-        x0.append(0)
+        slopes, intercepts, slopeErrors, interceptErrors = prefixLinearFitting(self.discrete_x,self.discrete_y)
         
-        x= self.discrete_x
-        y= self.discrete_y
-        for i in range(2,len(x)+1):
-            temp = Fitting(x[:i],y[:i])
-            temp.linearFitting2Coeffs()
-            slopes.append(temp.coefficients[0])
-            x0.append(temp.coefficients[1])
-        # I know I am going to repeat the same fitting but its simpler
-        self.linearFitting2Coeffs()    
+        # the fitting of all the data is the last one
+        self.function = np.polyval
+        self.coefficients = np.array([slopes[-1],intercepts[-1]])
+        self.slopeErrors = [0] + list(slopeErrors[1:])
+        self.interceptErrors = [0] + list(interceptErrors[1:])
         self.setContinuousY()
         self.determineError()
         
-        return slopes,x0
+        return [0] + list(slopes[1:]),[0] + list(intercepts[1:])
 
     
     def doMultipleExponentialSquared2coeffsFitting(self):
         """
         
         Going through all the data and calculates the fitting since the first 2 points
+        Every fitting starts from the previous one (see prefixLeastSquaresFitting)
         
         @return: 2 lists of the coefficients of the fitting: A exp((Bx)**2)
         """
         
         
         self.setContinuousX()
-        coeffA = []
-        coeffA.append(0)
-        coeffB = []
-        coeffB.append(0)
+        self.function = self.funcExponentialSquared2coeffs
         
         x= self.discrete_x
         y= self.discrete_y
-        for i in range(2,len(x)+1):
-            temp = Fitting(x[:i],y[:i])
-            temp.exponentialSquared2coeffsFitting()
-            coeffA.append(temp.coefficients[0])
-            coeffB.append(temp.coefficients[1])
-        # I know I am going to repeat the same fitting but its simpler
-        self.exponentialSquared2coeffsFitting()        
+        a, b = exponentialSquaredGuess(x[:2],y[:2])
+        coefficientsList, covariances = prefixLeastSquaresFitting('exponentialSquared2coeffs',x,y,[a,b])
+        coeffA = [0] + [coefficients[0] for coefficients in coefficientsList]
+        # b and -b are the same solution
+        coeffB = [0] + [abs(coefficients[1]) for coefficients in coefficientsList]
+        
+        # the last prefix is all the data
+        self.coefficients = np.array([coeffA[-1],coeffB[-1]])
+        self.covariance = covariances[-1]
         self.setContinuousY()
         self.determineError()
         
@@ -417,6 +467,7 @@ class Fitting(object):
         """
         
         Going through all the data and calculates the fitting since the first 2 points
+        Every fitting starts from the previous one (see prefixLeastSquaresFitting)
         
         @return: return a list of X values when Y is halved
         """
@@ -432,23 +483,19 @@ class Fitting(object):
         
         
         self.setContinuousX()
-        xForYHalveds = []
-        xForYHalveds.append(0)
+        self.function = self.funcExponential1coeffs
         
         halfY = np.max(self.discrete_y)/2
     
         x= self.discrete_x
         y= self.discrete_y
-        for i in range(2,len(x)+1):
-            temp = Fitting(x[:i],y[:i])
-            temp.exponentialFitting1Coeff()
-            
-            #xForYHalved = invFunc([temp.coefficients[0],temp.coefficients[1],0],halfY)
-            xForYHalved = invFunc(temp.coefficients,halfY)
-            xForYHalveds.append(xForYHalved)
-            
-        # I know I am going to repeat the same fitting but its simpler
-        self.exponentialFitting1Coeff()        
+        b, log2 = np.polyfit(x[:2], np.log(y[:2]), 1)
+        coefficientsList, covariances = prefixLeastSquaresFitting('exponential1coeff',x,y,[b])
+        xForYHalveds = [0] + [invFunc(coefficients,halfY) for coefficients in coefficientsList]
+        
+        # the last prefix is all the data
+        self.coefficients = coefficientsList[-1]
+        self.covariance = covariances[-1]
         self.setContinuousY()
         self.determineError()
         
@@ -471,82 +518,123 @@ class Fitting(object):
 #        resolution = 2.5
         self.beta = beta
         self.gamma = gamma
+        self.initialWilsonB = initialWilsonB
+        self.initialWilsonScale = initialWilsonScale
         
         
         # values for dose 0
-        idealWilsonDistributionH2 = [0.0090, 0.0131, 0.0172,0.0213, 0.0254, 0.0295,0.0335, 0.0376, 0.0417,0.0458, 0.0499, 0.0540,0.0581, 0.0622, 0.0663,0.0704, 0.0745, 0.0786,0.0826, 0.0867, 0.0908,0.0949, 0.0990, 0.1031,0.1072, 0.1113, 0.1154,0.1195, 0.1236, 0.1277,0.1318, 0.1358, 0.1399,0.1440, 0.1481, 0.1522,0.1563, 0.1604, 0.1645,0.1686, 0.1727, 0.1768,0.1809, 0.1849, 0.1890,0.1931, 0.1972, 0.2013,0.2054, 0.2095, 0.2136,0.2177, 0.2218, 0.2259,0.2300, 0.2341, 0.2381,0.2422, 0.2463, 0.2504,0.2545, 0.2586, 0.2627,0.2668, 0.2709, 0.2750,0.2791, 0.2832, 0.2873,0.2913, 0.2954, 0.2995,0.3036, 0.3077, 0.3118,0.3159, 0.3200, 0.3241,0.3282, 0.3323, 0.3364,0.3404, 0.3445, 0.3486,0.3527, 0.3568, 0.3609,0.3650, 0.3691, 0.3732,0.3773, 0.3814, 0.3855,0.3896, 0.3936, 0.3977,0.4018, 0.4059, 0.4100,0.4141, 0.4182, 0.4223,0.4264, 0.4305, 0.4346,0.4387, 0.4428, 0.4468,0.4509, 0.4550, 0.4591,0.4632, 0.4673, 0.4714,0.4755, 0.4796, 0.4837,0.4878, 0.4919, 0.4959,0.5000, 0.5041, 0.5082,0.5123, 0.5164, 0.5205,0.5246, 0.5287, 0.5328,0.5369, 0.5410, 0.5451,0.5491, 0.5532, 0.5573,0.5614, 0.5655, 0.5696,0.5737, 0.5778, 0.5819,0.5860, 0.5901, 0.5942,0.5982, 0.6023, 0.6064,0.6105, 0.6146, 0.6187,0.6228, 0.6269, 0.6310,0.6351, 0.6392, 0.6433,0.6474, 0.6514, 0.6555,0.6596, 0.6637, 0.6678,0.6719, 0.6760, 0.6801,0.6842, 0.6883, 0.6924,0.6965, 0.7006, 0.7046,0.7087, 0.7128, 0.7169,0.7210, 0.7251, 0.7292,0.7333, 0.7374, 0.7415,0.7456, 0.7497, 0.7537,0.7578, 0.7619, 0.7660,0.7701, 0.7742, 0.7783,0.7824, 0.7865, 0.7906,0.7947, 0.7988, 0.8029,0.8069, 0.8110, 0.8151,0.8192, 0.8233, 0.8274,0.8315, 0.8356, 0.8397,0.8438, 0.8479, 0.8520,0.8561, 0.8601, 0.8642,0.8683, 0.8724, 0.8765,0.8806, 0.8847, 0.8888,0.8929, 0.8970, 0.9011,0.9052, 0.9092, 0.9133,0.9174, 0.9215, 0.9256,0.9297, 0.9338, 0.9379,0.9420, 0.9461, 0.9502,0.9543, 0.9584, 0.9624,0.9665, 0.9706, 0.9747,0.9788, 0.9829, 0.9870,0.9911, 0.9952, 0.9993,1.0034, 1.0075, 1.0115,1.0156, 1.0197, 1.0238,1.0279, 1.0320, 1.0361,1.0402, 1.0443, 1.0484,1.0525, 1.0566, 1.0607,1.0647, 1.0688, 1.0729,1.0770, 1.0811, 1.0852,1.0893, 1.0934, 1.0975,1.1016, 1.1057, 1.1098,1.1139, 1.1179, 1.1220,1.1261, 1.1302, 1.1343,1.1384, 1.1425, 1.1466,1.1507, 1.1548, 1.1589,1.1630, 1.1670, 1.1711,1.1752, 1.1793, 1.1834,1.1875, 1.1916, 1.1957,1.1998, 1.2039, 1.2080,1.2121, 1.2162, 1.2202,1.2243, 1.2284, 1.2325,1.2366,1.2407,1.2448,1.2489,1.253,1.2571,1.2612,1.2653,1.2694,1.2735,1.2776,1.2817,1.2858,1.2899,1.294,1.2981,1.3022,1.3063,1.3104,1.3145,1.3186,1.3227,1.3268,1.3309,1.335,1.3391,1.3432,1.3473,1.3514,1.3555,1.3596,1.3637,1.3678,1.3719,1.376,1.3801,1.3842,1.3883,1.3924,1.3965,1.4006,1.4047,1.4088,1.4129,1.417,1.4211,1.4252,1.4293,1.4334,1.4375,1.4416,1.4457,1.4498,1.4539,1.458,1.4621,1.4662,1.4703,1.4744,1.4785,1.4826,1.4867,1.4908,1.4949,1.499,1.5031,1.5072,1.5113,1.5154,1.5195,1.5236,1.5277,1.5318,1.5359,1.5400,1.5441,1.5482,1.5523,1.5564,1.5605,1.5646,1.5687,1.5728,1.5769,1.5810,1.5851,1.5892,1.5933,1.5974,1.6015,1.6056,1.6097,1.6138,1.6179,1.6220,1.6261,1.6302,1.6343,1.6384,1.6425,1.6466,1.6507,1.6548,1.6589,1.6630,1.6671,1.6712,1.6753,1.6794,1.6835,1.6876,1.6917,1.6958,1.6999,1.7040,1.7081,1.7122,1.7163,1.7204,1.7245,1.7286,1.7327,1.7368,1.7409,1.7450,1.7491,1.7532,1.7573,1.7614,1.7655,1.7696,1.7737,1.7778,1.7819,1.7860,1.7901,1.7942,1.7983,1.8024,1.8065,1.8106,1.8147,1.8188,1.8229,1.8270,1.8311,1.8352,1.8393,1.8434,1.8475,1.8516,1.8557,1.8598,1.8639,1.8680,1.8721,1.8762,1.8803,1.8844,1.8885,1.8926,1.8967,1.9008,1.9049,1.9090,1.9131,1.9172,1.9213,1.9254,1.9295,1.9336,1.9377,1.9418,1.9459,1.9500,1.9541,1.9582,1.9623,1.9664,1.9705,1.9746,1.9787,1.9828,1.9869,1.9910,1.9951,1.9992,2.0033,2.0074,2.0115,2.0156,2.0197,2.0238,2.0279,2.0320,2.0361,2.0402,2.0443,2.0484,2.0525,2.0566,2.0607,2.0648,2.0689,2.0730,2.0771,2.0812,2.0853,2.0894,2.0935,2.0976,2.1017,2.1058,2.1099,2.1140,2.1181,2.1222,2.1263,2.1304,2.1345,2.1386,2.1427,2.1468,2.1509,2.1550,2.1591,2.1632,2.1673,2.1714,2.1755,2.1796,2.1837,2.1878,2.1919,2.1960,2.2001,2.2042,2.2083,2.2124,2.2165,2.2206,2.2247,2.2288,2.2329,2.2370,2.2411,2.2452,2.2493,2.2534,2.2575,2.2616,2.2657,2.2698,2.2739,2.2780,2.2821,2.2862,2.2903,2.2944,2.2985,2.3026,2.3067,2.3108,2.3149,2.3190,2.3231,2.3272,2.3313,2.3354,2.3395,2.3436,2.3477,2.3518,2.3559,2.3600,2.3641,2.3682,2.3723,2.3764,2.3805,2.3846,2.3887,2.3928,2.3969,2.4010,2.4051,2.4092,2.4133,2.4174,2.4215,2.4256,2.4297,2.4338,2.4379,2.4420,2.4461,2.4502,2.4543,2.4584,2.4625,2.4666,2.4707,2.4748,2.4789,2.4830,2.4871,2.4912,2.4953,2.4994,2.5035,2.5076,2.5117,2.5158,2.5199,2.5240,2.5281,2.5322,2.5363,2.5404,2.5445,2.5486,2.5527,2.5568,2.5609,2.5650,2.5691,2.5732,2.5773,2.5814,2.5855,2.5896,2.5937,2.5978,2.6019,2.6060,2.6101,2.6142,2.6183,2.6224,2.6265,2.6306,2.6347,2.6388,2.6429,2.6470,2.6511,2.6552,2.6593,2.6634,2.6675,2.6716,2.6757,2.6798,2.6839,2.6880,2.6921,2.6962,2.7003,2.7044,2.7085,2.7126,2.7167,2.7208,2.7249,2.7290,2.7331,2.7372,2.7413,2.7454,2.7495,2.7536,2.7577,2.7618,2.7659,2.7700,2.7741,2.7782,2.7823,2.7864,2.7905,2.7946,2.7987,2.8028,2.8069,2.8110,2.8151,2.8192,2.8233,2.8274,2.8315,2.8356,2.8397,2.8438,2.8479,2.8520,2.8561,2.8602,2.8643,2.8684,2.8725]
-        idealWilsonDistributionValue = [117970.000, 100512.023,  80882.992, 62948.516,  57507.758,  61357.430, 72234.063,  89858.945, 109460.930,126917.039, 137405.063, 139655.375,137483.219, 133394.875, 129394.328,125762.617, 121035.289, 116051.805,110836.078, 104613.297,  97322.055, 89836.305,  83216.188,  78146.273, 73459.672,  69471.023,  65299.645, 61581.441,  58510.613,  55865.180, 53658.789,  52101.020,  51070.418, 50092.043,  49350.723,  48151.910, 47058.906,  46675.406,  46597.676, 45924.047,  46080.672,  45937.621, 46096.023,  45896.965,  45990.094, 46123.293,  46343.516,  45936.539, 45715.695,  45109.164,  44549.133, 43634.820,  43566.086,  43451.016, 42696.293,  41173.980,  39972.754, 39166.629,  38020.367,  36810.992, 35497.309,  34194.906,  32992.742, 31585.996,  30211.492,  29119.816, 28151.564,  27386.414,  26232.775, 25235.693,  24318.244,  23707.949, 22821.910,  22182.096,  21694.740, 21236.889,  20733.123,  20323.289, 20073.404,  19932.156,  19631.480, 19223.189,  18920.273,  18557.662, 18134.789,  17926.918,  17909.145, 17908.371,  17781.652,  17634.252, 17607.758,  17273.971,  17132.121, 16953.238,  16883.561,  16615.092, 16435.377,  16423.141,  16351.833, 16278.806,  15998.301,  15795.754, 15589.186,  15561.384,  15467.072, 15476.589,  15331.998,  15028.964, 14745.987,  14509.142,  14445.926, 14254.643,  14111.921,  13900.479, 13785.526,  13686.093,  13464.846, 13304.157,  13084.093,  13114.881, 13089.596,  13244.095,  13117.398, 13140.626,  13031.727,  12999.481, 12835.458,  12954.440,  12937.747, 12936.304,  12825.827,  12995.077, 12994.031,  13036.257,  13006.766, 13057.586,  13010.016,  12891.707, 12966.081,  13114.423,  13119.474, 13065.754,  13052.747,  13214.619, 13376.885,  13386.037,  13244.184, 13225.625,  13203.178,  13157.919, 13058.345,  13089.547,  13236.270, 13356.928,  13294.085,  13322.506, 13356.878,  13574.700,  13741.788, 13988.013,  14126.934,  14226.778, 14096.913,  14083.928,  14170.343, 14351.646,  14494.585,  14485.082, 14514.434,  14622.690,  14725.597, 14840.912,  14869.137,  14947.929, 15039.328,  15069.899,  15058.230, 14892.115,  14829.184,  14854.609, 14911.043,  14950.722,  15113.783, 15211.773,  15205.695,  15024.023, 14926.859,  14948.205,  14968.500, 14961.653,  14880.744,  14853.396, 14715.400,  14625.747,  14476.197, 14315.362,  14115.836,  14177.435, 14214.169,  13756.128,  13478.938, 13409.521,  13313.305,  13191.076, 13068.228,  13143.240,  13034.021, 12844.786,  12565.626,  12494.126, 12431.333,  12224.259,  12045.229, 11934.917,  11999.310,  12092.722, 12073.927,  12000.386,  11492.284, 11340.666,  11261.278,  11170.411, 11033.554,  10920.556,  10805.261, 10749.542,  10633.937,  10553.671, 10396.852,  10345.898,  10439.532, 10444.084,  10338.728,  10137.357, 10024.374,   9960.443,   9843.068,  9813.853,   9774.964,   9722.901,  9668.755,   9489.759,   9437.470,  9337.847,   9232.355,   9143.001,  8946.202,   9061.576,   8927.707,  8833.817,   8559.503,   8737.791,  8741.253,   8734.717,   8730.013,  8553.071,   8567.203,   8448.906,  8348.450,   8372.744,   8420.621,  8534.404,   8515.739,   8391.372,  8376.129,   8364.006,   8370.607,  8053.081,   7885.547,   7949.570,  8098.683,   8009.885,   7884.853,  7912.111,   7977.090,   8038.597,  7984.881,   7943.616,   8002.785,  7840.147,   7771.715,   7704.840,  7606.398,   7499.033,   7380.200,  7353.043,   7373.826,   7386.296,  7445.311,   7298.761,   7163.549,6936.293,6920.410,6888.470,7020.130,   6991.486,6970.270,6894.089,6915.407,6934.171,6726.973509,6686.434089,6646.138977,6606.086698,6566.275791,6526.704799,6487.372279,6448.276792,6409.416909,6370.791212,6332.398289,6294.236737,6256.305161,6218.602176,6181.126405,6143.876477,6106.851032,6070.048718,6033.468188,5997.108108,5960.967148,5925.043987,5889.337314,5853.845824,5818.568219,5783.503211,5748.649519,5714.005869,5679.570996,5645.343641,5611.322553,5577.506491,5543.894217,5510.484504,5477.276131,5444.267885,5411.45856,5378.846957,5346.431885,5314.212159,5282.186601,5250.354043,5218.71332,5187.263276,5156.002763,5124.930639,5094.045767,5063.34702,5032.833276,5002.503419,4972.356343,4942.390945,4912.60613,4883.00081,4853.573904,4824.324336,4795.251038,4766.352947,4737.629007,4709.078169,4680.69939,4652.491632,4624.453866,4596.585067,4568.884216,4541.350301,4513.982317,4486.779263,4459.740146,4432.863977,4406.149774,4379.596562,4353.20337,4326.969234,4300.893196,4274.974301,4249.211605,4223.604165,4198.151045,4172.851316,4147.704053,4122.708338,4097.863257,4073.167902,4048.621371,4024.222768,3999.9712,3975.865781,3951.905632,3928.089876,3904.417643,3880.888068,3857.500292,3834.25346,3811.146723,3788.179236,3765.35016,3742.658662,3720.103911,3697.685085,3675.401363,3653.251931,3631.235981,3609.352708,3587.601312,3565.980999,3544.490978,3523.130465,3501.898679,3480.794844,3459.818189,3438.967947,3418.243358,3397.643663,3377.16811,3356.815951,3336.586442,3316.478844,3296.492423,3276.626448,3256.880193,3237.252936,3217.743962,3198.352556,3179.078011,3159.919621,3140.876688,3121.948515,3103.134411,3084.433688,3065.845663,3047.369657,3029.004995,3010.751005,2992.607021,2974.57238,2956.646424,2938.828495,2921.117945,2903.514126,2886.016394,2868.624111,2851.336641,2834.153351,2817.073615,2800.096808,2783.222311,2766.449505,2749.77778,2733.206524,2716.735134,2700.363007,2684.089545,2667.914153,2651.836241,2635.85522,2619.970507,2604.181522,2588.487688,2572.888431,2557.383182,2541.971373,2526.652442,2511.425828,2496.290977,2481.247334,2466.29435,2451.431479,2436.658177,2421.973905,2407.378127,2392.870308,2378.449919,2364.116433,2349.869327,2335.708079,2321.632173,2307.641093,2293.73433,2279.911374,2266.17172,2252.514868,2238.940317,2225.447571,2212.036139,2198.705528,2185.455254,2172.284831,2159.193778,2146.181617,2133.247872,2120.392072,2107.613745,2094.912426,2082.28765,2069.738956,2057.265885,2044.867982,2032.544794,2020.29587,2008.120763,1996.019028,1983.990223,1972.033909,1960.149647,1948.337005,1936.595551,1924.924856,1913.324493,1901.794038,1890.33307,1878.941171,1867.617923,1856.362914,1845.175733,1834.055969,1823.003218,1812.017075,1801.097139,1790.243011,1779.454294,1768.730594,1758.07152,1747.476681,1736.945691,1726.478165,1716.073721,1705.731978,1695.452558,1685.235086,1675.079189,1664.984495,1654.950636,1644.977245,1635.063957,1625.210411,1615.416246,1605.681105,1596.004632,1586.386472,1576.826276,1567.323694,1557.878377,1548.489982,1539.158165,1529.882586,1520.662904,1511.498784,1502.389891,1493.335892,1484.336455,1475.391253,1466.499958,1457.662246,1448.877793,1440.146279,1431.467384,1422.840792,1414.266187,1405.743256,1397.271688,1388.851173,1380.481403,1372.162073,1363.892878,1355.673517,1347.503688,1339.383095,1331.311439,1323.288427,1315.313764,1307.38716,1299.508325,1291.67697,1283.892811,1276.155562,1268.46494,1260.820666,1253.222459,1245.670041,1238.163138,1230.701474,1223.284777,1215.912776,1208.585202,1201.301787,1194.062264,1186.86637,1179.713841,1172.604415,1165.537835,1158.51384,1151.532174,1144.592583,1137.694813,1130.838611,1124.023727,1117.249913,1110.51692,1103.824504,1097.172418,1090.56042,1083.988269,1077.455724,1070.962547,1064.508501,1058.093349,1051.716857,1045.378793,1039.078924,1032.817021,1026.592855,1020.406198,1014.256824,1008.144509,1002.069029,996.0301617,990.0276876,984.0613867,978.1310412,972.2364343,966.3773506,960.5535761,954.7648979,949.0111047,943.2919861,937.6073332,931.9569382,926.3405948,920.7580977,915.209243,909.6938279,904.2116508,898.7625116,893.346211,887.9625512,882.6113354,877.2923683,872.0054553,866.7504034,861.5270205,856.3351158,851.1744996,846.0449833,840.9463796,835.878502,830.8411655,825.834186,820.8573805,815.9105673,810.9935655,806.1061955,801.2482787,796.4196377,791.620096,786.8494783,782.1076102,777.3943185,772.7094309,768.0527764,763.4241847,758.8234867,754.2505144,749.7051006,745.1870793,740.6962854,736.2325548,731.7957244,727.3856321,723.0021168,718.6450183,714.3141775,710.0094359,705.7306365,701.4776228,697.2502395,693.0483321,688.871747,684.7203317,680.5939345,676.4924046,672.4155921,668.3633481,664.3355246,660.3319743,656.3525511,652.3971094,648.4655048,644.5575936,640.673233,636.8122811,632.9745969,629.16004,625.3684712,621.5997519,617.8537445,614.1303119,610.4293182,606.7506282,603.0941075]
-        
-        self.idealWilsonDistributionH2 = np.array(idealWilsonDistributionH2)
-        self.idealWilsonDistributionValue = np.array(idealWilsonDistributionValue)
-        
-        self.idealWilsonDistributionResolution =  np.sqrt(1./self.idealWilsonDistributionH2) # R = 1/H^2
+        wilson = getIdealWilsonDistribution()
+        self.idealWilsonDistributionH2 = wilson['h2']
+        self.idealWilsonDistributionValue = wilson['value']
+        self.idealWilsonDistributionResolution = wilson['resolution']
         
-
-        idealWilsonDistributionLength=len(idealWilsonDistributionH2)
-        idealWilsonDistributionDeltaH2=(idealWilsonDistributionH2[idealWilsonDistributionLength-1]-\
-                                        idealWilsonDistributionH2[0])/(idealWilsonDistributionLength-1) # step
-        idealWilsonDistributionDeltaH=np.sqrt(idealWilsonDistributionDeltaH2)
-        
-
-        # for this initial scale and B factor
-        self.i0PerBin = idealWilsonDistributionValue * \
-        np.exp(-initialWilsonB*self.idealWilsonDistributionH2/2.)*initialWilsonScale*4*np.pi*self.idealWilsonDistributionH2*idealWilsonDistributionDeltaH
-            
-        # from low resolution to high
-        self.i0AccumulatedPerBin = np.add.accumulate(self.i0PerBin)
-                
-        # need to optimise from here on
+        # for this initial scale and B factor (from low resolution to high)
+        self.i0PerBin, self.i0AccumulatedPerBin = getIdealWilsonI0PerBin(initialWilsonB,initialWilsonScale)
         
     def doTheoreticalIntensityDecayCurve(self,resolution):
         
         self.log.logger.debug("Getting the Theoretical Intensity Decay Curve up to %.2f A"%(resolution))
         
-        self.resolutionLimitIndex = len(self.idealWilsonDistributionResolution)-1
-        for idx,i in enumerate(self.idealWilsonDistributionResolution) :
-            if i < resolution :
-                self.resolutionLimitIndex = idx
-                break
-        
-        doseRange = self.continuous_x
+        self.resolution = resolution
+        self.resolutionLimitIndex = theoreticalResolutionLimitIndices(self.idealWilsonDistributionH2,resolution)[0]
         
-        iOverI0 = []
-        for dose in doseRange :
-            intensityPerBin = self.i0PerBin*np.exp(-self.beta*dose*self.idealWilsonDistributionH2/2.)*np.exp(-(self.gamma*dose)**2)
-            intensityAccumulatedPerBin = np.add.accumulate(intensityPerBin)
-            
-            iOverI0.append(intensityAccumulatedPerBin[self.resolutionLimitIndex]/self.i0AccumulatedPerBin[self.resolutionLimitIndex])
-            #print '%.3e %1.3f'%(dose,iOverI0[-1])
-        
-        self.continuous_y = iOverI0
+        self.continuous_y = self.funcTheoreticalIntensityDecay(None,self.continuous_x)
         self.function = self.funcTheoreticalIntensityDecay
     
     def funcTheoreticalIntensityDecay(self,coeffs,x):
         
-        iOverI0 = []
-        for dose in x :
-            intensityPerBin = self.i0PerBin*np.exp(-self.beta*dose*self.idealWilsonDistributionH2/2.)*np.exp(-(self.gamma*dose)**2)
-            intensityAccumulatedPerBin = np.add.accumulate(intensityPerBin)
-            
-            iOverI0.append(intensityAccumulatedPerBin[self.resolutionLimitIndex]/self.i0AccumulatedPerBin[self.resolutionLimitIndex])
-            #print '%.3e %1.3f'%(dose,iOverI0[-1])
-        
-        return np.array(iOverI0)
-    
+        return theoreticalIntensityDecay(x,self.i0PerBin,self.idealWilsonDistributionH2,self.beta,self.gamma,
+                                         [self.resolutionLimitIndex])[:,0]
     
-    def getTheoreticalDOneHalf(self):
-        
+    def getTheoreticalIntensityDecays(self,doses,resolutions):
+        """
+        I/I0 for several doses and resolution limits at once
         
-        def interpolateXFromY(x0,x1,y0,y1,y):
-            return x0 + ( (x1-x0)*(y-y0) / (y1-y0) )
+        @return: (doses x resolutions) array
+        """
+        indices = theoreticalResolutionLimitIndices(self.idealWilsonDistributionH2,resolutions)
+        return theoreticalIntensityDecay(doses,self.i0PerBin,self.idealWilsonDistributionH2,self.beta,self.gamma,indices)
+    
+    def fitTheoreticalResolution(self,resolution,fitInitialWilsonB=False):
+        """
+        Fits the resolution limit (and the initial Wilson B factor if
+        fitInitialWilsonB) of the theoretical decay set up by
+        calculateTheoreticalIntensityDecay to discrete_x, discrete_y.
+        The accumulated intensities are interpolated between the bins of the
+        ideal Wilson distribution so the model is smooth in the resolution.
+        The resolution alone is fitted by fitTheoreticalResolutionDataSets.
+        
+        @param resolution: initial resolution limit (A)
+        
+        @return: fitted resolution (A), or (resolution, initial Wilson B)
+        if fitInitialWilsonB. nan for the resolution if the fitting did not
+        converge (the decay is left as it was).
+        """
+        h2 = self.idealWilsonDistributionH2
+        doses = np.asarray(self.discrete_x,dtype=np.float64)
+        measured = np.asarray(self.discrete_y,dtype=np.float64)
+        
+        if fitInitialWilsonB :
+            def residuals(p):
+                i0PerBin = idealWilsonI0PerBin(p[1],self.initialWilsonScale)
+                return theoreticalIntensityDecayAtResolutions(doses,i0PerBin,h2,self.beta,self.gamma,[p[0]])[:,0] - measured
+            
+            olderr = np.seterr(over='ignore',invalid='ignore')
+            try :
+                p, ier = opt.leastsq(residuals,[resolution,self.initialWilsonB])
+            finally :
+                np.seterr(**olderr)
+            
+            # resolution and B0 are strongly correlated
+            if not (np.all(np.isfinite(p)) and p[1] >= 0) :
+                self.log.logger.warning("Initial Wilson B factor fitting failed (%.2f): B factor kept at %.2f"%(p[1],self.initialWilsonB))
+                return self.fitTheoreticalResolution(resolution), self.initialWilsonB
+            fittedResolution = abs(p[0])
+            self.initialWilsonB = p[1]
+            self.i0PerBin, self.i0AccumulatedPerBin = getIdealWilsonI0PerBin(self.initialWilsonB,self.initialWilsonScale)
+        else :
+            fittedResolution = fitTheoreticalResolutionDataSets(doses[np.newaxis,:],measured[np.newaxis,:],self.beta,self.gamma,
+                                                                self.initialWilsonB,resolution)[0]
+            if not np.isfinite(fittedResolution) :
+                self.log.logger.warning("Theoretical Intensity Decay resolution fitting did not converge from %.2f A"%resolution)
+                return np.nan
+        
+        self.resolution = fittedResolution
+        self.resolutionLimitIndex = theoreticalResolutionLimitIndices(h2,self.resolution)[0]
+        self.log.logger.debug("Theoretical Intensity Decay fitted up to %.2f A, InitialWilsonB=%.2f"%(self.resolution,self.initialWilsonB))
+        
+        self.function = self.funcTheoreticalIntensityDecayAtResolution
+        self.setContinuousY()
+        self.determineError()
         
-        for i,v in enumerate(self.continuous_y) :
-            if v < 0.5 :
-                break
+        if fitInitialWilsonB :
+            return self.resolution, self.initialWilsonB
+        return self.resolution
+    
+    def funcTheoreticalIntensityDecayAtResolution(self,coeffs,x):
         
-        d = interpolateXFromY(self.continuous_x[i-1],self.continuous_x[i],self.continuous_y[i-1],self.continuous_y[i],0.5)
+        return theoreticalIntensityDecayAtResolutions(x,self.i0PerBin,self.idealWilsonDistributionH2,self.beta,self.gamma,
+                                                      [self.resolution])[:,0]
+    
+    def getTheoreticalDOneHalf(self,maximumExpansions=64):
+        """
+        Dose where the theoretical decay (see doTheoreticalIntensityDecayCurve
+        and fitTheoreticalResolution) is 0.5, by theoreticalDsOneHalfBatch
+        with the bracket starting at max(continuous_x).
         
-        self.log.logger.debug('Theoretical Interpolated Dose 1/2 = %.2e Gy'% d)
+        @return: D1/2 (Gy), nan if the decay does not reach 0.5
+        """
+        startDose = np.max(self.continuous_x)
+        if not startDose > 0 :
+            startDose = 1.
+        interpolated = self.function == self.funcTheoreticalIntensityDecayAtResolution
+        d = theoreticalDsOneHalfBatch(self.beta,self.gamma,self.initialWilsonB,self.resolution,interpolated,
+                                      startDose=startDose,maximumExpansions=maximumExpansions)[0]
+        
+        if np.isnan(d) :
+            self.log.logger.error('Theoretical decay does not reach 0.5 below %.2e Gy: no Dose 1/2'%(startDose*2**maximumExpansions))
+        else :
+            self.log.logger.debug('Theoretical Dose 1/2 = %.2e Gy'% d)
         
         return d
       
@@ -606,6 +694,640 @@ class Fitting(object):
     
     
     
+#################################################
+# Theoretical intensity decay: all doses and resolution limits at once
+#################################################
+
+def theoreticalResolutionLimitIndices(h2,resolutions):
+    """
+    Index of the first bin of the ideal Wilson distribution beyond each
+    resolution limit (the last bin if the limit is beyond the table)
+    
+    @param h2: H^2 = 1/d^2 of the bins (increasing)
+    @param resolutions: resolution limits (A)
+    """
+    resolutions = np.atleast_1d(np.asarray(resolutions,dtype=np.float64))
+    indices = np.searchsorted(h2,1./resolutions**2,side='right')
+    return np.minimum(indices,len(h2)-1)
+
+def theoreticalResolutionLimitBins(h2,resolutions,interpolated=False):
+    """
+    Bins up to which the intensities are accumulated for every resolution
+    limit: all the bins up to lowerBins, plus the fraction weights of the next one.
+     - not interpolated: up to the first bin beyond the limit
+       (theoreticalResolutionLimitIndices), weights 0
+     - interpolated: linear interpolation at H^2 = 1/resolution^2, so I/I0 is
+       continuous in the resolution limits
+    
+    @return: (lowerBins, weights) arrays with the shape of resolutions
+    """
+    resolutions = np.atleast_1d(np.asarray(resolutions,dtype=np.float64))
+    if not interpolated :
+        lowerBins = theoreticalResolutionLimitIndices(h2,resolutions)
+        return lowerBins, np.zeros(lowerBins.shape)
+    h2Limits = 1./resolutions**2
+    lowerBins = np.clip(np.searchsorted(h2,h2Limits,side='right')-1,0,len(h2)-2)
+    weights = np.clip((h2Limits - h2[lowerBins]) / (h2[lowerBins+1] - h2[lowerBins]),0.,1.)
+    return lowerBins, weights
+
+def theoreticalDecayTables(doses,i0PerBin,h2,betas,gammas):
+    """
+    Parts of the theoretical decay of n sets of (beta, gamma, intensities at
+    dose 0) that do not depend on the resolution limit:
+    I(D) = I0 * exp(-beta*D*H^2/2) * exp(-(gamma*D)^2) accumulated bin by bin
+    
+    @param doses: (n x m) array
+    @param i0PerBin: (n x bins) array, intensity per bin at dose 0
+    
+    @return: (intensityAccumulatedPerBin, i0AccumulatedPerBin, scaleDecay),
+    (n x m x bins), (n x 1 x bins) and (n x m x 1) arrays
+    """
+    doses = np.asarray(doses,dtype=np.float64)
+    i0PerBin = np.asarray(i0PerBin,dtype=np.float64)
+    betas = np.asarray(betas,dtype=np.float64)
+    gammas = np.asarray(gammas,dtype=np.float64)
+    intensityAccumulatedPerBin = np.cumsum(i0PerBin[:,np.newaxis,:] * np.exp(-(betas[:,np.newaxis]*doses/2.)[:,:,np.newaxis]*h2),axis=2)
+    # exp(-(gamma*D)^2) does not depend on the resolution
+    return intensityAccumulatedPerBin, np.cumsum(i0PerBin,axis=1)[:,np.newaxis,:], np.exp(-(gammas[:,np.newaxis]*doses)**2)[:,:,np.newaxis]
+
+def theoreticalDecayAtResolutionLimits(tables,lowerBins,weights):
+    """
+    I/I0 from the tables of theoreticalDecayTables up to k resolution limits per set
+    
+    @param lowerBins, weights: (n x k) arrays (see theoreticalResolutionLimitBins)
+    
+    @return: (n x m x k) array
+    """
+    intensityAccumulatedPerBin, i0AccumulatedPerBin, scaleDecay = tables
+    
+    def accumulated(accumulatedPerBin):
+        sets = np.arange(accumulatedPerBin.shape[0])[:,np.newaxis,np.newaxis]
+        points = np.arange(accumulatedPerBin.shape[1])[np.newaxis,:,np.newaxis]
+        upperBins = np.minimum(lowerBins+1,accumulatedPerBin.shape[2]-1)
+        return (1-weights[:,np.newaxis,:])*accumulatedPerBin[sets,points,lowerBins[:,np.newaxis,:]] + \
+            weights[:,np.newaxis,:]*accumulatedPerBin[sets,points,upperBins[:,np.newaxis,:]]
+    
+    return accumulated(intensityAccumulatedPerBin) / accumulated(i0AccumulatedPerBin) * scaleDecay
+
+def theoreticalDecay(doses,i0PerBin,h2,betas,gammas,lowerBins,weights):
+    """
+    I/I0 of the intensity accumulated up to resolution limits for n sets of
+    I(D) = I0 * exp(-beta*D*H^2/2) * exp(-(gamma*D)^2), as one
+    (sets x doses x bins) expression truncated at the highest resolution limit.
+    All the theoretical decays of this module go through it.
+    
+    @param doses: (n x m) array
+    @param i0PerBin: (n x bins) array, intensity per bin at dose 0
+    @param h2: H^2 of the bins
+    @param lowerBins, weights: (n x k) arrays (see theoreticalResolutionLimitBins)
+    
+    @return: (n x m x k) array
+    """
+    lowerBins = np.asarray(lowerBins)
+    numberOfBins = min(np.max(lowerBins) + 2,len(h2))
+    tables = theoreticalDecayTables(doses,np.asarray(i0PerBin,dtype=np.float64)[:,:numberOfBins],
+                                    np.asarray(h2,dtype=np.float64)[:numberOfBins],betas,gammas)
+    return theoreticalDecayAtResolutionLimits(tables,lowerBins,np.asarray(weights,dtype=np.float64))
+
+def theoreticalIntensityDecay(doses,i0PerBin,h2,beta,gamma,resolutionLimitIndices):
+    """
+    I/I0 of the intensity accumulated up to every resolution limit (bin
+    indices, see theoreticalResolutionLimitIndices) for one beta and gamma
+    
+    @param i0PerBin: intensity per bin of the ideal Wilson distribution at dose 0
+    
+    @return: (doses x resolution limits) array
+    """
+    doses = np.atleast_1d(np.asarray(doses,dtype=np.float64))
+    resolutionLimitIndices = np.atleast_1d(resolutionLimitIndices)
+    return theoreticalDecay(doses[np.newaxis,:],np.asarray(i0PerBin)[np.newaxis,:],h2,[beta],[gamma],
+                            resolutionLimitIndices[np.newaxis,:],np.zeros((1,len(resolutionLimitIndices))))[0]
+
+def theoreticalIntensityDecayAtResolutions(doses,i0PerBin,h2,beta,gamma,resolutions):
+    """
+    As theoreticalIntensityDecay, but the accumulated intensities are
+    linearly interpolated between bins at H^2 = 1/resolution^2, so I/I0 is
+    continuous in the resolution limits.
+    
+    @return: (doses x resolutions) array
+    """
+    doses = np.atleast_1d(np.asarray(doses,dtype=np.float64))
+    lowerBins, weights = theoreticalResolutionLimitBins(np.asarray(h2,dtype=np.float64),resolutions,interpolated=True)
+    return theoreticalDecay(doses[np.newaxis,:],np.asarray(i0PerBin)[np.newaxis,:],h2,[beta],[gamma],
+                            lowerBins[np.newaxis,:],weights[np.newaxis,:])[0]
+
+#################################################
+# Batched fitting: many curves with the same x
+#################################################
+
+def prefixLinearFitting(x,y,intercept=True):
+    """
+    Least squares fitting of y = a*x + b (or y = a*x if intercept is False)
+    for every prefix x[:i], y[:i], i = 1..n, from cumulative sums.
+    
+    @return: (slopes, intercepts, slopeErrors, interceptErrors) arrays of n;
+    element i-1 is the fitting of the first i points. nan where the fitting
+    (or its error) is not defined: i < 2 (i < 3 for errors with intercept).
+    intercepts are 0 if intercept is False.
+    """
+    x = np.asarray(x,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64)
+    n = np.arange(1,len(x)+1,dtype=np.float64)
+    
+    if intercept :
+        # centred on the first point for the stability of the sums
+        x0, y0 = x[0], y[0]
+        x = x - x0
+        y = y - y0
+    
+    sxx = np.cumsum(x*x)
+    sxy = np.cumsum(x*y)
+    syy = np.cumsum(y*y)
+    
+    olderr = np.seterr(divide='ignore',invalid='ignore')
+    try :
+        if intercept :
+            sx = np.cumsum(x)
+            sy = np.cumsum(y)
+            determinant = n*sxx - sx*sx
+            determinant[n < 2] = np.nan
+            slopes = (n*sxy - sx*sy) / determinant
+            intercepts = (sy - slopes*sx) / n
+            residuals = syy - 2*slopes*sxy - 2*intercepts*sy + slopes**2*sxx + 2*slopes*intercepts*sx + n*intercepts**2
+            variance = np.maximum(residuals,0) / (n - 2)
+            variance[n < 3] = np.nan
+            slopeErrors = np.sqrt(variance * n / determinant)
+            # back to the original origin
+            intercepts = intercepts + y0 - slopes*x0
+            interceptErrors = np.sqrt(variance * (sxx + 2*x0*sx + n*x0**2) / determinant)
+        else :
+            sxx[n < 2] = np.nan
+            slopes = sxy / sxx
+            intercepts = np.zeros(len(x))
+            residuals = syy - 2*slopes*sxy + slopes**2*sxx
+            variance = np.maximum(residuals,0) / (n - 1)
+            slopeErrors = np.sqrt(variance / sxx)
+            interceptErrors = np.zeros(len(x))
+    finally :
+        np.seterr(**olderr)
+    
+    return slopes, intercepts, slopeErrors, interceptErrors
+
+def weightedLinearFittingBatch(x,y,weights):
+    """
+    Weighted least squares y = a*x + b for every row of y at once,
+    from the closed form of the normal equations.
+    
+    @param x: array of m abscissas (e.g. doses), or (n x m) array, one per row
+    @param y: (n x m) array, one curve per row
+    @param weights: (n x m) array, 1/sigma^2 of y. 0 for points to ignore.
+    
+    @return: (slopes, intercepts, slopeErrors), arrays of n. nan for the rows
+    with less than 2 points.
+    """
+    x = np.asarray(x,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64)
+    weights = np.asarray(weights,dtype=np.float64)
+    y = np.where(weights > 0, y, 0)
+    
+    s = weights.sum(axis=1)
+    if x.ndim == 1 :
+        sx = np.dot(weights,x)
+        sxx = np.dot(weights,x*x)
+    else :
+        # padding of the rows may be nan
+        x = np.where(weights > 0, x, 0)
+        sx = (weights*x).sum(axis=1)
+        sxx = (weights*x*x).sum(axis=1)
+    sy = (weights*y).sum(axis=1)
+    if x.ndim == 1 :
+        sxy = (weights*y).dot(x)
+    else :
+        sxy = (weights*y*x).sum(axis=1)
+    
+    determinant = s*sxx - sx*sx
+    valid = ((weights > 0).sum(axis=1) >= 2) & (determinant > 0)
+    determinant = np.where(valid, determinant, np.nan)
+    
+    slopes = (s*sxy - sx*sy) / determinant
+    intercepts = (sxx*sy - sx*sxy) / determinant
+    slopeErrors = np.sqrt(s / determinant)
+    return slopes, intercepts, slopeErrors
+
+def reflectionDecayFittingBatch(doses,intensities,sigmas):
+    """
+    Fits ln(I) = ln(I0) + a*D for every reflection (rows of intensities).
+    Points are weighted by (I/sigma)^2, i.e. 1/sigma^2 of ln(I);
+    non positive intensities are ignored.
+    
+    @param doses: m doses (one per wedge)
+    @param intensities, sigmas: (reflections x m) arrays
+    
+    @return: (slopes, intercepts, slopeErrors) per reflection
+    """
+    intensities = np.asarray(intensities,dtype=np.float64)
+    sigmas = np.asarray(sigmas,dtype=np.float64)
+    positive = (intensities > 0) & (sigmas > 0)
+    logIntensities = np.log(np.where(positive, intensities, 1.))
+    weights = np.where(positive, (intensities / np.where(positive, sigmas, 1.))**2, 0.)
+    return weightedLinearFittingBatch(doses,logIntensities,weights)
+
+def reflectionDecayProfile(slopes,slopeErrors,resolution,numberOfBins=10):
+    """
+    Resolution dependent damage: per reflection decay slopes averaged in bins
+    of s^2 = 1/d^2 with the same number of reflections.
+    
+    For I(D) = I0 exp(-beta*D*s^2/2) exp(-(gamma*D)^2) the slope of a reflection
+    is linear in s^2, so beta = -2 * d(slope)/d(s^2).
+    
+    @return: (binS2, binSlopes, binSlopeErrors, beta)
+    """
+    valid = np.isfinite(slopes) & np.isfinite(slopeErrors) & (slopeErrors > 0)
+    slopes = slopes[valid]
+    weights = 1. / slopeErrors[valid]**2
+    s2 = 1. / np.asarray(resolution,dtype=np.float64)[valid]**2
+    
+    numberOfBins = max(1,min(numberOfBins,len(s2)))
+    edges = np.percentile(s2, np.linspace(0,100,numberOfBins+1))
+    bins = np.clip(np.searchsorted(edges,s2,side='right')-1, 0, numberOfBins-1)
+    
+    weightSums = np.bincount(bins,weights=weights,minlength=numberOfBins)
+    nonEmpty = weightSums > 0
+    weightSums = weightSums[nonEmpty]
+    binSlopes = np.bincount(bins,weights=weights*slopes,minlength=numberOfBins)[nonEmpty] / weightSums
+    binS2 = np.bincount(bins,weights=weights*s2,minlength=numberOfBins)[nonEmpty] / weightSums
+    binSlopeErrors = 1. / np.sqrt(weightSums)
+    
+    if len(binS2) >= 2 :
+        gradient, intercept, gradientError = weightedLinearFittingBatch(binS2,binSlopes[np.newaxis,:],
+                                                                        (1./binSlopeErrors**2)[np.newaxis,:])
+        beta = -2 * gradient[0]
+    else :
+        beta = np.nan
+    return binS2, binSlopes, binSlopeErrors, beta
+
+    
+def wilsonScaling(intensities,resolution,lowResolutionLimit=4.5,numberOfBins=20):
+    """
+    Overall B-factor and scale of a data set from its Wilson plot against the
+    ideal Wilson distribution:
+        <I>(H2) = scale * ideal(H2) * exp(-B*H2/2) , H2 = 1/d^2
+    ln(<I>/ideal) is fitted against H2 in bins with the same number of
+    reflections, weighted by the number of reflections per bin.
+    
+    @param intensities, resolution: arrays of I and d (A) of the reflections
+    @param lowResolutionLimit: reflections with d > lowResolutionLimit are ignored
+    
+    @return: (scale, overallBFactor) or (None, None) if there are not enough data
+    """
+    intensities = np.asarray(intensities,dtype=np.float64)
+    h2 = 1. / np.asarray(resolution,dtype=np.float64)**2
+    wilson = getIdealWilsonDistribution()
+    selected = (h2 >= 1./lowResolutionLimit**2) & (h2 <= wilson['h2'][-1])
+    intensities = intensities[selected]
+    h2 = h2[selected]
+    if len(h2) < 2*numberOfBins :
+        return None, None
+    
+    edges = np.percentile(h2, np.linspace(0,100,numberOfBins+1))
+    bins = np.clip(np.searchsorted(edges,h2,side='right')-1, 0, numberOfBins-1)
+    counts = np.bincount(bins,minlength=numberOfBins).astype(np.float64)
+    nonEmpty = counts > 0
+    binH2 = np.bincount(bins,weights=h2,minlength=numberOfBins)[nonEmpty] / counts[nonEmpty]
+    binIntensities = np.bincount(bins,weights=intensities,minlength=numberOfBins)[nonEmpty] / counts[nonEmpty]
+    counts = counts[nonEmpty]
+    
+    ideal = np.interp(binH2,wilson['h2'],wilson['value'])
+    positive = binIntensities > 0
+    if positive.sum() < 2 :
+        return None, None
+    
+    slopes, intercepts, slopeErrors = weightedLinearFittingBatch(binH2,
+                                                                 np.log(np.where(positive,binIntensities/ideal,1.))[np.newaxis,:],
+                                                                 np.where(positive,counts,0.)[np.newaxis,:])
+    return np.exp(intercepts[0]), -2 * slopes[0]
+
+def exponentialSquared2coeffsFittingBatch(x,y,weights,iterations=50,tolerance=1e-8):
+    """
+    Weighted least squares y = a*exp((b*x)**2) for every row of weights at once:
+    start from the linear fitting of log(y) against x**2, then Gauss-Newton
+    iterations with the 2x2 normal equations of all the rows together.
+    A row converges when its steps are below tolerance (relative to a and to
+    1 + b*max(x)), and is not iterated any more.
+    
+    @param x: array of m abscissas
+    @param y: array of m values, or (n x m) array
+    @param weights: (n x m) array, 0 for points to ignore
+    
+    @return: (a, b) arrays of n, b >= 0. nan where the fitting is not defined,
+    did not converge or ended with a weighted sum of squared residuals larger
+    than the one of the starting point.
+    """
+    x = np.asarray(x,dtype=np.float64)
+    weights = np.asarray(weights,dtype=np.float64)
+    y = np.asarray(y,dtype=np.float64) * np.ones(weights.shape)
+    x2 = x**2
+    xMax = np.max(np.abs(x))
+    
+    def weightedSquaredResiduals(a,b):
+        return (weights*(y - a[:,np.newaxis]*np.exp(x2*(b**2)[:,np.newaxis]))**2).sum(axis=1)
+    
+    olderr = np.seterr(all='ignore')
+    try :
+        positive = y > 0
+        k, logA, kErrors = weightedLinearFittingBatch(x2,np.log(np.where(positive,y,1.)),np.where(positive,weights,0.))
+        a = np.exp(logA)
+        b = np.sqrt(np.abs(k))
+        startSquaredResiduals = weightedSquaredResiduals(a,b)
+        
+        converged = np.zeros(len(a),dtype=bool)
+        for iteration in range(iterations) :
+            active = ~converged & np.isfinite(a) & np.isfinite(b)
+            if not np.any(active) :
+                break
+            e = np.exp(x2*(b**2)[:,np.newaxis])
+            residuals = y - a[:,np.newaxis]*e
+            ja = e
+            jb = 2*(a*b)[:,np.newaxis]*x2*e
+            saa = (weights*ja*ja).sum(axis=1)
+            sab = (weights*ja*jb).sum(axis=1)
+            sbb = (weights*jb*jb).sum(axis=1)
+            sar = (weights*ja*residuals).sum(axis=1)
+            sbr = (weights*jb*residuals).sum(axis=1)
+            determinant = saa*sbb - sab*sab
+            solvable = active & np.isfinite(determinant) & (determinant > 0)
+            determinant = np.where(solvable,determinant,1.)
+            aSteps = np.where(solvable,(sbb*sar - sab*sbr) / determinant,0.)
+            bSteps = np.where(solvable,(saa*sbr - sab*sar) / determinant,0.)
+            a = a + aSteps
+            b = b + bSteps
+            converged |= active & (np.abs(aSteps) <= tolerance*np.abs(a)) & \
+                (np.abs(bSteps)*xMax <= tolerance*(1 + np.abs(b)*xMax))
+        
+        valid = converged & np.isfinite(a) & np.isfinite(b) & \
+            (weightedSquaredResiduals(a,b) <= startSquaredResiduals*(1 + tolerance))
+    finally :
+        np.seterr(**olderr)
+    
+    return np.where(valid,a,np.nan), np.where(valid,np.abs(b),np.nan)
+
+def _broadcastSets(*values):
+    """
+    Parameters of n sets as 1-D float arrays of n
+    """
+    return [np.asarray(v,dtype=np.float64) for v in np.broadcast_arrays(*[np.atleast_1d(v) for v in values])]
+
+def theoreticalDecayBatch(doses,betas,gammas,initialWilsonBs,resolutions,interpolated=False):
+    """
+    I/I0 of the theoretical decay for n sets of (beta, gamma, initial Wilson B,
+    resolution limit), each at its own doses (theoreticalDecay)
+    
+    @param doses: (n x m) array
+    @param interpolated: see theoreticalResolutionLimitBins
+    
+    @return: (n x m) array
+    """
+    betas, gammas, initialWilsonBs, resolutions = _broadcastSets(betas,gammas,initialWilsonBs,resolutions)
+    h2 = getIdealWilsonDistribution()['h2']
+    lowerBins, weights = theoreticalResolutionLimitBins(h2,resolutions,interpolated)
+    # the scale cancels out in I/I0
+    return theoreticalDecay(doses,idealWilsonI0PerBin(initialWilsonBs),h2,betas,gammas,
+                            lowerBins[:,np.newaxis],weights[:,np.newaxis])[:,:,0]
+
+def theoreticalDsOneHalfBatch(betas,gammas,initialWilsonBs,resolutions,interpolated=False,
+                              startDose=1e6,maximumExpansions=64,iterations=64,tolerance=1e-12):
+    """
+    D1/2 of the theoretical decay for arrays of beta, gamma, initial Wilson B
+    and resolution limit at once: the crossings of 0.5 are bracketed from
+    [0, startDose], doubling the upper doses, and refined by bisection until
+    all the brackets are narrower than tolerance (relative).
+    
+    @param interpolated: see theoreticalResolutionLimitBins
+    
+    @return: array of D1/2 (Gy), nan where the decay does not reach 0.5
+    """
+    betas, gammas, initialWilsonBs, resolutions = _broadcastSets(betas,gammas,initialWilsonBs,resolutions)
+    h2 = getIdealWilsonDistribution()['h2']
+    i0PerBin = idealWilsonI0PerBin(initialWilsonBs)
+    lowerBins, weights = theoreticalResolutionLimitBins(h2,resolutions,interpolated)
+    lowerBins, weights = lowerBins[:,np.newaxis], weights[:,np.newaxis]
+    
+    def decay(doses,sets):
+        return theoreticalDecay(doses[:,np.newaxis],i0PerBin[sets],h2,betas[sets],gammas[sets],lowerBins[sets],weights[sets])[:,0,0]
+    
+    olderr = np.seterr(all='ignore')
+    try :
+        allSets = np.arange(len(betas))
+        lowDoses = np.zeros(len(betas))
+        highDoses = np.ones(len(betas)) * startDose
+        for expansion in range(maximumExpansions) :
+            bracketed = decay(highDoses,allSets) <= 0.5
+            if np.all(bracketed) :
+                break
+            lowDoses = np.where(bracketed,lowDoses,highDoses)
+            highDoses = np.where(bracketed,highDoses,2*highDoses)
+        else :
+            # crossings bracketed by the last doubling
+            bracketed = decay(highDoses,allSets) <= 0.5
+        
+        # only the bracketed crossings are refined
+        sets = np.flatnonzero(bracketed)
+        lowDoses, highDoses = lowDoses[sets], highDoses[sets]
+        for iteration in range(iterations) :
+            if np.all(highDoses - lowDoses <= tolerance*highDoses) :
+                break
+            doses = (lowDoses + highDoses) / 2
+            below = decay(doses,sets) <= 0.5
+            highDoses = np.where(below,doses,highDoses)
+            lowDoses = np.where(below,lowDoses,doses)
+    finally :
+        np.seterr(**olderr)
+    
+    dOneHalf = np.empty(len(betas))
+    dOneHalf.fill(np.nan)
+    dOneHalf[sets] = (lowDoses + highDoses) / 2
+    return dOneHalf
+
+def bootstrapDecayParameters(doses,bFactors,relativeScales,resolution,numberOfReplicates=2000,
+                             initialWilsonB=None,randomState=None):
+    """
+    Bootstrap replicates of beta (B = beta*D + B0), alpha (scale = S0*exp((alpha*D)**2))
+    and of the theoretical D1/2. The wedges are resampled with replacement:
+    a replicate is the number of draws of every wedge, used as the weights
+    of batched fittings of all the replicates at once.
+    
+    @param initialWilsonB: initial B of the theoretical decay, None for the
+    B0 of every replicate
+    
+    @return: dictionary beta, initialBFactor, alpha, dOneHalf -> arrays of
+    numberOfReplicates (nan for the degenerate replicates)
+    """
+    if randomState is None :
+        randomState = np.random
+    doses = np.asarray(doses,dtype=np.float64)
+    numberOfWedges = len(doses)
+    counts = randomState.multinomial(numberOfWedges,[1./numberOfWedges]*numberOfWedges,
+                                     size=numberOfReplicates).astype(np.float64)
+    
+    olderr = np.seterr(all='ignore')
+    try :
+        betas, initialBFactors, betaErrors = weightedLinearFittingBatch(doses,np.asarray(bFactors,dtype=np.float64)*np.ones(counts.shape),counts)
+    finally :
+        np.seterr(**olderr)
+    scales, alphas = exponentialSquared2coeffsFittingBatch(doses,relativeScales,counts)
+    if initialWilsonB is None :
+        initialWilsonBs = initialBFactors
+    else :
+        initialWilsonBs = initialWilsonB
+    dOneHalf = theoreticalDsOneHalfBatch(betas,alphas,initialWilsonBs,resolution)
+    
+    return {'beta' : betas, 'initialBFactor' : initialBFactors, 'alpha' : alphas, 'dOneHalf' : dOneHalf}
+
+def confidenceInterval(replicates,level=0.95):
+    """
+    Percentile interval of the finite replicates
+    
+    @return: (low, high), (nan, nan) if there are no finite replicates
+    """
+    replicates = np.asarray(replicates,dtype=np.float64)
+    replicates = replicates[np.isfinite(replicates)]
+    if len(replicates) == 0 :
+        return np.nan, np.nan
+    low, high = np.percentile(replicates,[50*(1-level),50*(1+level)])
+    return low, high
+
+#################################################
+# Several data sets (e.g. the CSV files of a campaign) at once
+#################################################
+
+def padDataSets(seriesList):
+    """
+    Ragged list of series (one per data set) as an (n x longest) array
+    padded with nan
+    """
+    paddedSeries = np.empty((len(seriesList),max([len(series) for series in seriesList])))
+    paddedSeries.fill(np.nan)
+    for i,series in enumerate(seriesList) :
+        paddedSeries[i,:len(series)] = series
+    return paddedSeries
+
+def fitTheoreticalResolutionDataSets(doses,relativeIntensities,betas,gammas,initialWilsonBs,resolutions,
+                                     iterations=50,tolerance=1e-6,relativeStep=1e-4,maximumHalvings=10):
+    """
+    Resolution limit of the theoretical decay (interpolated between bins, see
+    theoreticalResolutionLimitBins) fitted to the relative intensities of every
+    data set at once. The tables of the decay do not depend on the resolution
+    (theoreticalDecayTables): they are computed once, and the Gauss-Newton
+    iterations (numerical derivatives, steps limited to 25% of the resolution
+    and halved while they increase the sum of squared residuals) only
+    interpolate them. A data set converges when its step is below tolerance
+    (relative to the resolution).
+    
+    @param doses, relativeIntensities: (n x m) arrays, nan for padding
+    @param resolutions: initial resolution limits (A)
+    
+    @return: array of n fitted resolution limits, nan for the data sets
+    without points or that did not converge
+    """
+    doses = np.asarray(doses,dtype=np.float64)
+    relativeIntensities = np.asarray(relativeIntensities,dtype=np.float64)
+    valid = np.isfinite(doses) & np.isfinite(relativeIntensities)
+    doses = np.where(valid,doses,0.)
+    relativeIntensities = np.where(valid,relativeIntensities,0.)
+    betas, gammas, initialWilsonBs, resolutions = _broadcastSets(betas,gammas,initialWilsonBs,resolutions,np.ones(len(doses)))[:4]
+    wilson = getIdealWilsonDistribution()
+    h2 = wilson['h2']
+    lowestResolution, highestResolution = wilson['resolution'][-1], wilson['resolution'][0]
+    
+    olderr = np.seterr(all='ignore')
+    try :
+        tables = theoreticalDecayTables(doses,idealWilsonI0PerBin(initialWilsonBs),h2,betas,gammas)
+        
+        def residuals(resolutions):
+            lowerBins, weights = theoreticalResolutionLimitBins(h2,resolutions[:,np.newaxis],interpolated=True)
+            return np.where(valid,theoreticalDecayAtResolutionLimits(tables,lowerBins,weights)[:,:,0] - relativeIntensities,0.)
+        
+        squaredResiduals = (residuals(resolutions)**2).sum(axis=1)
+        converged = np.zeros(len(resolutions),dtype=bool)
+        for iteration in range(iterations) :
+            active = ~converged
+            if not np.any(active) :
+                break
+            steps = relativeStep*resolutions
+            derivatives = (residuals(resolutions+steps) - residuals(resolutions-steps)) / (2*steps[:,np.newaxis])
+            corrections = -(derivatives*residuals(resolutions)).sum(axis=1) / (derivatives*derivatives).sum(axis=1)
+            corrections = np.where(np.isfinite(corrections) & active,corrections,0.)
+            corrections = np.clip(corrections,-0.25*resolutions,0.25*resolutions)
+            
+            for halving in range(maximumHalvings) :
+                newResolutions = np.clip(resolutions + corrections,lowestResolution,highestResolution)
+                newSquaredResiduals = (residuals(newResolutions)**2).sum(axis=1)
+                worse = ~(newSquaredResiduals <= squaredResiduals)
+                if not np.any(worse & active) :
+                    break
+                corrections = np.where(worse,corrections/2,corrections)
+            # no descent left: the step is 0
+            newResolutions = np.where(worse,resolutions,newResolutions)
+            converged |= active & (np.abs(newResolutions - resolutions) <= tolerance*resolutions)
+            squaredResiduals = np.where(worse,squaredResiduals,newSquaredResiduals)
+            resolutions = newResolutions
+    finally :
+        np.seterr(**olderr)
+    
+    fitted = converged & valid.any(axis=1) & np.isfinite(squaredResiduals)
+    return np.where(fitted,resolutions,np.nan)
+
+def fitDataSets(doses,bFactors,alphas,resolutions,betas=None,initialBFactors=None,
+                relativeIntensities=None,numberOfContinuousPoints=100):
+    """
+    Fittings and curves of several data sets at once, the series padded to the
+    longest one and masked.
+     - B factor: linear fitting against the dose (as Fitting.linearFitting2Coeffs)
+     - relative scale: exp(-(alpha*D)**2) (as funcExponentialSquaredNegative1coeffs)
+     - relative intensity: theoretical decay and its D1/2 (as
+       calculateTheoreticalIntensityDecay, doTheoreticalIntensityDecayCurve and
+       getTheoreticalDOneHalf), with the resolution limit fitted if
+       relativeIntensities are given (as fitTheoreticalResolution)
+    
+    @param doses, bFactors: lists of series, one per data set
+    @param alphas, resolutions: one value per data set
+    @param betas, initialBFactors: one value per data set for the theoretical
+    decay, None for the slopes and intercepts of the B factor fittings
+    @param relativeIntensities: list of series, None not to fit the resolution
+    
+    @return: dictionary of columns, one value or row per data set:
+    bFactorSlope, bFactorIntercept, resolution, dOneHalf, continuousDose,
+    continuousBFactor, continuousInvRelativeScale, continuousRelativeIntensity
+    """
+    paddedDoses = padDataSets(doses)
+    paddedBFactors = padDataSets(bFactors)
+    valid = np.isfinite(paddedDoses) & np.isfinite(paddedBFactors)
+    bFactorSlopes, bFactorIntercepts, bFactorSlopeErrors = weightedLinearFittingBatch(paddedDoses,np.where(valid,paddedBFactors,0.),
+                                                                                      valid.astype(np.float64))
+    if betas is None :
+        betas = bFactorSlopes
+    if initialBFactors is None :
+        initialBFactors = bFactorIntercepts
+    alphas = np.asarray(alphas,dtype=np.float64)
+    resolutions = np.asarray(resolutions,dtype=np.float64) * np.ones(len(paddedDoses))
+    
+    # as Fitting.setContinuousX: from 0 to the highest dose
+    continuousDoses = np.linspace(0,1,numberOfContinuousPoints)[np.newaxis,:] * np.nanmax(paddedDoses,axis=1)[:,np.newaxis]
+    
+    interpolated = relativeIntensities is not None
+    if interpolated :
+        resolutions = fitTheoreticalResolutionDataSets(paddedDoses,padDataSets(relativeIntensities),
+                                                       betas,alphas,initialBFactors,resolutions)
+    
+    return {'bFactorSlope' : bFactorSlopes,
+            'bFactorIntercept' : bFactorIntercepts,
+            'resolution' : resolutions,
+            'dOneHalf' : theoreticalDsOneHalfBatch(betas,alphas,initialBFactors,resolutions,interpolated),
+            'continuousDose' : continuousDoses,
+            'continuousBFactor' : bFactorSlopes[:,np.newaxis]*continuousDoses + bFactorIntercepts[:,np.newaxis],
+            'continuousInvRelativeScale' : np.exp(-(alphas[:,np.newaxis]*continuousDoses)**2),
+            'continuousRelativeIntensity' : theoreticalDecayBatch(continuousDoses,betas,alphas,initialBFactors,resolutions,interpolated)}
+
 ###############################################################################
 # TESTS
 ###########################
@@ -0,0 +1,670 @@
+'''
+Reflection files handling
+
+Reads the XDS reflection files straight into numpy arrays, so the
+analysis works on columns rather than on lists of reflections.
+
+@author: leal
+'''
+
+import os
+import re
+import pickle
+import hashlib
+import numpy as np
+
+
+# Items that XDS writes as integers
+XDS_INTEGER_ITEMS = ['H', 'K', 'L']
+
+# Canonical record of a reflection in memory and in the binary cache (18 bytes)
+REFLECTION_DTYPE = np.dtype([('H', np.int16), ('K', np.int16), ('L', np.int16),
+                             ('IOBS', np.float32), ('SIGMA(IOBS)', np.float32),
+                             ('RESOLUTION', np.float32)])
+
+# XDS items that can be appended to REFLECTION_DTYPE (float32)
+REFLECTION_OPTIONAL_ITEMS = ['ZD', 'PSI', 'CORR']
+
+# bytes read from the start and the end of a file to build its content hash
+FILE_KEY_HASH_BLOCK_SIZE = 65536
+
+# default size (bytes) of the chunks read by iterXdsAsciiHkl
+XDS_ASCII_HKL_CHUNK_SIZE = 8 * 1024 * 1024
+
+# keyword=value pairs in the XDS header lines, e.g.:
+# !FORMAT=XDS_ASCII    MERGE=FALSE    FRIEDEL'S_LAW=TRUE
+xdsHeaderKeywordPattern = re.compile(r"([^\s=]+)=\s*(.*?)\s*(?=\s[^\s=]+=|$)")
+
+
+def parseXdsAsciiHklHeader(header):
+    """
+    Parses the header of a XDS_ASCII.HKL file
+
+    @param header: header text (everything before !END_OF_HEADER)
+
+    @return: (keywords, items)
+        keywords: dictionary keyword -> value (as string)
+        items: list of item names sorted by column, e.g. ['H','K','L','IOBS','SIGMA(IOBS)',...]
+    """
+
+    keywords = {}
+    itemColumns = {}
+    for line in header.splitlines():
+        line = line.strip()
+        if not line.startswith('!'):
+            continue
+        for key, value in xdsHeaderKeywordPattern.findall(line[1:]):
+            if key.startswith('ITEM_'):
+                itemColumns[key[len('ITEM_'):]] = int(value)
+            else:
+                keywords[key] = value
+
+    items = sorted(itemColumns.keys(), key=lambda name: itemColumns[name])
+    return keywords, items
+
+
+def buildXdsAsciiHklDtype(items, extraFields=()):
+    """
+    Builds the structured dtype for the items in the header
+
+    @param extraFields: names of float columns to be added after the items
+    """
+    fields = []
+    for name in items:
+        if name in XDS_INTEGER_ITEMS:
+            fields.append((name, np.int32))
+        else:
+            fields.append((name, np.float64))
+    for name in extraFields:
+        fields.append((name, np.float64))
+    return np.dtype(fields)
+
+
+def _readXdsAsciiHklHeader(inp):
+    """
+    Reads the header lines of an open XDS_ASCII.HKL up to !END_OF_HEADER
+
+    @return: (keywords, items, complete) with keywords and items as in
+        parseXdsAsciiHklHeader. complete is False if the header stops (at a
+        record or at the end of the file) before !END_OF_HEADER
+    """
+    header = []
+    # readline: the records are read from the same file object afterwards
+    for line in iter(inp.readline, ''):
+        if line.find("!END_OF_HEADER") >= 0:
+            return parseXdsAsciiHklHeader(''.join(header)) + (True,)
+        if not line.startswith("!"):
+            break
+        header.append(line)
+    return parseXdsAsciiHklHeader(''.join(header)) + (False,)
+
+
+def readXdsAsciiHklHeader(xdsIntensitiesFilePath):
+    """
+    Parses only the header of a XDS_ASCII.HKL
+
+    @return: (keywords, items) as in parseXdsAsciiHklHeader
+    """
+    inp = open(xdsIntensitiesFilePath, "r")
+    try:
+        keywords, items, complete = _readXdsAsciiHklHeader(inp)
+    finally:
+        inp.close()
+    return keywords, items
+
+
+def iterXdsAsciiHkl(xdsIntensitiesFilePath, chunkSize=XDS_ASCII_HKL_CHUNK_SIZE, extraFields=()):
+    """
+    Reads the XDS_ASCII.HKL in chunks of about chunkSize bytes.
+
+    The records of each chunk are converted in a single call, so memory
+    depends on chunkSize and not on the number of reflections.
+
+    @param extraFields: names of float columns to be allocated (filled with nan)
+        in the returned arrays, e.g. the resolution of the reflection.
+
+    @return: generator of (keywords, reflections) where reflections is a
+        structured array with the reflections of one chunk
+
+    @raise ValueError: if the file is not a complete XDS_ASCII.HKL (no header,
+        no items, a malformed record or no !END_OF_DATA). Chunks read before
+        the error have already been yielded.
+    """
+
+    inp = open(xdsIntensitiesFilePath, "r")
+    try:
+        keywords, items, complete = _readXdsAsciiHklHeader(inp)
+        if not complete:
+            raise ValueError("No !END_OF_HEADER in %s" % xdsIntensitiesFilePath)
+        if len(items) == 0:
+            raise ValueError("No !ITEM_ in the header of %s" % xdsIntensitiesFilePath)
+        dtype = buildXdsAsciiHklDtype(items, extraFields)
+        numberOfItems = len(items)
+
+        endOfData = False
+        while not endOfData:
+            lines = inp.readlines(chunkSize)
+            if len(lines) == 0:
+                raise ValueError("No !END_OF_DATA in %s" % xdsIntensitiesFilePath)
+            dataLines = []
+            for line in lines:
+                if line.startswith("!"):
+                    if line.find("!END_OF_DATA") >= 0:
+                        endOfData = True
+                        break
+                    continue
+                dataLines.append(line)
+
+            values = np.fromstring(''.join(dataLines), dtype=np.float64, sep=' ')
+            if values.size % numberOfItems != 0:
+                raise ValueError("Malformed reflection records in %s" % xdsIntensitiesFilePath)
+            values = values.reshape(-1, numberOfItems)
+
+            reflections = np.empty(values.shape[0], dtype=dtype)
+            for column, name in enumerate(items):
+                reflections[name] = values[:, column]
+            for name in extraFields:
+                reflections[name] = np.nan
+            yield keywords, reflections
+    finally:
+        inp.close()
+
+
+class IntensityAccumulator(object):
+    """
+    Running sums of the intensities of reflections fed chunk by chunk
+
+    Only reflections with I > 0 and sigma(I) > 0 are accounted:
+        - iSum and numberOfReflections for d >= resolution (all d if resolution is None)
+        - per shell counts, sums of I and sums of I/sigma for the shells defined
+          by shellLimits (A). Reflections are binned on 1/d^2 with a single
+          searchsorted/bincount per chunk, whatever the number of shells.
+    """
+
+    def __init__(self, resolution=None, shellLimits=()):
+        self.resolution = resolution
+
+        self.iSum = 0.0
+        self.numberOfReflections = 0
+
+        # shells from low to high resolution: 1/d^2 edges in increasing order
+        # shell k holds limit[k-1] > d >= limit[k] ; a limit of 0 takes all reflections
+        self.shellLimits = np.sort(np.asarray(shellLimits, dtype=np.float64))[::-1]
+        self.shellEdges = np.empty(len(self.shellLimits))
+        self.shellEdges.fill(np.inf)
+        positive = self.shellLimits > 0
+        self.shellEdges[positive] = 1. / self.shellLimits[positive] ** 2
+        # last bin keeps reflections beyond the highest resolution limit
+        self.shellCounts = np.zeros(len(self.shellLimits) + 1, dtype=np.int64)
+        self.shellISums = np.zeros(len(self.shellLimits) + 1, dtype=np.float64)
+        self.shellIOverSigmaSums = np.zeros(len(self.shellLimits) + 1, dtype=np.float64)
+
+    def add(self, i, sigma, d):
+        """
+        Accumulates the arrays i, sigma(i) and d of a chunk of reflections
+        """
+        selection = (i > 0) & (sigma > 0)
+        if self.resolution is not None:
+            cutoff = selection & (d >= self.resolution)
+        else:
+            cutoff = selection
+        self.iSum += i[cutoff].sum(dtype=np.float64)
+        self.numberOfReflections += int(np.count_nonzero(cutoff))
+
+        if len(self.shellLimits) > 0:
+            iSelected = np.asarray(i[selection], dtype=np.float64)
+            sigmaSelected = np.asarray(sigma[selection], dtype=np.float64)
+            dSelected = np.asarray(d[selection], dtype=np.float64)
+            shellIndices = np.searchsorted(self.shellEdges, 1. / dSelected ** 2, side='left')
+            numberOfBins = len(self.shellCounts)
+            self.shellCounts += np.bincount(shellIndices, minlength=numberOfBins)
+            self.shellISums += np.bincount(shellIndices, weights=iSelected, minlength=numberOfBins)
+            self.shellIOverSigmaSums += np.bincount(shellIndices, weights=iSelected / sigmaSelected, minlength=numberOfBins)
+
+    def getShellStatistics(self):
+        """
+        Statistics per resolution shell from the accumulated sums
+
+        @return: dictionary of arrays, one entry per shell limit (from low to high resolution):
+            shellLimits
+            numberOfReflections, averageIntensity, averageIOverSigma : limit[k-1] > d >= limit[k]
+            cumulativeNumberOfReflections, cumulativeAverageIntensity,
+            cumulativeAverageIOverSigma : d >= limit[k]
+        """
+        n = len(self.shellLimits)
+        counts = self.shellCounts[:n].astype(np.float64)
+        cumulativeCounts = np.cumsum(self.shellCounts)[:n].astype(np.float64)
+
+        errorSettings = np.seterr(divide='ignore', invalid='ignore')
+        statistics = {
+            'shellLimits': self.shellLimits,
+            'numberOfReflections': self.shellCounts[:n],
+            'averageIntensity': self.shellISums[:n] / counts,
+            'averageIOverSigma': self.shellIOverSigmaSums[:n] / counts,
+            'cumulativeNumberOfReflections': np.cumsum(self.shellCounts)[:n],
+            'cumulativeAverageIntensity': np.cumsum(self.shellISums)[:n] / cumulativeCounts,
+            'cumulativeAverageIOverSigma': np.cumsum(self.shellIOverSigmaSums)[:n] / cumulativeCounts,
+        }
+        np.seterr(**errorSettings)
+        return statistics
+
+
+def shellStatistics(i, sigma, d, shellLimits):
+    """
+    Sums, counts, mean I and mean I/sigma for an arbitrary set of resolution
+    shells in one pass over the reflections.
+
+    @return: see IntensityAccumulator.getShellStatistics
+    """
+    accumulator = IntensityAccumulator(shellLimits=shellLimits)
+    accumulator.add(i, sigma, d)
+    return accumulator.getShellStatistics()
+
+
+def frameStatistics(zd, i, sigma, d, resolution=None):
+    """
+    Average intensity per frame (image) of a wedge, binned on ZD.
+    XDS image n spans n-1 <= ZD < n. As in IntensityAccumulator only
+    I > 0, sigma(I) > 0 and d >= resolution are accounted.
+
+    @return: (frames, numberOfReflections, averageIntensity) for the frames
+        with reflections
+    """
+    selected = (i > 0) & (sigma > 0)
+    if resolution is not None:
+        selected &= d >= resolution
+    frames = np.floor(zd[selected]).astype(np.int64) + 1
+    if len(frames) == 0:
+        return np.array([], dtype=np.int64), np.array([]), np.array([])
+    firstFrame = frames.min()
+    counts = np.bincount(frames - firstFrame)
+    iSums = np.bincount(frames - firstFrame, weights=i[selected])
+    withReflections = counts > 0
+    return (np.arange(firstFrame, firstFrame + len(counts))[withReflections],
+            counts[withReflections].astype(np.float64),
+            iSums[withReflections] / counts[withReflections])
+
+
+def crystGen(cell):
+    """
+    c-------------------------------------------------
+    c    Callculation of reciprocal lattice parameters and
+    c     orthogonal matrix of crystal orientation
+    c    Am(3,3) -  3*3 - matrics
+    c       a*  b*cos(gama*)  c*cos(beta*)
+    c       0   b*sin(gama*) -c*sin(beta*)cosAlpha
+    c       0       0         1/c
+    c
+    c===================================================
+
+    @param cell: a,b,c,alpha,beta,gamma (angles in degrees)
+
+    @return: 3x3 array
+    """
+
+    a,b,c,alpha,beta,gamma = cell
+
+    alpha = alpha * np.pi/180
+    beta = beta * np.pi/180
+    gamma = gamma * np.pi/180
+
+    cosAlpha = np.cos(alpha)
+    sinAlpha = np.sin(alpha)
+    cosBeta = np.cos(beta)
+    sinBeta = np.sin(beta)
+    cosGamma = np.cos(gamma)
+    sinGamma = np.sin(gamma)
+
+    vol=a*b*c*np.sqrt(1.-cosAlpha**2-cosBeta**2-cosGamma**2+2.*cosAlpha*cosBeta*cosGamma)
+
+    ar=b*c*sinAlpha/vol
+    br=a*c*sinBeta/vol
+    cr=a*b*sinGamma/vol
+
+    cosalfar=(cosBeta*cosGamma-cosAlpha)/(sinBeta*sinGamma)
+    cosbetar=(cosAlpha*cosGamma-cosBeta)/(sinAlpha*sinGamma)
+    cosgamar=(cosAlpha*cosBeta-cosGamma)/(sinAlpha*sinBeta)
+
+    alfar=np.arccos(cosalfar)
+    betar=np.arccos(cosbetar)
+    gamar=np.arccos(cosgamar)
+
+    am = np.array([[ar, br*np.cos(gamar), cr*np.cos(betar)],
+                   [ 0.0, br*np.sin(gamar), -cr*np.sin(betar)*cosAlpha],
+                   [ 0.0, 0.0, 1.0/c]])
+
+    return am
+
+
+def getResolution(hkl, reciprocalMat):
+    """
+    Resolution of a whole array of reflections in one call
+
+    s = 1/d^2 = |Am * hkl|^2
+
+    @param hkl: Nx3 array of Miller indices (or a single h,k,l)
+    @param reciprocalMat: 3x3 matrix from crystGen
+
+    @return: (d, invDSquared) arrays of length N
+    """
+
+    hkl = np.atleast_2d(np.asarray(hkl, dtype=np.float64))
+    xyz = np.dot(hkl, np.asarray(reciprocalMat).T)
+    invDSquared = np.einsum('ij,ij->i', xyz, xyz)
+    d = 1. / np.sqrt(invDSquared)
+    return d, invDSquared
+
+
+def getHkl(reflections):
+    """
+    Nx3 array of Miller indices from a structured array of reflections
+    """
+    return np.column_stack((reflections['H'], reflections['K'], reflections['L']))
+
+
+# Generators of the Laue groups (with the inversion) acting on (h,k,l) columns
+_INVERSION = [[-1, 0, 0], [0, -1, 0], [0, 0, -1]]
+_TWOFOLD_A = [[1, 0, 0], [0, -1, 0], [0, 0, -1]]
+_TWOFOLD_B = [[-1, 0, 0], [0, 1, 0], [0, 0, -1]]
+_TWOFOLD_C = [[-1, 0, 0], [0, -1, 0], [0, 0, 1]]
+_FOURFOLD_C = [[0, -1, 0], [1, 0, 0], [0, 0, 1]]
+_THREEFOLD_C = [[0, 1, 0], [-1, -1, 0], [0, 0, 1]]
+_THREEFOLD_DIAGONAL = [[0, 0, 1], [1, 0, 0], [0, 1, 0]]
+# (h,k,l) -> (k,h,-l) for the 321 classes, (h,k,l) -> (-k,-h,-l) for the 312 classes
+_TWOFOLD_AB = [[0, 1, 0], [1, 0, 0], [0, 0, -1]]
+_TWOFOLD_A_MINUS_B = [[0, -1, 0], [-1, 0, 0], [0, 0, -1]]
+
+# Trigonal space groups of the classes 312, 31m, -31m
+TRIGONAL_312_SPACE_GROUPS = [149, 151, 153, 157, 159, 162, 163]
+
+# offset and base used to pack a (h,k,l) in an int64 key
+HKL_KEY_OFFSET = 2 ** 15
+HKL_KEY_BASE = 2 ** 16
+
+
+def getLaueGroupOperators(spaceGroupNumber):
+    """
+    Rotation matrices of the Laue group of a space group (Friedel pairs
+    are equivalent). Trigonal and hexagonal groups in the hexagonal setting.
+
+    @return: array (numberOfOperators, 3, 3) of integers
+    """
+    n = int(spaceGroupNumber)
+    if n <= 2:
+        generators = []
+    elif n <= 15:
+        generators = [_TWOFOLD_B]
+    elif n <= 74:
+        generators = [_TWOFOLD_C, _TWOFOLD_B]
+    elif n <= 88:
+        generators = [_FOURFOLD_C]
+    elif n <= 142:
+        generators = [_FOURFOLD_C, _TWOFOLD_A]
+    elif n <= 148:
+        generators = [_THREEFOLD_C]
+    elif n <= 167:
+        if n in TRIGONAL_312_SPACE_GROUPS:
+            generators = [_THREEFOLD_C, _TWOFOLD_A_MINUS_B]
+        else:
+            generators = [_THREEFOLD_C, _TWOFOLD_AB]
+    elif n <= 176:
+        generators = [_THREEFOLD_C, _TWOFOLD_C]
+    elif n <= 194:
+        generators = [_THREEFOLD_C, _TWOFOLD_C, _TWOFOLD_AB]
+    elif n <= 206:
+        generators = [_TWOFOLD_C, _TWOFOLD_B, _THREEFOLD_DIAGONAL]
+    elif n <= 230:
+        generators = [_FOURFOLD_C, _TWOFOLD_A, _THREEFOLD_DIAGONAL]
+    else:
+        raise ValueError("Invalid space group number: %s" % spaceGroupNumber)
+
+    generators = [np.array(g, dtype=np.int64) for g in generators + [_INVERSION]]
+    # closure of the generators
+    operators = {np.identity(3, dtype=np.int64).tostring(): np.identity(3, dtype=np.int64)}
+    newOperators = list(operators.values())
+    while len(newOperators) > 0:
+        products = []
+        for op in newOperators:
+            for g in generators:
+                product = np.dot(g, op)
+                if product.tostring() not in operators:
+                    operators[product.tostring()] = product
+                    products.append(product)
+        newOperators = products
+    return np.array(list(operators.values()))
+
+
+def getUniqueReflectionKeys(hkl, operators):
+    """
+    Symmetry reduced key of each reflection: the largest int64 packing of
+    the (h,k,l) among its equivalents, so equivalent reflections (and
+    Friedel mates) share the key.
+
+    @param hkl: Nx3 array of Miller indices
+    @param operators: as returned by getLaueGroupOperators
+
+    @return: array of N int64 keys
+    """
+    hkl = np.asarray(hkl, dtype=np.int64)
+    # one operator at a time: memory stays in N, whatever the number of operators
+    keys = None
+    for operator in np.asarray(operators, dtype=np.int64):
+        equivalents = np.dot(hkl, operator.T) + HKL_KEY_OFFSET
+        operatorKeys = (equivalents[:, 0] * HKL_KEY_BASE + equivalents[:, 1]) * HKL_KEY_BASE + equivalents[:, 2]
+        if keys is None:
+            keys = operatorKeys
+        else:
+            np.maximum(keys, operatorKeys, out=keys)
+    return keys
+
+
+def getHklFromKeys(keys):
+    """
+    Inverse of the packing in getUniqueReflectionKeys
+
+    @return: Nx3 array of Miller indices
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    return np.column_stack((keys // HKL_KEY_BASE ** 2 - HKL_KEY_OFFSET,
+                            (keys // HKL_KEY_BASE) % HKL_KEY_BASE - HKL_KEY_OFFSET,
+                            keys % HKL_KEY_BASE - HKL_KEY_OFFSET))
+
+
+def mergeEquivalentReflections(keys, i, sigma, d):
+    """
+    Merges the observations sharing the same key (1/sigma^2 weighted mean).
+    Observations with sigma(I) <= 0 are ignored.
+
+    @return: (uniqueKeys, i, sigma, d) with one entry per unique key (sorted)
+    """
+    valid = sigma > 0
+    keys = keys[valid]
+    sigma = np.asarray(sigma[valid], dtype=np.float64)
+    uniqueKeys, inverse = np.unique(keys, return_inverse=True)
+    weights = 1.0 / sigma ** 2
+    weightSums = np.bincount(inverse, weights=weights)
+    mergedI = np.bincount(inverse, weights=weights * i[valid]) / weightSums
+    mergedSigma = 1.0 / np.sqrt(weightSums)
+    mergedD = np.bincount(inverse, weights=d[valid]) / np.bincount(inverse)
+    return uniqueKeys, mergedI, mergedSigma, mergedD
+
+
+def buildCommonReflectionTable(keysList, iList, sigmaList, dList):
+    """
+    Matches the merged reflections of several wedges.
+
+    @param keysList, iList, sigmaList, dList: one array per wedge as returned
+        by mergeEquivalentReflections (keys unique within a wedge)
+
+    @return: (keys, d, intensities, sigmas) for the reflections present in
+        all the wedges: keys and d have one entry per reflection,
+        intensities and sigmas are (reflections x wedges) arrays
+    """
+    numberOfWedges = len(keysList)
+    allKeys = np.concatenate(keysList)
+    wedgeIndices = np.repeat(np.arange(numberOfWedges), [len(k) for k in keysList])
+
+    keys, inverse = np.unique(allKeys, return_inverse=True)
+    common = np.bincount(inverse, minlength=len(keys)) == numberOfWedges
+
+    # position of each common reflection in the output arrays (-1 if not common)
+    rows = np.cumsum(common) - 1
+    rows[~common] = -1
+    selected = rows[inverse] >= 0
+    rowIndices = rows[inverse][selected]
+    columnIndices = wedgeIndices[selected]
+
+    numberOfCommonReflections = int(common.sum())
+    intensities = np.empty((numberOfCommonReflections, numberOfWedges))
+    sigmas = np.empty((numberOfCommonReflections, numberOfWedges))
+    intensities[rowIndices, columnIndices] = np.concatenate(iList)[selected]
+    sigmas[rowIndices, columnIndices] = np.concatenate(sigmaList)[selected]
+    d = np.empty(numberOfCommonReflections)
+    d[rowIndices] = np.concatenate(dList)[selected]
+
+    return keys[common], d, intensities, sigmas
+
+
+def getReflectionDtype(optionalItems=()):
+    """
+    REFLECTION_DTYPE followed by the optional items, e.g. ['ZD']
+
+    @raise ValueError: if an item is not in REFLECTION_OPTIONAL_ITEMS
+    """
+    fields = REFLECTION_DTYPE.descr
+    for name in optionalItems:
+        if name not in REFLECTION_OPTIONAL_ITEMS:
+            raise ValueError("Unknown optional reflection item: %s (valid: %s)"
+                             % (name, ", ".join(REFLECTION_OPTIONAL_ITEMS)))
+        fields.append((name, np.float32))
+    return np.dtype(fields)
+
+
+def toReflectionArray(reflections, dtype=REFLECTION_DTYPE):
+    """
+    Converts a structured array of reflections (e.g. from iterXdsAsciiHkl)
+    to the canonical record. Fields missing in reflections are set to nan.
+    """
+    compact = np.empty(len(reflections), dtype=dtype)
+    for name in dtype.names:
+        if name in reflections.dtype.names:
+            compact[name] = reflections[name]
+        else:
+            compact[name] = np.nan
+    return compact
+
+
+def readReflections(xdsIntensitiesFilePath, reciprocalMat=None, optionalItems=(),
+                    chunkSize=XDS_ASCII_HKL_CHUNK_SIZE):
+    """
+    Reads the XDS_ASCII.HKL into the canonical record (getReflectionDtype).
+
+    The file is converted chunk by chunk, so apart from the result only one
+    chunk is held in double precision at a time.
+
+    @param reciprocalMat: from crystGen. If given the RESOLUTION of the
+        reflections is calculated, otherwise it is nan.
+
+    @return: (keywords, reflections) or (None, None) if the file is not a
+        complete XDS_ASCII.HKL
+    """
+
+    dtype = getReflectionDtype(optionalItems)
+    keywords = None
+    chunks = []
+    try:
+        for keywords, chunk in iterXdsAsciiHkl(xdsIntensitiesFilePath, chunkSize):
+            compact = toReflectionArray(chunk, dtype)
+            if reciprocalMat is not None:
+                compact['RESOLUTION'], _ = getResolution(getHkl(chunk), reciprocalMat)
+            chunks.append(compact)
+    except ValueError:
+        # truncated or malformed (see iterXdsAsciiHkl)
+        return None, None
+
+    return keywords, np.concatenate(chunks)
+
+
+def getFileKey(filePath, *extra):
+    """
+    Key identifying the contents of a file: size, mtime and a md5 of
+    the first and last blocks of the file.
+
+    @param extra: other values the cached data depends on (e.g. the cell)
+    """
+    stat = os.stat(filePath)
+    md5 = hashlib.md5()
+    inp = open(filePath, "rb")
+    md5.update(inp.read(FILE_KEY_HASH_BLOCK_SIZE))
+    if stat.st_size > FILE_KEY_HASH_BLOCK_SIZE:
+        inp.seek(max(FILE_KEY_HASH_BLOCK_SIZE, stat.st_size - FILE_KEY_HASH_BLOCK_SIZE))
+        md5.update(inp.read(FILE_KEY_HASH_BLOCK_SIZE))
+    inp.close()
+    return {'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'md5': md5.hexdigest(),
+            'extra': [float(i) for i in extra]}
+
+
+def saveReflectionsCache(cacheFilePath, reflections, key):
+    """
+    Saves the compact array of reflections to cacheFilePath (.npy) and the
+    key of the source file beside it (<cacheFilePath>.key).
+
+    Files are written to a temporary name and renamed, so that a reader
+    never sees a partial cache.
+    """
+    temporaryFilePath = cacheFilePath + '.tmp'
+    outFile = open(temporaryFilePath, "wb")
+    np.save(outFile, reflections)
+    outFile.close()
+    os.rename(temporaryFilePath, cacheFilePath)
+
+    outFile = open(temporaryFilePath, "wb")
+    pickle.dump(key, outFile)
+    outFile.close()
+    os.rename(temporaryFilePath, cacheFilePath + '.key')
+
+
+def loadReflectionsCache(cacheFilePath, key, dtype=REFLECTION_DTYPE, mmapMode='r'):
+    """
+    Loads the cached reflections (memory-mapped) if the stored key
+    matches key and the cache holds records of dtype.
+
+    @return: array of reflections or None if there is no valid cache
+    """
+    keyFilePath = cacheFilePath + '.key'
+    if not os.path.exists(cacheFilePath) or not os.path.exists(keyFilePath):
+        return None
+    try:
+        inp = open(keyFilePath, "rb")
+        cachedKey = pickle.load(inp)
+        inp.close()
+        if cachedKey != key:
+            return None
+        reflections = np.load(cacheFilePath, mmap_mode=mmapMode)
+    except Exception:
+        return None
+    if reflections.dtype != dtype:
+        return None
+    return reflections
+
+
+if __name__ == '__main__':
+
+    import sys
+    import time
+
+    if len(sys.argv) < 2:
+        print 'Usage: ' + sys.argv[0] + ' <XDS_ASCII.HKL>'
+        sys.exit()
+
+    start = time.time()
+    keywords, reflections = readReflections(sys.argv[1])
+    if reflections is None:
+        print 'Not a complete XDS_ASCII.HKL: ' + sys.argv[1]
+        sys.exit(1)
+    print 'Read %d reflections in %.3f s' % (len(reflections), time.time() - start)
+    print 'Items:', reflections.dtype.names
+    print 'Space group:', keywords.get('SPACE_GROUP_NUMBER')
+    print 'Cell:', keywords.get('UNIT_CELL_CONSTANTS')
@@ -0,0 +1,197 @@
+'''
+XDS log files parsing
+
+Tables of the XDS log files are read in one pass into numpy arrays
+(one array per column).
+
+@author: leal
+'''
+
+import re
+import numpy as np
+
+
+# Columns of the table COMPLETENESS AND QUALITY OF DATA SET in CORRECT.LP
+# Older XDS versions write Rmrgd-F where newer ones write CC(1/2)
+CORRECT_LP_SHELL_COLUMNS = ['resolutionLimit',
+                            'numberOfReflectionsObserved', 'numberOfReflectionsUnique', 'numberOfReflectionsPossible',
+                            'completenessOfData', 'rFactorObserved', 'rFactorExpected',
+                            'numberOfReflectionsCompared', 'iOverSigma', 'rMeas',
+                            'rMrgdF', 'anomalousCorrelation', 'sigAno', 'nAno']
+CORRECT_LP_SHELL_COLUMNS_CC = CORRECT_LP_SHELL_COLUMNS[:10] + ['ccOneHalf'] + CORRECT_LP_SHELL_COLUMNS[11:]
+
+# columns written as percentages (stored as fractions)
+CORRECT_LP_PERCENTAGE_COLUMNS = ['completenessOfData', 'rFactorObserved', 'rFactorExpected', 'rMeas',
+                                 'rMrgdF', 'ccOneHalf', 'anomalousCorrelation']
+
+# values written by XDS for the shells without data (-99.9% and -99.00), read as nan
+CORRECT_LP_EMPTY_SHELL_VALUES = [-99.9, -99.0]
+
+# version of the parsed table, part of the keys of the caches built from it
+CORRECT_LP_SHELL_TABLE_VERSION = 2
+
+correctLpTableTitle = 'COMPLETENESS AND QUALITY OF DATA SET'
+# a row of the table: resolution limit (or total) followed by the values
+correctLpShellRowPattern = re.compile(r"^[ \t]*(\d+\.\d+|total)((?:[ \t]+-?\d+\.?\d*[%*]?)+)[ \t]*$", re.MULTILINE)
+
+
+def parseCorrectLpShellTable(contents):
+    """
+    Parses the first COMPLETENESS AND QUALITY OF DATA SET table of CORRECT.LP
+
+    @param contents: text of CORRECT.LP
+
+    @return: (shells, total)
+        shells: dictionary column name -> array with one value per resolution shell
+            (nan for the values of empty shells, see CORRECT_LP_EMPTY_SHELL_VALUES)
+        total: dictionary column name -> value of the total row
+        ({}, {}) if there is no complete table
+    """
+
+    start = contents.find(correctLpTableTitle)
+    if start < 0:
+        return {}, {}
+    end = contents.find('\n    total', start)
+    if end < 0:
+        return {}, {}
+    end = contents.find('\n', end + 1)
+    if end < 0:
+        end = len(contents)
+    table = contents[start:end]
+
+    if table.find('CC(1/2)') >= 0:
+        columns = CORRECT_LP_SHELL_COLUMNS_CC
+    else:
+        columns = CORRECT_LP_SHELL_COLUMNS
+
+    rows = correctLpShellRowPattern.findall(table)
+    if len(rows) == 0 or rows[-1][0] != 'total':
+        return {}, {}
+
+    # one go for all the values: '%' and '*' (significant CC(1/2)) removed
+    values = np.fromstring(' '.join([row[1] for row in rows]).replace('%', ' ').replace('*', ' '),
+                           dtype=np.float64, sep=' ')
+    numberOfValues = len(columns) - 1
+    if values.size != numberOfValues * len(rows):
+        return {}, {}
+    values = values.reshape(len(rows), numberOfValues)
+    values[np.in1d(values, CORRECT_LP_EMPTY_SHELL_VALUES).reshape(values.shape)] = np.nan
+
+    shells = {'resolutionLimit': np.array([float(row[0]) for row in rows[:-1]])}
+    total = {}
+    for column, name in enumerate(columns[1:]):
+        if name in CORRECT_LP_PERCENTAGE_COLUMNS:
+            values[:, column] /= 100
+        shells[name] = values[:-1, column]
+        total[name] = values[-1, column]
+    return shells, total
+
+
+def readCorrectLpShellTable(xdsLogFilePath):
+    """
+    Reads CORRECT.LP and parses its shell table (see parseCorrectLpShellTable)
+    """
+    inp = open(xdsLogFilePath, "r")
+    contents = inp.read()
+    inp.close()
+    return parseCorrectLpShellTable(contents)
+
+
+def correctLpShellIndices(resolutionLimits, shellLimits):
+    """
+    Rows of the CORRECT.LP shell table standing for given resolution shell
+    limits (e.g. xds_resolution_shells): XDS picks the shell limits of each
+    wedge from its own resolution range, the row with the nearest limit
+    (in 1/d^2) gives the same shells for every wedge.
+
+    @param resolutionLimits: shells['resolutionLimit'] of parseCorrectLpShellTable
+    @param shellLimits: resolution limits (A)
+
+    @return: array of row indices, one per shell limit, -1 for the limits
+    beyond the highest resolution row (by more than half of its shell) or <= 0
+    """
+    resolutionLimits = np.asarray(resolutionLimits, dtype=np.float64)
+    shellLimits = np.atleast_1d(np.asarray(shellLimits, dtype=np.float64))
+    if len(resolutionLimits) == 0:
+        return -np.ones(len(shellLimits), dtype=int)
+
+    rowEdges = 1. / resolutionLimits ** 2
+    positive = shellLimits > 0
+    edges = np.empty(len(shellLimits))
+    edges.fill(np.inf)
+    edges[positive] = 1. / shellLimits[positive] ** 2
+
+    indices = np.abs(edges[:, np.newaxis] - rowEdges[np.newaxis, :]).argmin(axis=1)
+    if len(rowEdges) > 1:
+        lastShellWidth = rowEdges[-1] - rowEdges[-2]
+    else:
+        lastShellWidth = rowEdges[-1]
+    indices[edges > rowEdges[-1] + lastShellWidth / 2] = -1
+    return indices
+
+
+# Columns of the per image tables of INTEGRATE.LP
+INTEGRATE_LP_IMAGE_COLUMNS = ['image', 'ier', 'scale', 'nbkg', 'novl', 'newald', 'nstrong', 'nrej', 'sigmab', 'sigmar']
+
+# a row of the tables, e.g.:
+#  IMAGE IER  SCALE     NBKG NOVL NEWALD NSTRONG  NREJ   SIGMAB   SIGMAR
+#      1   0  1.000  2214076    0   4589    1204     0  0.01815  0.09937
+integrateLpImageRowPattern = re.compile(r"^[ \t]*(\d+)[ \t]+(-?\d+)[ \t]+(\d+\.\d+)[ \t]+(\d+)[ \t]+(\d+)[ \t]+(\d+)"
+                                        r"[ \t]+(\d+)[ \t]+(\d+)[ \t]+(\d+\.\d+)[ \t]+(\d+\.\d+)[ \t]*$", re.MULTILINE)
+
+
+def parseIntegrateLpImageTable(contents):
+    """
+    Parses the per image tables of INTEGRATE.LP (one per block of images)
+
+    @param contents: text of INTEGRATE.LP
+
+    @return: dictionary column name (INTEGRATE_LP_IMAGE_COLUMNS) -> array with
+        one value per image, sorted by image. Empty if there are no tables.
+    """
+    rows = integrateLpImageRowPattern.findall(contents)
+    if len(rows) == 0:
+        return {}
+    values = np.array(rows, dtype=np.float64)
+    # images processed twice (e.g. refinement) keep the last values
+    images, lastRows = np.unique(values[::-1, 0], return_index=True)
+    values = values[len(values) - 1 - lastRows]
+
+    table = {}
+    for column, name in enumerate(INTEGRATE_LP_IMAGE_COLUMNS):
+        table[name] = values[:, column]
+    for name in ['image', 'ier', 'nbkg', 'novl', 'newald', 'nstrong', 'nrej']:
+        table[name] = table[name].astype(np.int64)
+    return table
+
+
+def readIntegrateLpImageTable(xdsLogFilePath):
+    """
+    Reads INTEGRATE.LP and parses its per image tables (see parseIntegrateLpImageTable)
+    """
+    inp = open(xdsLogFilePath, "r")
+    contents = inp.read()
+    inp.close()
+    return parseIntegrateLpImageTable(contents)
+
+
+def flagAnomalousImages(table, threshold=5.0):
+    """
+    Images with an error code (IER != 0) or whose SCALE, NSTRONG or SIGMAR
+    is further than threshold robust standard deviations (1.4826 * median
+    absolute deviation) from the linear trend of the wedge (the decay with
+    the dose is not flagged).
+
+    @return: boolean array, True for the anomalous images
+    """
+    anomalous = table['ier'] != 0
+    images = np.asarray(table['image'], dtype=np.float64)
+    for name in ['scale', 'nstrong', 'sigmar']:
+        values = np.asarray(table[name], dtype=np.float64)
+        if len(values) > 2:
+            values = values - np.polyval(np.polyfit(images, values, 1), images)
+        residuals = np.abs(values - np.median(values))
+        deviation = 1.4826 * np.median(residuals)
+        if deviation > 0:
+            anomalous |= residuals > threshold * deviation
+    return anomalous